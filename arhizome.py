@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Asynchronous access to the Rhizome REST API. All requests share a small
+pool of keep-alive HTTP connections, so that many calls can be handled at
+the same time without a thread per call.
+'''
+
+import base64
+import asyncio
+import contextlib
+
+from pyserval.lowlevel.rhizome import Manifest
+from pyserval.rhizome import Bundle
+from pyserval.exceptions import DecryptionError, InvalidTokenError
+from pyserval.exceptions import ManifestNotFoundError, PayloadNotFoundError
+from requests.structures import CaseInsensitiveDict
+
+import transfer
+from transfer import CHUNK_SIZE, MultipartStream
+
+# Number of connections used at the same time, if not configured.
+CONNECTIONS = 8
+
+
+class HTTPStatusError(Exception):
+    '''Raised for responses with an unexpected HTTP status
+    '''
+
+    def __init__(self, status, reason):
+        '''Init the error
+
+        Arguments:
+            status -- The HTTP status code
+            reason -- The reason phrase of the response
+        '''
+
+        super().__init__(status, reason)
+        self.http_status = status
+        self.reason = reason
+
+    def __str__(self):
+        return 'Unexpected HTTP status {} {}'.format(self.http_status,
+                                                    self.reason)
+
+
+class Response():
+    '''A HTTP response, the body is read on demand
+    '''
+
+    def __init__(self, reader, status, reason, headers, method):
+        '''Init the response after the headers were read
+
+        Arguments:
+            reader -- StreamReader of the connection
+            status -- The HTTP status code
+            reason -- The reason phrase
+            headers -- CaseInsensitiveDict of the headers
+            method -- The method of the request
+        '''
+
+        self.reader = reader
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+        # The body is either chunked, has a known length or lasts until the
+        # connection is closed.
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding',
+                                                '').lower()
+        self.remaining = None
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            self.remaining = 0
+        elif not self.chunked and 'Content-Length' in headers:
+            self.remaining = int(headers['Content-Length'])
+        self.chunk_left = 0
+        self.complete = self.remaining == 0
+        self.keep_alive = (
+            headers.get('Connection', '').lower() != 'close' and
+            (self.chunked or self.remaining is not None))
+
+    async def read_chunk(self, timeout=None):
+        '''Read the next part of the body, as soon as it arrived
+
+        Keyword Arguments:
+            timeout -- Seconds without data, after which asyncio.TimeoutError
+            is raised (default: {None})
+
+        Returns:
+            The received bytes, empty at the end of the body
+        '''
+
+        if self.complete:
+            return b''
+
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await asyncio.wait_for(self.reader.readline(), timeout)
+                self.chunk_left = int(line.split(b';')[0].strip() or b'0', 16)
+                if self.chunk_left == 0:
+                    # Skip the trailers.
+                    while (await asyncio.wait_for(self.reader.readline(),
+                                                  timeout)).strip():
+                        pass
+                    self.complete = True
+                    return b''
+
+            data = await asyncio.wait_for(
+                self.reader.read(min(self.chunk_left, CHUNK_SIZE)), timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(data, self.chunk_left)
+            self.chunk_left = self.chunk_left - len(data)
+            if self.chunk_left == 0:
+                await asyncio.wait_for(self.reader.readexactly(2), timeout)
+            return data
+
+        size = CHUNK_SIZE
+        if self.remaining is not None:
+            size = min(self.remaining, CHUNK_SIZE)
+        data = await asyncio.wait_for(self.reader.read(size), timeout)
+
+        if self.remaining is None:
+            self.complete = not data
+            return data
+
+        if not data:
+            raise asyncio.IncompleteReadError(data, self.remaining)
+        self.remaining = self.remaining - len(data)
+        self.complete = self.remaining == 0
+        return data
+
+    async def read(self, timeout=None):
+        '''Read the whole body
+
+        Keyword Arguments:
+            timeout -- Seconds without data (default: {None})
+
+        Returns:
+            The body
+        '''
+
+        body = bytearray()
+        while True:
+            data = await self.read_chunk(timeout)
+            if not data:
+                return bytes(body)
+            body.extend(data)
+
+    async def text(self, timeout=None):
+        '''Read the whole body as text
+
+        Keyword Arguments:
+            timeout -- Seconds without data (default: {None})
+
+        Returns:
+            The decoded body
+        '''
+
+        return (await self.read(timeout)).decode('utf-8')
+
+
+class AsyncRhizome():
+    '''Rhizome REST client for asyncio. At most 'connections' requests are
+    sent at the same time, idle connections are reused.
+    '''
+
+    def __init__(self, host, port, user, passwd, connections=CONNECTIONS,
+                 rhizome=None):
+        '''Init the client, connections are opened on demand
+
+        Arguments:
+            host -- Host of the Serval daemon
+            port -- Port of the REST interface
+            user -- REST user
+            passwd -- Password of the REST user
+
+        Keyword Arguments:
+            connections -- Size of the connection pool
+            (default: {CONNECTIONS})
+            rhizome -- Pyserval Rhizome connection, set in returned bundles
+            (default: {None})
+        '''
+
+        self.host = host
+        self.port = int(port)
+        self.rhizome = rhizome
+        self.authorization = 'Basic {}'.format(
+            base64.b64encode('{}:{}'.format(user, passwd).encode('utf-8'))
+            .decode('ascii'))
+        self.slots = asyncio.Semaphore(connections)
+        self.idle = []
+
+    async def _connection(self):
+        '''Get an idle connection or open a new one
+
+        Returns:
+            Tuple of StreamReader, StreamWriter and if the connection was
+            used before
+        '''
+
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer, True)
+            writer.close()
+
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return (reader, writer, False)
+
+    async def _send(self, writer, method, path, body, content_type):
+        '''Send a request
+
+        Arguments:
+            writer -- StreamWriter of the connection
+            method -- HTTP method
+            path -- Path of the endpoint
+            body -- Body as bytes or MultipartStream, may be None
+            content_type -- Content type of the body, may be None
+        '''
+
+        head = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}:{}'.format(self.host, self.port),
+            'Authorization: {}'.format(self.authorization),
+            'Connection: keep-alive'
+        ]
+        if body is not None:
+            head.append('Content-Length: {}'.format(len(body)))
+        if content_type is not None:
+            head.append('Content-Type: {}'.format(content_type))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('utf-8'))
+
+        if isinstance(body, MultipartStream):
+            for chunk in body:
+                writer.write(chunk)
+                await writer.drain()
+        elif body:
+            writer.write(body)
+        await writer.drain()
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, path, body=None, content_type=None,
+                      timeout=None):
+        '''Send a request and get the response. The connection is released
+        when the context is left, it is reused if the body was read
+        completely.
+
+        Arguments:
+            method -- HTTP method
+            path -- Path of the endpoint
+
+        Keyword Arguments:
+            body -- Body as bytes or MultipartStream (default: {None})
+            content_type -- Content type of the body (default: {None})
+            timeout -- Seconds without data, after which
+            asyncio.TimeoutError is raised (default: {None})
+
+        Returns:
+            Context manager of the Response
+        '''
+
+        async with self.slots:
+            response = None
+            reader, writer, reused = await self._connection()
+            try:
+                try:
+                    await self._send(writer, method, path, body, content_type)
+                    response = await asyncio.wait_for(
+                        self._read_head(reader, method), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # Serval may have closed an idle connection meanwhile,
+                    # so the request is sent once more on a new one.
+                    if not reused:
+                        raise
+                    writer.close()
+                    reader, writer = await asyncio.open_connection(
+                        self.host, self.port)
+                    await self._send(writer, method, path, body, content_type)
+                    response = await asyncio.wait_for(
+                        self._read_head(reader, method), timeout)
+
+                yield response
+
+            finally:
+                if response is not None and response.complete and \
+                        response.keep_alive:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+
+    @staticmethod
+    async def _read_head(reader, method):
+        '''Read the status line and the headers of a response
+
+        Arguments:
+            reader -- StreamReader of the connection
+            method -- The method of the request
+
+        Returns:
+            The Response
+        '''
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by Serval')
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+
+        headers = CaseInsensitiveDict()
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            key, value = line.split(':', 1)
+            headers[key.strip()] = value.strip()
+
+        return Response(reader, status, reason, headers, method)
+
+    async def get_bundlelist(self):
+        '''Get all bundles of the store, the newest first
+
+        Returns:
+            List of bundles with the standard manifest fields only
+        '''
+
+        async with self.request(
+                'GET', '/restful/rhizome/bundlelist.json') as response:
+            body = await response.read()
+            if response.status != 200:
+                raise HTTPStatusError(response.status, response.reason)
+
+        parser = transfer.TableParser()
+        return [
+            transfer.row_to_bundle(self.rhizome, header, row)
+            for header, row in parser.feed(body)
+        ]
+
+    async def newsince(self, token, timeout=None):
+        '''Stream all bundles inserted after token, see transfer.newsince
+
+        Arguments:
+            token -- The newsince token
+
+        Keyword Arguments:
+            timeout -- Seconds without data, after which the connection is
+            given up (default: {None})
+
+        Returns:
+            Async generator of bundles with the standard manifest fields only
+        '''
+
+        async with self.request(
+                'GET',
+                '/restful/rhizome/newsince/{}/bundlelist.json'.format(token),
+                timeout=timeout) as response:
+            if response.status == 404:
+                await response.read(timeout)
+                raise InvalidTokenError(token, response.reason)
+            if response.status != 200:
+                await response.read(timeout)
+                raise HTTPStatusError(response.status, response.reason)
+
+            # Unlike the blocking client, every read returns what already
+            # arrived, so rows are passed on right away.
+            parser = transfer.TableParser()
+            while True:
+                data = await response.read_chunk(timeout)
+                if not data:
+                    break
+                for header, row in parser.feed(data):
+                    yield transfer.row_to_bundle(self.rhizome, header, row)
+
+    async def get_bundle(self, bundle_id):
+        '''Get a bundle with its complete manifest, see transfer.get_bundle
+
+        Arguments:
+            bundle_id -- The ID of the bundle
+
+        Returns:
+            The bundle with an empty payload
+        '''
+
+        async with self.request(
+                'GET',
+                '/restful/rhizome/{}.rhm'.format(bundle_id)) as response:
+            text = await response.text()
+            if response.status == 404:
+                raise ManifestNotFoundError(bundle_id)
+            if response.status != 200:
+                raise HTTPStatusError(response.status, response.reason)
+
+        manifest = Manifest()
+        manifest.update(text)
+
+        return Bundle(
+            self.rhizome,
+            manifest=manifest,
+            payload='',
+            bundle_id=manifest.id,
+            complete=True)
+
+    async def get_payload(self, bundle):
+        '''Get the payload of a bundle into memory, for small payloads only
+
+        Arguments:
+            bundle -- The bundle
+
+        Returns:
+            The payload
+        '''
+
+        async with self.request(
+                'GET', '/restful/rhizome/{}/raw.bin'.format(
+                    bundle.bundle_id)) as response:
+            payload = await response.read()
+            if response.status == 404:
+                raise PayloadNotFoundError(bundle.bundle_id)
+            if response.status != 200:
+                raise HTTPStatusError(response.status, response.reason)
+
+        return payload
+
+    async def download_payload(self, bundle, path):
+        '''Stream the payload of a bundle into a file, see
+        transfer.download_payload
+
+        Arguments:
+            bundle -- The bundle, the manifest must be complete
+            path -- Path of the file to be written
+
+        Returns:
+            The path of the written file
+        '''
+
+        endpoint = 'raw.bin'
+        if bundle.manifest.crypt == 1:
+            endpoint = 'decrypted.bin'
+
+        async with self.request(
+                'GET', '/restful/rhizome/{}/{}'.format(
+                    bundle.bundle_id, endpoint)) as response:
+            if response.status != 200:
+                await response.read()
+            if response.status == 419:
+                raise DecryptionError(bundle.bundle_id)
+            if response.status == 404:
+                raise PayloadNotFoundError(bundle.bundle_id)
+            if response.status != 200:
+                raise HTTPStatusError(response.status, response.reason)
+
+            with open(path, 'wb') as payload_file:
+                while True:
+                    data = await response.read_chunk()
+                    if not data:
+                        break
+                    payload_file.write(data)
+
+        return path
+
+    async def _insert(self, sender, fields, payload_path=None, payload=b'',
+                      bundle_id=None, bundle_secret=None):
+        '''Insert or update a bundle, the payload is streamed from a file
+
+        Arguments:
+            sender -- SID of the local identity authoring the bundle
+            fields -- List of (key, value) of the manifest
+
+        Keyword Arguments:
+            payload_path -- Path to the payload, payload is used if None
+            (default: {None})
+            payload -- Small payload as bytes (default: {b''})
+            bundle_id -- ID of the bundle to be updated (default: {None})
+            bundle_secret -- Secret key of the bundle (default: {None})
+
+        Returns:
+            The bundle with an empty payload
+        '''
+
+        body = MultipartStream(
+            transfer.insert_parts(sender, fields, bundle_id, bundle_secret),
+            payload_path, payload)
+
+        async with self.request('POST', '/restful/rhizome/insert', body,
+                                body.content_type) as response:
+            text = await response.text()
+
+        return transfer.insert_result(self.rhizome, sender, response.status,
+                                      text, response.headers)
+
+    async def insert_bundle(self,
+                            sender,
+                            payload_path=None,
+                            name='',
+                            service='',
+                            recipient='',
+                            custom_manifest=None,
+                            bundle_secret=None,
+                            payload=b''):
+        '''Insert a new bundle, see transfer.insert_bundle
+
+        Arguments:
+            sender -- SID of the local identity authoring the bundle, the
+            bundle is anonymous if empty
+
+        Keyword Arguments:
+            payload_path -- Path to the payload, payload is used if None
+            (default: {None})
+            name -- Name of the bundle (default: {''})
+            service -- Service of the bundle (default: {''})
+            recipient -- SID of the recipient, the payload is encrypted if
+            set (default: {''})
+            custom_manifest -- Additional manifest fields (default: {None})
+            bundle_secret -- Secret key of the bundle as hex string
+            (default: {None})
+            payload -- Small payload as bytes, if there is no payload_path
+            (default: {b''})
+
+        Returns:
+            The new bundle with an empty payload
+        '''
+
+        fields = [('name', name), ('service', service), ('sender', sender),
+                  ('recipient', recipient), ('crypt', 1 if recipient else 0)]
+        if custom_manifest:
+            fields.extend(custom_manifest.items())
+
+        return await self._insert(sender, fields, payload_path, payload,
+                                  bundle_secret=bundle_secret)
+
+    async def update_bundle(self, bundle, sender, payload_path=None,
+                            payload=b''):
+        '''Replace the payload of a bundle authored by this node. Changes
+        of the manifest are kept, size, hash and version are recomputed.
+
+        Arguments:
+            bundle -- The bundle with a complete manifest
+            sender -- SID of the local identity, which authored the bundle
+
+        Keyword Arguments:
+            payload_path -- Path to the new payload, payload is used if None
+            (default: {None})
+            payload -- Small new payload as bytes (default: {b''})
+
+        Returns:
+            The updated bundle with an empty payload
+        '''
+
+        fields = [(key, value) for key, value in bundle.manifest.fields()
+                  if key not in ('filesize', 'filehash', 'version')]
+
+        return await self._insert(sender, fields, payload_path, payload,
+                                  bundle_id=bundle.bundle_id)
+
+    def close(self):
+        '''Close all idle connections
+        '''
+
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
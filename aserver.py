@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''The asynchronous server mode. Watching the store, publishing the offer,
+downloading and sending bundles and executing procedures are coroutines on
+one event loop, so that a call waiting for the network or a procedure does
+not occupy a thread. The state shared with the blocking server, e.g. the
+bundles to be cleaned up, lives in the server module.
+'''
+
+import os
+import time
+import shutil
+import asyncio
+import zipfile
+import functools
+
+from json.decoder import JSONDecodeError
+
+from pyserval.exceptions import DuplicateBundleException, DecryptionError
+from pyserval.exceptions import PayloadNotFoundError, ManifestNotFoundError
+from pyserval.exceptions import InvalidTokenError, RhizomeInsertionError
+
+import server
+import utilities
+import blobs
+from arhizome import AsyncRhizome, HTTPStatusError, CONNECTIONS
+from watcher import MIN_DELAY, MAX_DELAY
+from utilities import LOGGER
+from utilities import ACK, CALL, CLEANUP, ERROR, RESULT, CONFIGURATION
+from utilities import RPC, OFFER, GATHER, BLOB
+
+# Errors of a single request to Serval, which are logged and skipped.
+REQUEST_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                  HTTPStatusError, RhizomeInsertionError)
+
+# The asynchronous Rhizome client.
+ARHIZOME = None
+
+# Number of procedures executed at the same time.
+WORKERS = 4
+
+# Limits the procedures executed at the same time to WORKERS.
+WORKER_SLOTS = None
+
+# Maximal number of calls handled at the same time, further calls are
+# refused.
+MAX_CALLS = 1024
+
+# Number of calls being handled and of procedures being executed.
+CALLS = 0
+RUNNING = 0
+
+# The bundle of our offer, once it is known.
+OFFER_BUNDLE = None
+
+# All running tasks, so that they are not garbage collected.
+TASKS = set()
+
+
+def blocking(function, *args, **kwargs):
+    '''Run a blocking function in the default thread pool
+
+    Arguments:
+        function -- The function
+        *args -- Its arguments
+        **kwargs -- Its keyword arguments
+
+    Returns:
+        Future of the result
+    '''
+
+    return asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
+
+
+def spawn(coroutine):
+    '''Run a coroutine as task in background. Exceptions are logged.
+
+    Arguments:
+        coroutine -- The coroutine
+    '''
+
+    task = asyncio.get_running_loop().create_task(coroutine)
+    TASKS.add(task)
+    task.add_done_callback(task_done)
+
+
+def task_done(task):
+    '''Forget a finished task and log its exception
+
+    Arguments:
+        task -- The task
+    '''
+
+    TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        LOGGER.error(' | Task failed: {}'.format(task.exception()),
+                     exc_info=task.exception())
+
+
+async def publish_procedures():
+    '''Publish the offered procedures, the capabilities and the status of
+    the server. The offer bundle is looked up once and updated afterwards.
+    '''
+
+    global OFFER_BUNDLE
+
+    payload = server.offer_payload(WORKERS, CALLS - RUNNING, RUNNING)
+    payload = payload.encode('utf-8')
+
+    if OFFER_BUNDLE is None:
+        for bundle in await ARHIZOME.get_bundlelist():
+            if bundle.from_here == 1 and bundle.manifest.service == OFFER:
+                OFFER_BUNDLE = await ARHIZOME.get_bundle(bundle.bundle_id)
+                break
+
+    if OFFER_BUNDLE is not None:
+        OFFER_BUNDLE = await ARHIZOME.update_bundle(
+            OFFER_BUNDLE, server.SERVER_DEFAULT_SID, payload=payload)
+    else:
+        OFFER_BUNDLE = await ARHIZOME.insert_bundle(
+            server.SERVER_DEFAULT_SID,
+            name=server.SERVER_DEFAULT_SID,
+            service=OFFER,
+            payload=payload)
+
+
+async def publish_loop():
+    '''Publish the offer at startup and then periodically
+    '''
+
+    while True:
+        try:
+            await publish_procedures()
+        except REQUEST_ERRORS as e:
+            LOGGER.warn(' | Publishing procedures failed, hint: {}'.format(e))
+
+        # Calls still missing chunks fail after 'blob_timeout'.
+        server.resume_calls(server.resumable_calls(), resume_call)
+
+        # Calls to other servers without answer count as failed.
+        await blocking(utilities.LATENCY.expire)
+
+        LOGGER.info(' | Calls: {} waiting, {} running, {} tasks'.format(
+            CALLS - RUNNING, RUNNING, len(TASKS)))
+        await asyncio.sleep(30)
+
+
+async def return_error(call_bundle, reason, file_list=None,
+                       zip_file_name=None):
+    '''Inform the client about an error, see server.return_error
+
+    Arguments:
+        call_bundle -- The bundle where the error happend.
+        reason -- The reason of the error
+
+    Keyword Arguments:
+        file_list -- Files, which should be sent to the client
+        (default: {None})
+        zip_file_name -- The name of the ZIP file created (default: {None})
+    '''
+
+    payload_path = None
+    if file_list is not None:
+        payload_path = await blocking(
+            blobs.make_zip,
+            server.SERVAL.rhizome,
+            file_list,
+            name=zip_file_name + '_error.zip',
+            subpath_to_remove=zip_file_name,
+            owner=call_bundle.bundle_id)
+
+    error_bundle = await ARHIZOME.insert_bundle(
+        server.SERVER_DEFAULT_SID,
+        payload_path=payload_path,
+        name=call_bundle.manifest.name,
+        service=RPC,
+        recipient=call_bundle.manifest.originator,
+        custom_manifest={
+            'type': ERROR,
+            'reason': reason,
+            'originator': call_bundle.manifest.originator,
+            'rpcid': call_bundle.manifest.rpcid
+        })
+    LOGGER.debug('Returned Error with {} to {}'.format(
+        error_bundle.bundle_id, call_bundle.manifest.originator))
+
+    server.remember_bundle(call_bundle, error_bundle)
+
+
+async def execute_procedure(job, env_path, job_id):
+    '''Execute a procedure as subprocess, see
+    server.server_execute_procedure_cached. At most WORKERS procedures are
+    executed at the same time.
+
+    Arguments:
+        job -- The job to be executed
+        env_path -- The temporary path where the procedure will be executed
+        job_id -- The ID of the call, used for logging
+
+    Returns:
+        The return code of the procedure and a string containing the result
+    '''
+
+    global RUNNING
+
+    key, result = await blocking(server.lookup_cached_result, job, env_path,
+                                 job_id)
+    if result is not None:
+        return (0, result)
+
+    error = server.resolve_arguments(job, env_path)
+    if error:
+        return (1, error)
+
+    async with WORKER_SLOTS:
+        RUNNING = RUNNING + 1
+        try:
+            options = server.get_procedure_options(job)
+            if 'persistent' in options:
+                # The warm workers are blocking, so they get a thread.
+                workers = int(options['persistent'] or 1)
+                code, result = await blocking(
+                    server.get_persistent_procedure(job, workers).call,
+                    job.arguments)
+            else:
+                # The arguments are passed as they are, there is no shell
+                # in between. A missing or not executable procedure fails
+                # like the procedure itself.
+                try:
+                    job_process = await asyncio.create_subprocess_exec(
+                        os.path.join(CONFIGURATION['bins'], job.procedure),
+                        *job.arguments,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE)
+                except OSError as e:
+                    LOGGER.error('{} | Could not start {}: {}'.format(
+                        job_id, job.procedure, e))
+                    return (1, str(e).encode('utf-8'))
+                out, err = await job_process.communicate()
+
+                code, result = (0, out.rstrip())
+                if job_process.returncode != 0:
+                    code, result = (1, err.rstrip())
+        finally:
+            RUNNING = RUNNING - 1
+
+    if code == 0 and key is not None:
+        await blocking(server.store_cached_result, key, env_path, result)
+
+    return (code, result)
+
+
+async def handle_call(potential_call):
+    '''Download and extract a call and execute its job, see
+    server.server_handle_call
+
+    Arguments:
+        potential_call -- The bundle containing the call
+    '''
+
+    exec_time = int(time.time() * 1000)
+
+    job_id = potential_call.manifest.rpcid
+    zip_file_base_path = '{}_{}'.format(job_id, exec_time)
+    zip_file_step_path = '{}_step.zip'.format(zip_file_base_path)
+
+    try:
+        await ARHIZOME.download_payload(potential_call, zip_file_step_path)
+    except (DecryptionError, PayloadNotFoundError) as e:
+        LOGGER.error('{} | Could not download the call, skipping. ({})'
+                     .format(job_id, e))
+        return
+
+    if not zipfile.is_zipfile(zip_file_step_path):
+        reason = '{} | {} is not a valid ZIP file.'.format(
+            job_id, zip_file_step_path)
+        LOGGER.critical(reason)
+        await return_error(
+            potential_call,
+            reason,
+            file_list=[zip_file_step_path],
+            zip_file_name=zip_file_step_path)
+        return
+
+    # Blobs referenced in the ZIP file are fetched by the blocking client.
+    # Missing chunks are not waited for, the call is parked instead.
+    try:
+        file_list = await blocking(blobs.extract_zip, server.SERVAL.rhizome,
+                                   zip_file_step_path,
+                                   zip_file_base_path + '/', timeout=0)
+    except blobs.BlobNotFoundError as e:
+        shutil.rmtree(zip_file_base_path, ignore_errors=True)
+        os.remove(zip_file_step_path)
+        if server.wait_for_blobs(potential_call, e):
+            LOGGER.info('{} | Waiting for {} chunks.'.format(
+                job_id, e.missing))
+            return
+
+        reason = '{} | {}'.format(job_id, e)
+        LOGGER.critical(reason)
+        await return_error(potential_call, reason)
+        return
+
+    with server.LOCK:
+        server.WAITING_CALLS.pop(potential_call.bundle_id, None)
+
+    job_file_path, possible_job = server.find_call_job(potential_call,
+                                                       file_list)
+    if job_file_path is None:
+        reason = '{} | Call has no job file.'.format(job_id)
+        LOGGER.critical(reason)
+        await return_error(
+            potential_call,
+            reason,
+            file_list=file_list,
+            zip_file_name=zip_file_base_path)
+        return
+
+    step = await blocking(server.Step, potential_call, zip_file_base_path,
+                          job_file_path, possible_job, file_list)
+    await handle_step(step)
+
+
+async def handle_step(step):
+    '''Execute a job of a call and the following local jobs, see
+    server.server_handle_step. The decisions are made by the step, looking
+    up servers and touching the working directory runs in threads.
+
+    Arguments:
+        step -- The server.Step of the call
+    '''
+
+    own_sid = server.SERVER_DEFAULT_SID
+
+    await blocking(step.take_snapshot)
+
+    while True:
+        reason = step.check()
+        if reason:
+            await return_error(step.call, reason, **step.error_arguments())
+            return
+
+        ack_fields = step.ack_fields()
+        if ack_fields:
+            try:
+                await ARHIZOME.insert_bundle(own_sid, **ack_fields)
+            except DuplicateBundleException:
+                pass
+
+        if not await blocking(step.join):
+            return
+
+        LOGGER.info('{} | -Execution- Starting execution of {}...'.format(
+            step.job_id, step.job.procedure))
+        if step.job.procedure == GATHER:
+            code, result = step.gather()
+        else:
+            code, result = await execute_procedure(
+                step.job, step.env_path + '/', step.job_id)
+
+        if step.consume_energy():
+            await publish_procedures()
+
+        next_jobs = await blocking(step.finish, code, result)
+        if not next_jobs:
+            break
+
+        # Looking up servers may query the store, so it runs in a thread.
+        reason = await blocking(step.plan, next_jobs)
+        if reason:
+            await return_error(step.call, reason, **step.error_arguments())
+            return
+
+        if step.remote_jobs:
+            payload_path = await blocking(
+                blobs.make_zip,
+                server.SERVAL.rhizome,
+                await blocking(step.next_hop_files),
+                name=step.result_step_path,
+                subpath_to_remove=step.env_path + '/',
+                owner=step.call.bundle_id)
+
+            for next_job in step.remote_jobs:
+                next_hop_bundle = await ARHIZOME.insert_bundle(
+                    own_sid,
+                    payload_path=payload_path,
+                    **step.next_hop_fields(next_job))
+                step.next_hop_sent(next_job, next_hop_bundle)
+
+        if not step.local_jobs:
+            return
+
+        # Further local branches are tasks of their own and count as calls.
+        # If the server is overloaded, the branch is executed right here.
+        for next_job in step.local_jobs[1:]:
+            branch = await blocking(step.branch, next_job)
+            if CALLS < MAX_CALLS:
+                spawn(counted(handle_step(branch)))
+            else:
+                await handle_step(branch)
+
+        step.continue_with(step.local_jobs[0])
+
+    payload_path = await blocking(
+        blobs.make_zip,
+        server.SERVAL.rhizome,
+        await blocking(step.result_files),
+        name=step.result_path,
+        subpath_to_remove=step.env_path + '/',
+        owner=step.call.bundle_id)
+
+    result_bundle = await ARHIZOME.insert_bundle(
+        own_sid,
+        payload_path=payload_path,
+        **step.result_fields())
+    step.result_sent(result_bundle)
+
+
+async def counted(coroutine):
+    '''Handle a call or a local branch and keep the number of calls up to
+    date
+
+    Arguments:
+        coroutine -- The coroutine handling the call
+    '''
+
+    global CALLS
+
+    CALLS = CALLS + 1
+    try:
+        await coroutine
+    finally:
+        CALLS = CALLS - 1
+
+
+def resume_call(potential_call):
+    '''Handle a call waiting for chunks again, see server.resume_calls
+
+    Arguments:
+        potential_call -- The bundle containing the call
+
+    Returns:
+        False, if the server is overloaded
+    '''
+
+    if CALLS >= MAX_CALLS:
+        return False
+    spawn(counted(handle_call(potential_call)))
+    return True
+
+
+async def cleanup_store(bundle):
+    '''Set the CLEANUP flag of all bundles sent because of a call and
+    remove their payloads, see server.server_cleanup_store
+
+    Arguments:
+        bundle -- The bundle which needs to be cleaned
+    '''
+
+    await blocking(blobs.release_blobs, server.SERVAL.rhizome,
+                   bundle.bundle_id)
+
+    stored_bundle_ids = server.CLEANUP_BUNDLES.pop(bundle.bundle_id, None)
+    if not stored_bundle_ids:
+        return
+
+    for stored_bundle_id in stored_bundle_ids:
+        stored_bundle = await ARHIZOME.get_bundle(stored_bundle_id)
+        stored_bundle.manifest.type = CLEANUP
+        await ARHIZOME.update_bundle(stored_bundle, server.SERVER_DEFAULT_SID)
+
+
+async def dispatch_bundle(bundle):
+    '''Handles a single bundle returned by newsince, see
+    server.server_dispatch_bundle
+
+    Arguments:
+        bundle -- The bundle from the newsince list
+    '''
+
+    if bundle.manifest.service == OFFER:
+        if utilities.REGISTRY.needs_update(bundle):
+            utilities.REGISTRY.add(bundle, await ARHIZOME.get_payload(bundle))
+        return
+
+    if bundle.manifest.service == BLOB:
+        server.resume_calls(server.resumable_calls(bundle.bundle_id),
+                            resume_call)
+        return
+
+    if not bundle.manifest.service == RPC:
+        return
+
+    # The bundle may still tell that a server we called completed the call.
+    if not bundle.manifest.recipient == server.SERVER_DEFAULT_SID:
+        if utilities.LATENCY.waiting_for(bundle.manifest.sender):
+            manifest = (await ARHIZOME.get_bundle(bundle.bundle_id)).manifest
+            utilities.LATENCY.observe(manifest)
+        LOGGER.debug(
+            " | Received RPC bundle for other client, skipping. (bid:{})"
+            .format(bundle.manifest.id))
+        return
+
+    try:
+        potential_call = await ARHIZOME.get_bundle(bundle.bundle_id)
+    except (DecryptionError, ManifestNotFoundError):
+        LOGGER.error(
+            " | Error decrypting received RPC bundle, skipping. (bid:{})"
+            .format(bundle.manifest.id))
+        return
+    utilities.LATENCY.observe(potential_call.manifest)
+
+    if potential_call.manifest.type == ACK:
+        LOGGER.info('{} | Received ACK for {} from {}'.format(
+            potential_call.manifest.rpcid,
+            potential_call.manifest.name,
+            potential_call.manifest.sender))
+
+    elif potential_call.manifest.type == CALL:
+        LOGGER.info(
+            '{} | -Runtime- Received call, starting handling.'
+            .format(potential_call.manifest.rpcid))
+        if CALLS >= MAX_CALLS:
+            reason = 'Server is overloaded.'
+            LOGGER.critical('{} | {} ({} calls, {} running)'.format(
+                potential_call.manifest.rpcid, reason, CALLS, RUNNING))
+            await return_error(potential_call, reason)
+            return
+        await counted(handle_call(potential_call))
+
+    elif potential_call.manifest.type == CLEANUP:
+        LOGGER.info('{} | Cleaning up store for bundle {}'.format(
+            potential_call.manifest.rpcid, bundle.bundle_id))
+        await cleanup_store(potential_call)
+
+    elif potential_call.manifest.type == RESULT:
+        LOGGER.debug('{} | Recieved RPC result, skipping.'.format(
+            potential_call.manifest.rpcid))
+    else:
+        LOGGER.error(
+            "{} | Received RPC bundle of unknown type ({}), skipping."
+            .format(potential_call.manifest.rpcid,
+                    potential_call.manifest.type))
+
+
+async def watch(token):
+    '''Stream new bundles and dispatch every bundle in its own task, see
+    watcher.BundleWatcher
+
+    Arguments:
+        token -- The newsince token to start with
+    '''
+
+    timeout = float(CONFIGURATION.get('newsince_timeout', 90))
+    delay = MIN_DELAY
+
+    while True:
+        received = False
+        try:
+            async for bundle in ARHIZOME.newsince(token, timeout):
+                received = True
+                token = bundle.token
+                delay = MIN_DELAY
+                spawn(dispatch_bundle(bundle))
+
+        except REQUEST_ERRORS as e:
+            LOGGER.warn(
+                " | Error while calling newsince, hint: {}, continuing..."
+                .format(e))
+
+        except InvalidTokenError as e:
+            LOGGER.warn(
+                " | InvalidTokenError while calling newsince, hint: {}, continuing..."
+                .format(e))
+
+        except (KeyError, JSONDecodeError) as e:
+            LOGGER.warn(
+                " | Invalid newsince response, hint: {}, continuing..."
+                .format(e))
+
+        else:
+            if received:
+                continue
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_DELAY)
+
+
+async def serve(token):
+    '''Run the publisher and the watcher until cancelled
+
+    Arguments:
+        token -- The newsince token to start with
+    '''
+
+    global ARHIZOME
+    global WORKER_SLOTS
+
+    ARHIZOME = AsyncRhizome(
+        CONFIGURATION['host'],
+        CONFIGURATION['port'],
+        CONFIGURATION['user'],
+        CONFIGURATION['passwd'],
+        connections=int(CONFIGURATION.get('async_connections', CONNECTIONS)),
+        rhizome=server.SERVAL.rhizome)
+    WORKER_SLOTS = asyncio.Semaphore(WORKERS)
+
+    LOGGER.info(' | Publishing procedures and capabilities.')
+    publisher = asyncio.get_running_loop().create_task(publish_loop())
+    try:
+        await watch(token)
+    finally:
+        publisher.cancel()
+        for task in list(TASKS):
+            task.cancel()
+        ARHIZOME.close()
+
+
+def server_listen_async(queue):
+    '''The listening function of the asynchronous server
+
+    Arguments:
+        queue -- If the procedures should be executed sequentially or not
+    '''
+
+    global WORKERS
+    global MAX_CALLS
+
+    LOGGER.info(' | Starting asynchronous server')
+
+    _, token = server.server_connect()
+
+    WORKERS = 1 if queue else int(CONFIGURATION.get('workers', 4))
+    MAX_CALLS = int(CONFIGURATION.get('async_calls', 1024))
+
+    try:
+        asyncio.run(serve(token))
+    finally:
+        server.stop_persistent_procedures()
+        utilities.LATENCY.save(force=True)
@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Content addressed, chunked transfer of large files.
+
+Files larger than the configured 'blob_min_size' are not put into the ZIP
+files of calls and results. Instead, every file is split into chunks of
+'blob_chunk_size' bytes and every chunk is inserted as a separate bundle (a
+blob), whose bundle ID is derived from the SHA-256 of its content. Thus, the
+same content always ends up in the same bundle and crosses the network only
+once, no matter how many hops or workflows use it. Chunks are synchronized
+independently, so short contacts still make progress and chunks can be
+received from several peers at once. The ZIP file only contains the file
+BLOB_MANIFEST with one line 'DIGEST CHUNK_SIZE CHUNKS PATH' per file, where
+CHUNKS is a comma separated list of 'CHUNK_DIGEST:BID'.
+
+Received chunks are kept in a local, size bounded store, so a node only
+downloads chunks it does not already hold. Chunks published for a call are
+owned by the call, once no call of the node owns a chunk any longer, its
+payload is removed from Rhizome.
+'''
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+from pyserval.exceptions import DuplicateBundleException
+from pyserval.exceptions import ManifestNotFoundError, PayloadNotFoundError
+from pyserval.exceptions import RhizomeHTTPStatusError
+
+import transfer
+import utilities
+from utilities import LOGGER, CONFIGURATION, BLOB, CLEANUP
+
+# Name of the blob manifest inside of ZIP files.
+BLOB_MANIFEST = '.blobs'
+
+
+class BlobNotFoundError(Exception):
+    '''Raised if a blob is neither in the local store nor in Rhizome
+    '''
+
+    def __init__(self, digest, bundle_id, missing=1, bundle_ids=None):
+        self.digest = digest
+        self.bundle_id = bundle_id
+        self.missing = missing
+        # Bundle IDs of all missing chunks.
+        self.bundle_ids = bundle_ids or []
+        super().__init__(
+            'Blob {} (bid: {}) is not available, {} chunks missing.'.format(
+                digest, bundle_id, missing))
+
+
+class BlobStore():
+    '''A directory of files named by the SHA-256 of their content. If the
+    total size exceeds the limit, the least recently used blobs are removed.
+    '''
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        '''Init the store, blobs already in path are taken over
+
+        Arguments:
+            path -- Directory of the store
+
+        Keyword Arguments:
+            max_bytes -- Maximal total size of all blobs
+            (default: {256 MiB})
+        '''
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        # Bundle IDs of the blobs inserted into Rhizome by this node. Blobs
+        # only fetched are not listed, another node may remove them.
+        self.bundles = {}
+        # Calls owning the published blobs, keyed by the digest.
+        self.owners = {}
+        self.lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # Restore the usage order from the modification times.
+        stored = []
+        for digest in os.listdir(path):
+            # Skip temporary files of interrupted transfers.
+            if digest.startswith('.'):
+                continue
+            stat = os.stat(os.path.join(path, digest))
+            stored.append((stat.st_mtime, digest, stat.st_size))
+        for _, digest, size in sorted(stored):
+            self.entries[digest] = size
+            self.size = self.size + size
+
+    def blob_path(self, digest):
+        '''Path of a blob in the store
+
+        Arguments:
+            digest -- The SHA-256 of the blob
+
+        Returns:
+            The path
+        '''
+
+        return os.path.join(self.path, digest)
+
+    def has(self, digest):
+        '''Check if a blob is stored and mark it as recently used
+
+        Arguments:
+            digest -- The SHA-256 of the blob
+
+        Returns:
+            True, if the blob is stored
+        '''
+
+        with self.lock:
+            if digest not in self.entries:
+                return False
+            self.entries.move_to_end(digest)
+            os.utime(self.blob_path(digest))
+            return True
+
+    def temp_path(self):
+        '''Create a temporary file in the store, which can be moved into
+        the store with add.
+
+        Returns:
+            The path of the temporary file
+        '''
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+        os.close(fd)
+        return tmp_path
+
+    def add(self, path, digest, move=False):
+        '''Copy a file into the store and evict old blobs if required
+
+        Arguments:
+            path -- Path of the file
+            digest -- The SHA-256 of the file
+
+        Keyword Arguments:
+            move -- Move the file instead of copying it, path has to be a
+            temporary file of the store (default: {False})
+        '''
+
+        if self.has(digest):
+            if move:
+                os.remove(path)
+            return
+
+        # Copy to a temporary file first, so that a blob is never visible
+        # incomplete.
+        tmp_path = path
+        if not move:
+            tmp_path = self.temp_path()
+            shutil.copyfile(path, tmp_path)
+        size = os.path.getsize(tmp_path)
+
+        with self.lock:
+            os.replace(tmp_path, self.blob_path(digest))
+            self.entries[digest] = size
+            self.size = self.size + size
+
+            # The blob just added is never evicted.
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted, evicted_size = self.entries.popitem(last=False)
+                self.size = self.size - evicted_size
+                os.remove(self.blob_path(evicted))
+                LOGGER.debug(' | Evicted blob {}.'.format(evicted))
+
+    def write_to(self, digest, out_file):
+        '''Write a blob into an open file at its current position
+
+        Arguments:
+            digest -- The SHA-256 of the blob
+            out_file -- The file opened for binary writing
+
+        Returns:
+            True, if the blob was written, False if it is not stored
+        '''
+
+        with self.lock:
+            if digest not in self.entries:
+                return False
+            self.entries.move_to_end(digest)
+            os.utime(self.blob_path(digest))
+
+            with open(self.blob_path(digest), 'rb') as blob_file:
+                shutil.copyfileobj(blob_file, out_file)
+            return True
+
+    def claim(self, digest, owner):
+        '''Mark a blob as used by a call
+
+        Arguments:
+            digest -- The SHA-256 of the blob
+            owner -- ID of the call
+        '''
+
+        with self.lock:
+            self.owners.setdefault(digest, set()).add(owner)
+
+    def release(self, owner):
+        '''Remove a call from the owners of all its blobs
+
+        Arguments:
+            owner -- ID of the call
+
+        Returns:
+            List of the digests without any owner left
+        '''
+
+        released = []
+        with self.lock:
+            for digest, owners in list(self.owners.items()):
+                if owner not in owners:
+                    continue
+                owners.discard(owner)
+                if not owners:
+                    del self.owners[digest]
+                    released.append(digest)
+        return released
+
+
+STORE = None
+STORE_LOCK = threading.Lock()
+
+
+def get_store():
+    '''Get the blob store, it is created on first use
+
+    Returns:
+        The BlobStore
+    '''
+
+    global STORE
+
+    with STORE_LOCK:
+        if STORE is None:
+            STORE = BlobStore(
+                CONFIGURATION.get('blob_store', 'blobs'),
+                max_bytes=int(
+                    CONFIGURATION.get('blob_store_bytes',
+                                      256 * 1024 * 1024)))
+        return STORE
+
+
+def blob_min_size():
+    '''Minimal size of files transferred as blobs
+
+    Returns:
+        The size in bytes or None, if blobs are disabled
+    '''
+
+    if 'blob_min_size' not in CONFIGURATION:
+        return None
+    return int(CONFIGURATION['blob_min_size'])
+
+
+def blob_secret(digest):
+    '''Derive the bundle secret of a blob from its content, so that all nodes
+    insert the same content into the same bundle.
+
+    Arguments:
+        digest -- The SHA-256 of the blob
+
+    Returns:
+        The bundle secret as hex string
+    '''
+
+    return hashlib.sha256('dtnrpc-blob:{}'.format(digest).encode(
+        'utf-8')).hexdigest()
+
+
+def publish_chunk(rhizome, data, digest, owner=None):
+    '''Insert a chunk as blob, if this node did not insert it already. A
+    chunk only fetched is inserted again, in case the node which inserted it
+    removed it in the meantime.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        data -- The content of the chunk
+        digest -- The SHA-256 of the chunk
+
+    Keyword Arguments:
+        owner -- ID of the call the chunk is published for, a blob inserted
+        by this node is removed from Rhizome when it is released
+        (default: {None})
+
+    Returns:
+        The bundle ID of the blob
+    '''
+
+    store = get_store()
+    if owner is not None:
+        store.claim(digest, owner)
+
+    bundle_id = store.bundles.get(digest)
+    if bundle_id is not None:
+        return bundle_id
+
+    tmp_path = store.temp_path()
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(data)
+
+    try:
+        bundle_id = transfer.insert_bundle(
+            rhizome,
+            '',
+            payload_path=tmp_path,
+            name=digest,
+            service=BLOB,
+            bundle_secret=blob_secret(digest)).bundle_id
+        LOGGER.debug(' | Published blob {} (bid: {}).'.format(
+            digest, bundle_id))
+        store.bundles[digest] = bundle_id
+    except DuplicateBundleException as e:
+        bundle_id = e.bid
+
+    store.add(tmp_path, digest, move=True)
+    return bundle_id
+
+
+def publish_file(rhizome, path, chunk_size, owner=None):
+    '''Split a file into chunks and insert all chunks as blobs
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        path -- Path of the file
+        chunk_size -- Size of the chunks in bytes
+
+    Keyword Arguments:
+        owner -- ID of the call the file is published for (default: {None})
+
+    Returns:
+        The SHA-256 of the file and a list of (digest, bundle ID) of all
+        chunks
+    '''
+
+    file_hash = hashlib.sha256()
+    chunks = []
+    with open(path, 'rb') as published_file:
+        for data in iter(lambda: published_file.read(chunk_size), b''):
+            file_hash.update(data)
+            digest = hashlib.sha256(data).hexdigest()
+            chunks.append((digest,
+                           publish_chunk(rhizome, data, digest, owner)))
+
+    return (file_hash.hexdigest(), chunks)
+
+
+def release_blobs(rhizome, owner):
+    '''Release all blobs published for a call. The payloads of blobs
+    inserted by this node and not used by any other of its calls are removed
+    from Rhizome, by inserting an empty version of the bundle. The chunks
+    stay in the local store.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        owner -- ID of the call
+    '''
+
+    store = get_store()
+    for digest in store.release(owner):
+        if store.bundles.pop(digest, None) is None:
+            continue
+
+        try:
+            transfer.insert_bundle(
+                rhizome,
+                '',
+                name=digest,
+                service=BLOB,
+                custom_manifest={'type': CLEANUP},
+                bundle_secret=blob_secret(digest))
+            LOGGER.debug(' | Removed blob {} from Rhizome.'.format(digest))
+        except DuplicateBundleException:
+            pass
+
+
+def fetch_chunk(rhizome, digest, bundle_id, out_file):
+    '''Write a chunk into an open file, it is only downloaded if it is not
+    in the local store.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        digest -- The SHA-256 of the chunk
+        bundle_id -- The bundle ID of the chunk
+        out_file -- The file opened for binary writing, positioned at the
+        offset of the chunk
+
+    Returns:
+        True, if the chunk was written, False if it is not available (yet)
+    '''
+
+    store = get_store()
+    if store.write_to(digest, out_file):
+        return True
+
+    tmp_path = store.temp_path()
+    try:
+        blob = transfer.get_bundle(rhizome, bundle_id)
+        transfer.download_payload(blob, tmp_path)
+    except (ManifestNotFoundError, PayloadNotFoundError,
+            RhizomeHTTPStatusError):
+        os.remove(tmp_path)
+        return False
+
+    # Never trust the content of a bundle.
+    if utilities.hash_file(tmp_path) != digest:
+        LOGGER.error(' | Blob {} (bid: {}) has a wrong hash.'.format(
+            digest, bundle_id))
+        os.remove(tmp_path)
+        return False
+
+    store.add(tmp_path, digest, move=True)
+    return store.write_to(digest, out_file)
+
+
+def fetch_file(rhizome, digest, chunk_size, chunks, path, deadline):
+    '''Reassemble a file from its chunks. Chunks are written as soon as they
+    are available, in any order. Missing chunks are polled until deadline,
+    a deadline in the past only tries every chunk once.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        digest -- The SHA-256 of the file
+        chunk_size -- Size of the chunks in bytes
+        chunks -- List of (digest, bundle ID) of all chunks
+        path -- Destination of the file
+        deadline -- Time until missing chunks are polled
+
+    Raises:
+        BlobNotFoundError -- If chunks are still missing after deadline or
+        the reassembled file is corrupt
+    '''
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    missing = list(enumerate(chunks))
+    with open(path, 'wb') as out_file:
+        while True:
+            still_missing = []
+            for index, (chunk_digest, bundle_id) in missing:
+                out_file.seek(index * chunk_size)
+                if not fetch_chunk(rhizome, chunk_digest, bundle_id,
+                                   out_file):
+                    still_missing.append((index, (chunk_digest, bundle_id)))
+            missing = still_missing
+
+            if not missing:
+                break
+            if time.time() >= deadline:
+                raise BlobNotFoundError(
+                    digest, missing[0][1][1], len(missing),
+                    bundle_ids=[chunk[1] for _, chunk in missing])
+
+            LOGGER.debug(' | Waiting for {} of {} chunks of {}.'.format(
+                len(missing), len(chunks), digest))
+            time.sleep(1)
+
+    if utilities.hash_file(path) != digest:
+        LOGGER.error(' | Reassembled blob {} has a wrong hash.'.format(digest))
+        raise BlobNotFoundError(digest, None, 0)
+
+
+def make_zip(rhizome,
+             to_zip,
+             name='tmp_container',
+             subpath_to_remove='',
+             owner=None):
+    '''Same as utilities.make_zip, but files of at least 'blob_min_size'
+    bytes are published as chunked blobs and only referenced in the ZIP
+    file.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        to_zip -- List of files or directory to be ZIP'd
+
+    Keyword Arguments:
+        name -- Name of the resulting ZIP file (default: {'tmp_container'})
+        subpath_to_remove -- Remove subpaths (default: {''})
+        owner -- ID of the call the blobs are published for, see
+        release_blobs (default: {None})
+
+    Returns:
+        Name of the resulting ZIP file
+    '''
+
+    min_size = blob_min_size()
+    if min_size is None:
+        return utilities.make_zip(
+            to_zip, name=name, subpath_to_remove=subpath_to_remove)
+
+    chunk_size = int(CONFIGURATION.get('blob_chunk_size', 1024 * 1024))
+
+    if isinstance(to_zip, str):
+        to_zip = [
+            os.path.join(root, f) for root, dirs, files in os.walk(to_zip)
+            for f in files
+        ]
+
+    blob_lines = []
+    with zipfile.ZipFile(name + '.zip', 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for arg in to_zip:
+            arcname = arg.replace(subpath_to_remove, '')
+            if os.path.getsize(arg) < min_size:
+                utilities.write_to_zip(zipf, arg, arcname)
+                continue
+
+            digest, chunks = publish_file(rhizome, arg, chunk_size, owner)
+            # Use the same normalized name, zipfile would use.
+            arcname = zipfile.ZipInfo.from_file(arg, arcname).filename
+            blob_lines.append('{} {} {} {}\n'.format(
+                digest, chunk_size,
+                ','.join('{}:{}'.format(*chunk) for chunk in chunks) or '-',
+                arcname))
+
+        if blob_lines:
+            zipf.writestr(BLOB_MANIFEST, ''.join(blob_lines))
+
+    return name + '.zip'
+
+
+def parse_blob_manifest(text):
+    '''Parse a blob manifest
+
+    Arguments:
+        text -- Content of the manifest
+
+    Returns:
+        List of (path, digest, chunk size, list of (digest, bundle ID))
+    '''
+
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        digest, chunk_size, chunk_list, path = line.split(' ', 3)
+        chunks = []
+        if chunk_list != '-':
+            chunks = [
+                tuple(chunk.split(':', 1)) for chunk in chunk_list.split(',')
+            ]
+        entries.append((path, digest, int(chunk_size), chunks))
+    return entries
+
+
+def _safe_path(extract_path, path):
+    '''Join a path from a manifest to extract_path, like zipfile does, paths
+    leaving extract_path are not allowed.
+
+    Arguments:
+        extract_path -- The destination directory
+        path -- The relative path
+
+    Returns:
+        The joined path
+    '''
+
+    parts = [
+        part for part in path.split('/') if part not in ('', '.', '..')
+    ]
+    return os.path.join(extract_path, *parts)
+
+
+def _deadline(timeout):
+    '''Compute the deadline for missing blobs
+
+    Arguments:
+        timeout -- Seconds to wait, 'blob_timeout' from the configuration if
+        None
+
+    Returns:
+        The deadline as timestamp
+    '''
+
+    if timeout is None:
+        timeout = float(CONFIGURATION.get('blob_timeout', 60))
+    return time.time() + timeout
+
+
+def extract_zip(rhizome, path, extract_path, timeout=None):
+    '''Same as utilities.extract_zip, but all blobs referenced in the ZIP
+    file are reassembled in extract_path as well. Chunks travel in their own
+    bundles and may arrive later than the ZIP file, so the call is only
+    extracted completely, when all chunks are present.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        path -- Path of the ZIP file
+        extract_path -- Path of the destination
+
+    Keyword Arguments:
+        timeout -- Seconds to wait for missing chunks, 'blob_timeout' from
+        the configuration if None, 0 to not wait at all (default: {None})
+
+    Returns:
+        A list of filenames containing all extracted files
+
+    Raises:
+        BlobNotFoundError -- If a chunk is still missing after timeout, it
+        names the missing chunks of all blobs
+    '''
+
+    member_list = utilities.extract_zip(path, extract_path)
+
+    manifest_path = extract_path + BLOB_MANIFEST
+    if manifest_path not in member_list:
+        return member_list
+
+    with open(manifest_path, 'r') as manifest_file:
+        entries = parse_blob_manifest(manifest_file.read())
+    os.remove(manifest_path)
+    member_list.remove(manifest_path)
+
+    deadline = _deadline(timeout)
+    errors = []
+    for blob_path, digest, chunk_size, chunks in entries:
+        destination = _safe_path(extract_path, blob_path)
+        try:
+            fetch_file(rhizome, digest, chunk_size, chunks, destination,
+                       deadline)
+        except BlobNotFoundError as e:
+            errors.append(e)
+            continue
+        member_list.append(destination)
+
+    # Fetch the available chunks of all blobs, before giving up.
+    if errors:
+        raise BlobNotFoundError(
+            errors[0].digest, errors[0].bundle_id,
+            sum(e.missing for e in errors),
+            bundle_ids=[bid for e in errors for bid in e.bundle_ids])
+
+    return member_list
+
+
+def complete_zip(rhizome, path, timeout=None):
+    '''Add all blobs referenced in a ZIP file to the ZIP file itself, so
+    that it can be used without blob support.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        path -- Path of the ZIP file
+
+    Keyword Arguments:
+        timeout -- Seconds to wait for missing chunks, 'blob_timeout' from
+        the configuration if None (default: {None})
+
+    Raises:
+        BlobNotFoundError -- If a chunk is still missing after timeout
+    '''
+
+    with zipfile.ZipFile(path, 'r') as zipf:
+        if BLOB_MANIFEST not in zipf.namelist():
+            return
+        entries = parse_blob_manifest(
+            zipf.read(BLOB_MANIFEST).decode('utf-8'))
+
+    deadline = _deadline(timeout)
+    tmp_path = get_store().temp_path()
+    try:
+        with zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED) as zipf:
+            for blob_path, digest, chunk_size, chunks in entries:
+                fetch_file(rhizome, digest, chunk_size, chunks, tmp_path,
+                           deadline)
+                zipf.write(tmp_path, blob_path)
+    finally:
+        os.remove(tmp_path)
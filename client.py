@@ -9,43 +9,138 @@ import os
 import time
 import math
 import sys
+import glob
 import hashlib
+import threading
+import contextlib
 
-from pyserval.client import Client
 from pyserval.exceptions import DecryptionError
-from pyserval.exceptions import InvalidTokenError, RhizomeHTTPStatusError
-from requests.exceptions import ConnectionError
-from json.decoder import JSONDecodeError
+from pyserval.exceptions import RhizomeHTTPStatusError
+from pyserval.exceptions import ManifestNotFoundError
 
 import utilities
+import transfer
+import blobs
+import planner
 from utilities import LOGGER
-from utilities import CALL, ACK, RESULT, ERROR, CLEANUP, RPC
+from utilities import CALL, ACK, RESULT, ERROR, CLEANUP, RPC, OFFER
 from utilities import CONFIGURATION
 from job import Job
+from watcher import BundleWatcher
 
+# Interval in seconds, in which the daemon looks for new job files.
+SPOOL_INTERVAL = 1.0
 
-def client_call(job_file_path):
-    '''Client main call function. Calls a remote procedure found in
-    job_file_path.
+
+def complete_result_zip(rhizome, result_path, job_id):
+    '''Add all blobs referenced in a received ZIP file to it, so that the
+    result is usable on its own.
 
     Arguments:
-        job_file_path {str} -- Path to the job file
+        rhizome -- Pyserval Rhizome connection
+        result_path -- Path of the received ZIP file
+        job_id -- The ID of the job
     '''
 
-    # Create a RESTful serval_client to Serval with the parameters from
-    # the config file and get the Rhizome serval_client.
-    SERVAL = Client(
-            host=CONFIGURATION['host'],
-            port=int(CONFIGURATION['port']),
-            user=CONFIGURATION['user'],
-            passwd=CONFIGURATION['passwd']
-        )
-    rhizome = SERVAL.rhizome
-    client_default_sid = SERVAL.keyring.default_identity().sid
+    try:
+        blobs.complete_zip(rhizome, result_path)
+    except blobs.BlobNotFoundError as e:
+        LOGGER.error('{} | Result is incomplete: {}'.format(job_id, e))
 
-    LOGGER.info(
-        ' | Client SID: {}, job file: {}'
-        .format(client_default_sid, job_file_path))
+
+def observe_latency(rhizome, bundle):
+    '''Pass a bundle sent by a server with pending calls to the latency
+    model. Only then the manifest is downloaded.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        bundle -- A RPC bundle from newsince
+    '''
+
+    if not utilities.LATENCY.waiting_for(bundle.manifest.sender):
+        return
+
+    try:
+        manifest = transfer.get_bundle(rhizome, bundle.bundle_id).manifest
+    except (ManifestNotFoundError, RhizomeHTTPStatusError):
+        return
+    utilities.LATENCY.observe(manifest)
+
+
+def cleanup_calls(rhizome, call_bundles, job_id=None):
+    '''Set the CLEANUP flag of all call bundles and remove their payloads
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        call_bundles -- The call bundles
+
+    Keyword Arguments:
+        job_id -- The ID of the job, whose blobs are released as well
+        (default: {None})
+    '''
+
+    for call_bundle in call_bundles:
+        call_bundle = transfer.get_bundle(rhizome, call_bundle.bundle_id)
+        call_bundle.manifest.type = CLEANUP
+        call_bundle.payload = ''
+        call_bundle.update()
+
+    if job_id is not None:
+        blobs.release_blobs(rhizome, job_id)
+
+
+class Workflow():
+    '''A submitted job file, which waits for its results
+    '''
+
+    def __init__(self, job_id, job_file_path, jobs, base_path):
+        '''Init the workflow
+
+        Arguments:
+            job_id -- The ID of the job, the rpcid of all its bundles
+            job_file_path -- Path to the job file
+            jobs -- The parsed job file
+            base_path -- Prefix of the paths of the ZIP files
+        '''
+
+        self.job_id = job_id
+        self.job_file_path = job_file_path
+        self.base_path = base_path
+        self.call_bundles = []
+        self.started = time.time()
+
+        # Every job without following jobs returns a result.
+        self.sink_jobs = {job.line: job for job in jobs.sinks()}
+        self.pending_steps = set(self.sink_jobs)
+
+        # The ZIP file of the call, the received ZIP files and if the
+        # workflow failed.
+        self.call_zip = None
+        self.results = []
+        self.failed = False
+
+
+def submit_workflow(rhizome, client_default_sid, job_file_path, workflows,
+                    base_path=None, lock=None):
+    '''Call the first procedures of a job file. The workflow is added to
+    workflows before the calls are sent. If sending a call fails, the
+    workflow is removed again and its calls and blobs are cleaned up.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        client_default_sid -- SID of the client
+        job_file_path -- Path to the job file
+        workflows -- Dict of pending workflows keyed by their job ID
+
+    Keyword Arguments:
+        base_path -- Prefix of the paths of the ZIP files, the job ID if
+        None (default: {None})
+        lock -- Lock held while the workflow is added and called, so that
+        answers are handled after all calls are known (default: {None})
+
+    Returns:
+        The Workflow or None, if the workflow could not be called
+    '''
 
     # Parse the job file and store all jobs in jobs.
     jobs = utilities.parse_jobfile(job_file_path)
@@ -53,15 +148,16 @@ def client_call(job_file_path):
         LOGGER.critical(
             ' | Job file {} does not contain jobs. Aborting.'
             .format(job_file_path))
-        return
+        return None
 
     # This is the first job to be called. We remember it here for
     # further processing.
     first_job = jobs.joblist[0]
 
-    hash_base_string = '{}{}{:.9f}'.format(first_job.procedure,
-                                           client_default_sid,
-                                           time.time())
+    hash_base_string = '{}{}{}{:.9f}'.format(first_job.procedure,
+                                             client_default_sid,
+                                             job_file_path,
+                                             time.time())
     encoded_hash_base_string = hash_base_string.encode('utf-8')
 
     job_id = hashlib.sha256(encoded_hash_base_string).hexdigest()[:8]
@@ -70,183 +166,449 @@ def client_call(job_file_path):
         '{} | -Runtime- Job file parsed. First Job is {} with ID {}.'
         .format(job_id, first_job.procedure, job_id))
 
+    # Scattered jobs are expanded into one job per input first.
+    input_files, reason = utilities.expand_scatter(
+        rhizome, client_default_sid, job_file_path, jobs, job_id)
+    if reason:
+        return None
+    if any(job.scatter for job in jobs.joblist):
+        jobs = utilities.parse_jobfile(job_file_path)
+
+    # If planning is enabled, the servers of all jobs are chosen now.
+    if CONFIGURATION.get('planning') == 'true':
+        reason = planner.plan_workflow(rhizome, client_default_sid,
+                                       client_default_sid, job_file_path,
+                                       jobs, job_id)
+        if reason:
+            return None
+        jobs = utilities.parse_jobfile(job_file_path)
+
+    # The jobs without dependencies are called first. Jobs joining several
+    # branches of a workflow have to run on the same server for all
+    # branches, so their server is chosen here as well.
+    root_jobs = jobs.roots()
+    join_jobs = [job for job in jobs.joblist if len(jobs.dependencies(job)) > 1]
+
     # If the server address is 'any', we have to find a server, which
     # offers this procedure.
-    if first_job.server == 'any':
+    for job in root_jobs + join_jobs:
+        if job.server != 'any':
+            continue
+
         LOGGER.info(
-                '{} | The address is any, searching for server.'
-                .format(job_id))
+                '{} | The address of {} is any, searching for server.'
+                .format(job_id, job.procedure))
 
         reason = utilities.lookup_server(rhizome, client_default_sid,
-                                         client_default_sid, first_job, job_id,
+                                         client_default_sid, job, job_id,
                                          job_file_path)
 
         if reason:
-            return
+            return None
 
     # All involved files in a call should be uniquely named.
     # Thus, we use the job id, which is a hash of
     # procedure name, the server SID and a timestamp.
-    zip_file_base_path = job_id
+    zip_file_base_path = job_id if base_path is None else base_path
 
     # Iterate through all arguments and check if it is file.
     # If so, add it to the file list to be ZIP'd.
-    zip_list = []
-    for arg in first_job.arguments:
-        if not os.path.isfile(arg):
-            continue
-        zip_list.append(arg)
+    zip_list = list(input_files)
+    for job in root_jobs:
+        for arg in job.arguments:
+            if not os.path.isfile(arg) or arg in zip_list:
+                continue
+            zip_list.append(arg)
     # Of course, we have to add the job file to the file list.
     # For sanity reasons we also strip away all whitespace characters.
     zip_list.append(job_file_path)
     zip_list = list(map(str.strip, zip_list))
 
     # Now we can crate the ZIP file...
-    zip_file = utilities.make_zip(zip_list, zip_file_base_path + '_call')
+    zip_file = blobs.make_zip(rhizome, zip_list,
+                              zip_file_base_path + '_call', owner=job_id)
 
     LOGGER.info('{} | Prepared ZIP file {} for call.'.format(job_id, zip_file))
 
-    # ... open it ...
-    payload = open(zip_file, 'rb')
-    # ... and create a new Rhizome bundle containing all relevant information
-    # for the call.
-    call_bundle = rhizome.new_bundle(
-        name=first_job.procedure,
-        payload=payload.read(),
-        service=RPC,
-        recipient=first_job.server,
-        custom_manifest={
-            'type': CALL,
-            'originator': client_default_sid,
-            'rpcid': job_id
-        })
-    payload.close()
-    LOGGER.info('{} | -Transmission- Procedure {} is called: bid is {}'.format(
-        job_id, first_job.procedure, call_bundle.bundle_id))
-
-    # Now we wait for the result.
+    # The workflow is known before the first call is sent, so that no
+    # answer is missed.
+    workflow = Workflow(job_id, job_file_path, jobs, zip_file_base_path)
+    workflow.call_zip = zip_file
+
+    with lock or contextlib.nullcontext():
+        workflows[job_id] = workflow
+
+        # ... and create a new Rhizome bundle containing all relevant
+        # information for every call. The ZIP file is streamed, not read
+        # into memory.
+        try:
+            for job in root_jobs:
+                call_bundle = transfer.insert_bundle(
+                    rhizome,
+                    client_default_sid,
+                    payload_path=zip_file,
+                    name=job.procedure,
+                    service=RPC,
+                    recipient=job.server,
+                    custom_manifest={
+                        'type': CALL,
+                        'originator': client_default_sid,
+                        'rpcid': job_id,
+                        'step': job.line
+                    })
+                workflow.call_bundles.append(call_bundle)
+                utilities.LATENCY.sent(job.server, job.procedure, job_id)
+                LOGGER.info(
+                    '{} | -Transmission- Procedure {} is called: bid is {}'
+                    .format(job_id, job.procedure, call_bundle.bundle_id))
+        except Exception:
+            workflows.pop(job_id, None)
+            try:
+                cleanup_calls(rhizome, workflow.call_bundles, job_id)
+            except Exception:
+                LOGGER.exception(
+                    '{} | Cleaning up the calls failed.'.format(job_id))
+            raise
+
+    return workflow
+
+
+def client_handle_bundle(rhizome, client_default_sid, bundle, workflows):
+    '''Handle a bundle from newsince. Answers are passed to the pending
+    workflow with their rpcid and results are written as they arrive.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        client_default_sid -- SID of the client
+        bundle -- The bundle from the newsince list
+        workflows -- Dict of pending workflows keyed by their job ID
+
+    Returns:
+        The Workflow, if it finished with this bundle, None otherwise
+    '''
+
+    # Keep the server registry up to date with new offers.
+    if bundle.manifest.service == OFFER:
+        utilities.REGISTRY.update(rhizome, bundle)
+        return None
+
+    # Don't bother, if it is not a RPC bundle.
+    if not bundle.manifest.service == RPC:
+        return None
+
+    # Ignore bundles not sended to me, except they tell that a
+    # server we called completed the call.
+    if not bundle.manifest.recipient == client_default_sid:
+        observe_latency(rhizome, bundle)
+        return None
+
+    # Before further checks, we have to download the manifest
+    # to have all metadata available. The payload is only
+    # downloaded, if it is our result.
+    try:
+        potential_result = transfer.get_bundle(rhizome, bundle.bundle_id)
+    except DecryptionError:
+        return None
+    utilities.LATENCY.observe(potential_result.manifest)
+
+    workflow = workflows.get(getattr(potential_result.manifest, 'rpcid',
+                                     None))
+    if workflow is None:
+        return None
+    job_id = workflow.job_id
+
+    # Yay, ACK received.
+    if potential_result.manifest.type == ACK:
+        LOGGER.info('{} | Received ACK from {}'.format(
+            potential_result.manifest.rpcid,
+            potential_result.manifest.sender))
+
+    # Here we have a result.
+    if potential_result.manifest.type == RESULT:
+        # Results of older servers do not name the step, they are
+        # always the final result.
+        step = getattr(potential_result.manifest, 'step', None)
+        step = int(step) if step is not None else None
+        if step is not None and step not in workflow.pending_steps:
+            return None
+
+        LOGGER.info(
+            '{} | -Runtime- Received result.'.format(
+                potential_result.manifest.rpcid))
+        # Use the same filename as for the call, except
+        # we append result instead of call to the name. If there
+        # are several results, the step is part of the name.
+        result_path = workflow.base_path + '_result.zip'
+        if len(workflow.sink_jobs) > 1 and step is not None:
+            result_path = '{}_{}_result.zip'.format(
+                workflow.base_path, workflow.sink_jobs[step].name or step)
+
+        # Download the payload from the Rhizome store and
+        # write it to the mentioned ZIP file
+        transfer.download_payload(potential_result, result_path)
+        complete_result_zip(rhizome, result_path, job_id)
+        workflow.results.append(result_path)
+        LOGGER.info(
+            '{} | Download is done: {}'.format(job_id, result_path))
+
+        if step is None:
+            workflow.pending_steps.clear()
+        else:
+            workflow.pending_steps.discard(step)
+        if workflow.pending_steps:
+            return None
+
+        # The final step is to cleanup the store by updating
+        # the call bundles by setting the CLEANUP flag to the
+        # bundles and removing the payload.
+        LOGGER.info('{} | Cleaning up store.'.format(job_id))
+        cleanup_calls(rhizome, workflow.call_bundles, workflow.job_id)
+        workflows.pop(job_id, None)
+
+        LOGGER.info(
+            '{} | -End- Finished RPC, result: {}'
+            .format(job_id, result_path))
+        return workflow
+
+    # One of the servers had an error, so see what is going on.
+    if potential_result.manifest.type == ERROR:
+        result_path = workflow.base_path + '_error.zip'
+
+        # Download the payload from the Rhizome store and
+        # write it to the mentioned ZIP file
+        transfer.download_payload(potential_result, result_path)
+        complete_result_zip(rhizome, result_path, job_id)
+        workflow.results.append(result_path)
+        workflow.failed = True
+        LOGGER.info(
+            '{} | Download is done. Cleaning up store.'.format(job_id))
+
+        cleanup_calls(rhizome, workflow.call_bundles, workflow.job_id)
+        workflows.pop(job_id, None)
+
+        LOGGER.warn(
+            u'{} | -End- Received error \'{}\' for job {}.'
+            .format(
+                job_id,
+                getattr(potential_result.manifest, 'reason', None),
+                potential_result.manifest.name))
+        return workflow
+
+    return None
+
+
+def expire_workflows(rhizome, workflows, timeout):
+    '''Give up workflows waiting for their results for too long. Their
+    calls are cleaned up.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        workflows -- Dict of pending workflows keyed by their job ID
+        timeout -- Seconds after which a workflow is given up
+
+    Returns:
+        List of the expired workflows
+    '''
+
+    now = time.time()
+    expired = [
+        workflow for workflow in list(workflows.values())
+        if now - workflow.started > timeout
+    ]
+
+    for workflow in expired:
+        LOGGER.warn('{} | -End- No result within {}s, giving up.'.format(
+            workflow.job_id, timeout))
+        cleanup_calls(rhizome, workflow.call_bundles, workflow.job_id)
+        workflows.pop(workflow.job_id, None)
+        workflow.failed = True
+
+    return expired
+
+
+def client_call(job_file_path):
+    '''Client main call function. Calls a remote procedure found in
+    job_file_path.
+
+    Arguments:
+        job_file_path {str} -- Path to the job file
+    '''
+
+    # Get the RESTful serval_client to Serval with the parameters from
+    # the config file and get the Rhizome serval_client.
+    SERVAL = utilities.serval_client()
+    rhizome = SERVAL.rhizome
+    client_default_sid = SERVAL.keyring.default_identity().sid
+
+    LOGGER.info(
+        ' | Client SID: {}, job file: {}'
+        .format(client_default_sid, job_file_path))
+
+    workflows = {}
+    if submit_workflow(rhizome, client_default_sid, job_file_path,
+                       workflows) is None:
+        return
+
+    # Now we wait for the result. The watcher passes the bundles in token
+    # order, as soon as they arrive.
     all_bundles = rhizome.get_bundlelist()
     token = all_bundles[0].token
+    timeout = float(CONFIGURATION.get('workflow_timeout', 0))
 
-    while True:
-        try:
-            bundles = rhizome.get_bundlelist_newsince(token)
+    lock = threading.Lock()
+    finished = threading.Event()
 
-        except ConnectionError:
-            LOGGER.warn(
-                " | ConnectionError while calling newsince, continuing...")
-            time.sleep(1)
-            continue
+    def handle_bundle(bundle):
+        with lock:
+            if finished.is_set():
+                return
+            if client_handle_bundle(rhizome, client_default_sid, bundle,
+                                    workflows):
+                finished.set()
 
-        except RhizomeHTTPStatusError as e:
-            LOGGER.warn(
-                " | RhizomeHTTPStatusError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
+    watcher = BundleWatcher(rhizome, token)
+    watcher.subscribe(handle_bundle)
+    threading.Thread(target=watcher.run, daemon=True).start()
 
-        except InvalidTokenError as e:
-            LOGGER.warn(
-                " | InvalidTokenError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
+    # An idle store yields no bundles, so the deadline is not checked by
+    # the watcher, but by waiting for the result.
+    if not finished.wait(timeout or None):
+        with lock:
+            if not finished.is_set():
+                expire_workflows(rhizome, workflows, timeout)
+                finished.set()
+    watcher.stop()
 
-        except KeyError as e:
-            LOGGER.warn(
-                " | KeyError while calling newsince, hint: {}, continuing...".
-                format(e))
-            time.sleep(1)
-            continue
+    utilities.LATENCY.save(force=True)
+    utilities.serval_session().log_stats()
 
-        except JSONDecodeError as e:
-            LOGGER.warn(
-                " | JSONDecodeError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
 
-        if len(bundles) == 0:
-            time.sleep(1)
-            continue
+def retire_workflow(spool_path, workflow):
+    '''Move the job file of a finished workflow from the running to the
+    done or failed directory of the spool and remove the call ZIP file
+
+    Arguments:
+        spool_path -- The spool directory
+        workflow -- The finished workflow
+    '''
 
-        bundle = bundles[0]
-        token = bundle.token
+    state = 'failed' if workflow.failed else 'done'
+    os.replace(workflow.job_file_path,
+               os.path.join(spool_path, state,
+                            os.path.basename(workflow.job_file_path)))
+    if workflow.call_zip and os.path.isfile(workflow.call_zip):
+        os.remove(workflow.call_zip)
 
-        # Don't bother, if it is not a RPC bundle.
-        if not bundle.manifest.service == RPC:
-            continue
 
-        # Ignore bundles not sended to me
-        if not bundle.manifest.recipient == client_default_sid:
-            continue
+def client_spool(rhizome, client_default_sid, spool_path, workflows, lock):
+    '''Call all job files put into the spool directory and give up
+    workflows without result within 'workflow_timeout', runs forever
 
-        # Before further checks, we have to download the manifest
-        # to have all metadata available.
-        try:
-            potential_result = rhizome.get_bundle(bundle.bundle_id)
-        except DecryptionError:
-            continue
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        client_default_sid -- SID of the client
+        spool_path -- The spool directory
+        workflows -- Dict of pending workflows keyed by their job ID
+        lock -- Lock for adding and finishing workflows
+    '''
 
-        # Yay, ACK received.
-        if (potential_result.manifest.type == ACK and
-                potential_result.manifest.rpcid == job_id):
-            LOGGER.info('{} | Received ACK from {}'.format(
-                potential_result.manifest.rpcid,
-                potential_result.manifest.sender))
-
-        # Here we have the result.
-        if (potential_result.manifest.type == RESULT and
-                potential_result.manifest.rpcid == job_id):
-            LOGGER.info(
-                '{} | -Runtime- Received result.'.format(
-                    potential_result.manifest.rpcid))
-            # Use the same filename as for the call, except
-            # we append result instead of call to the name.
-            result_path = zip_file_base_path + '_result.zip'
-
-            # Download the payload from the Rhizome store and
-            # write it to the mentioned ZIP file
-            with open(result_path, 'wb') as zip_file:
-                zip_file.write(potential_result.payload)
-            LOGGER.info(
-                '{} | Download is done. Cleaning up store.'.format(job_id))
-
-            # The final step is to cleanup the store by updating
-            # the call bundle by setting the CLEANUP flag to the
-            # bundle and removing the payload.
-            call_bundle.refresh()
-            call_bundle.manifest.type = CLEANUP
-            call_bundle.payload = ''
-            call_bundle.update()
-
-            LOGGER.info(
-                '{} | -End- Finished RPC, result: {}'
-                .format(job_id, result_path))
-            break
-
-        # One of the servers had an error, so see what is going on.
-        if (potential_result.manifest.type == ERROR
-                and potential_result.manifest.rpcid == job_id):
-
-            result_path = zip_file_base_path + '_error.zip'
-
-            # Download the payload from the Rhizome store and
-            # write it to the mentioned ZIP file
-            with open(result_path, 'wb') as zip_file:
-                zip_file.write(potential_result.payload)
-            LOGGER.info(
-                '{} | Download is done. Cleaning up store.'.format(job_id))
-
-            call_bundle.refresh()
-            call_bundle.manifest.type = CLEANUP
-            call_bundle.payload = ''
-            call_bundle.update()
-
-            LOGGER.warn(
-                u'{} | -End- Received error \'{}\' for job {}.'
-                .format(
-                    job_id,
-                    potential_result.manifest.reason,
-                    potential_result.manifest.name))
-            break
+    timeout = float(CONFIGURATION.get('workflow_timeout', 0))
+
+    while True:
+        # Job files are called in the order they were put into the spool.
+        for path in sorted(glob.glob(os.path.join(spool_path, '*.jb')),
+                           key=os.path.getmtime):
+            name = os.path.basename(path)
+            running_path = os.path.join(spool_path, 'running', name)
+            os.replace(path, running_path)
+
+            try:
+                workflow = submit_workflow(
+                    rhizome, client_default_sid, running_path, workflows,
+                    base_path=os.path.join(spool_path, 'results', name[:-3]),
+                    lock=lock)
+            except Exception:
+                LOGGER.exception(' | Calling {} failed.'.format(name))
+                workflow = None
+
+            if workflow is None:
+                os.replace(running_path,
+                           os.path.join(spool_path, 'failed', name))
+                continue
+
+            LOGGER.info(' | Called {} as {}, {} workflows pending.'.format(
+                name, workflow.job_id, len(workflows)))
+
+        if timeout:
+            with lock:
+                for workflow in expire_workflows(rhizome, workflows,
+                                                 timeout):
+                    retire_workflow(spool_path, workflow)
+
+        # Calls without answer count as failed.
+        utilities.LATENCY.expire()
+
+        time.sleep(SPOOL_INTERVAL)
+
+
+def client_daemon(spool_path):
+    '''Client daemon, calls all job files put into the spool directory.
+    A single watcher passes the answers of all pending workflows to them
+    by their rpcid.
+
+    The spool directory contains:
+        *.jb -- Job files to be called, should be moved there atomically
+        running/ -- Job files of the pending workflows
+        results/ -- The received result and error ZIP files, named after
+        the job files
+        done/, failed/ -- Job files of the finished workflows
+
+    Arguments:
+        spool_path {str} -- Path to the spool directory
+    '''
+
+    SERVAL = utilities.serval_client()
+    rhizome = SERVAL.rhizome
+    client_default_sid = SERVAL.keyring.default_identity().sid
+
+    LOGGER.info(
+        ' | Client SID: {}, spool directory: {}'
+        .format(client_default_sid, spool_path))
+
+    for directory in ('running', 'results', 'done', 'failed'):
+        os.makedirs(os.path.join(spool_path, directory), exist_ok=True)
+
+    # The answers of workflows interrupted by a restart are lost.
+    for path in glob.glob(os.path.join(spool_path, 'running', '*.jb')):
+        LOGGER.warn(' | Workflow {} was interrupted.'.format(path))
+        os.replace(path, os.path.join(spool_path, 'failed',
+                                      os.path.basename(path)))
+
+    # The watcher starts before the first call, so that no answer is
+    # missed. The registry is filled once, afterwards it is updated by the
+    # watcher.
+    all_bundles = rhizome.get_bundlelist()
+    token = all_bundles[0].token
+    utilities.REGISTRY.load(rhizome, all_bundles)
+
+    workflows = {}
+    lock = threading.Lock()
+
+    def handle_bundle(bundle):
+        with lock:
+            workflow = client_handle_bundle(rhizome, client_default_sid,
+                                            bundle, workflows)
+            if workflow is not None:
+                retire_workflow(spool_path, workflow)
+
+    threading.Thread(
+        target=client_spool,
+        args=(rhizome, client_default_sid, spool_path, workflows, lock),
+        daemon=True).start()
+
+    watcher = BundleWatcher(rhizome, token)
+    watcher.subscribe(handle_bundle)
+    try:
+        watcher.run()
+    finally:
+        utilities.LATENCY.save(force=True)
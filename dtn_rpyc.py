@@ -12,6 +12,7 @@ import argparse
 
 import utilities
 import server
+import aserver
 import client
 
 
@@ -54,6 +55,14 @@ class DTNRPyC(object):
             default='',
             help='Call a procedure(s) specified in the job file given..')
 
+        group.add_argument(
+            '-d',
+            '--daemon',
+            type=str,
+            dest='spool_path',
+            default='',
+            help='Call all job files put into the given spool directory.')
+
         group.add_argument(
             '-s',
             '--server',
@@ -69,6 +78,15 @@ class DTNRPyC(object):
             'of parallel.'
         )
 
+        parser.add_argument(
+            '-a',
+            '--async',
+            action='store_true',
+            dest='asynchronous',
+            help='Run the server on an asyncio event loop instead of one ' \
+            'thread per call.'
+        )
+
         args = parser.parse_args()
 
         # Before starting, check, if the config file can be parsed
@@ -76,7 +94,10 @@ class DTNRPyC(object):
         if args.server:
             utilities.add_logfile("worker.log")
             utilities.pre_exec_checks(args.config_path, server_checks=True)
-            server.server_listen(args.queue)
+            if args.asynchronous:
+                aserver.server_listen_async(args.queue)
+            else:
+                server.server_listen(args.queue)
             
         elif args.job_file_path:
             utilities.add_logfile("client.log")
@@ -84,6 +105,11 @@ class DTNRPyC(object):
                 args.config_path, client_jobfle=args.job_file_path)
             client.client_call(args.job_file_path)
 
+        elif args.spool_path:
+            utilities.add_logfile("client.log")
+            utilities.pre_exec_checks(args.config_path)
+            client.client_daemon(args.spool_path)
+
 
 def signal_handler(_, __):
     '''Simple CTRL-C signal handler. Since we do not have any global
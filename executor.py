@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A bounded pool of worker threads for handling calls
+'''
+
+import queue
+import threading
+
+from utilities import LOGGER
+
+
+class CallExecutor():
+    '''Runs calls on a fixed number of worker threads. Calls which can not
+    be started immediately wait in a bounded queue, if the queue is full,
+    new calls are refused.
+    '''
+
+    def __init__(self, handler, workers=4, queue_size=16):
+        '''Init the executor and start the worker threads
+
+        Arguments:
+            handler -- Function to be called for every submitted call
+
+        Keyword Arguments:
+            workers -- Number of worker threads (default: {4})
+            queue_size -- Number of calls waiting for a worker (default: {16})
+        '''
+
+        self.handler = handler
+        self.workers = workers
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.running = True
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, name='worker-{}'.format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        '''Main loop of a worker thread
+        '''
+
+        while True:
+            item = self.pending.get()
+
+            # None tells the worker to stop.
+            if item is None:
+                return
+
+            handler, call = item
+            with self.lock:
+                self.busy = self.busy + 1
+            try:
+                handler(call)
+            except Exception:
+                LOGGER.exception(' | Handling call failed.')
+            finally:
+                with self.lock:
+                    self.busy = self.busy - 1
+
+    def submit(self, call, handler=None):
+        '''Queue a call for execution
+
+        Arguments:
+            call -- The call to be handled
+
+        Keyword Arguments:
+            handler -- Function handling this call instead of the handler of
+            the executor (default: {None})
+
+        Returns:
+            True, if the call was queued, False if the queue is full or the
+            executor is shut down
+        '''
+
+        if not self.running:
+            return False
+
+        try:
+            self.pending.put_nowait((handler or self.handler, call))
+        except queue.Full:
+            return False
+        return True
+
+    def queue_depth(self):
+        '''Number of calls waiting for a worker
+
+        Returns:
+            The number of waiting calls
+        '''
+
+        return self.pending.qsize()
+
+    def running_calls(self):
+        '''Number of calls currently handled
+
+        Returns:
+            The number of busy workers
+        '''
+
+        return self.busy
+
+    def utilization(self):
+        '''Fraction of busy workers
+
+        Returns:
+            The utilization between 0 and 1
+        '''
+
+        return self.busy / float(self.workers)
+
+    def shutdown(self):
+        '''Stop accepting calls, drop all waiting calls and wait until the
+        running calls are finished
+        '''
+
+        self.running = False
+
+        # Drop everything which is not started yet...
+        dropped = 0
+        while True:
+            try:
+                self.pending.get_nowait()
+                dropped = dropped + 1
+            except queue.Empty:
+                break
+        if dropped:
+            LOGGER.warning(
+                ' | Dropped {} waiting calls on shutdown.'.format(dropped))
+
+        # ... and stop the workers after their current call.
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -23,6 +23,16 @@ class Jobfile:
         self.client_sid = client_sid
         self.joblist = []
         self.filter = filter
+        # If any job names its dependencies, the jobs form a DAG, otherwise
+        # every job depends on the previous one.
+        self.dag = False
+        # Indexes of the jobs by their position, line and name (the first
+        # job of a name wins, like in find).
+        self.positions = {}
+        self.lines = {}
+        self.names = {}
+        # Direct dependents of every job, built on first use.
+        self.dependents_index = None
 
     def add_filter(self, key, value):
         '''Add a filter to the global filters
@@ -34,7 +44,20 @@ class Jobfile:
 
         self.filter[key] = value
 
-    def add(self, server, procedure, args, status, counter, filter_dict={}):
+    def add(self,
+            server,
+            procedure,
+            args,
+            status,
+            counter,
+            filter_dict={},
+            carry=False,
+            name=None,
+            after=None,
+            scatter=None,
+            planned=False,
+            radius=None,
+            nearest=None):
         '''Add a Job to the joblist of the job file
 
         Arguments:
@@ -46,10 +69,146 @@ class Jobfile:
 
         Keyword Arguments:
             filter_dict -- Optional filters for this job (default: {{}})
+            carry -- If all files of the previous step are required
+            (default: {False})
+            name -- Name of the job (default: {None})
+            after -- Names of the jobs this job depends on (default: {None})
+            scatter -- Inputs the job is executed for, as glob or comma
+            separated list (default: {None})
+            planned -- If the server was assigned by the workflow planner
+            (default: {False})
+            radius -- Maximal distance of the server (default: {None})
+            nearest -- Number of nearest servers to choose from
+            (default: {None})
         '''
 
-        self.joblist.append(
-            Job(server, procedure, args, status, counter, filter_dict))
+        if after is not None:
+            self.dag = True
+
+        job = Job(server, procedure, args, status, counter, filter_dict,
+                  carry, name, after, scatter, planned, radius, nearest)
+        self.positions[job] = len(self.joblist)
+        self.lines.setdefault(counter, job)
+        if name is not None:
+            self.names.setdefault(name, job)
+        self.joblist.append(job)
+        self.dependents_index = None
+
+    def find(self, line=None, name=None):
+        '''Find a job by its line or its name
+
+        Keyword Arguments:
+            line -- Line of the job in the file (default: {None})
+            name -- Name of the job (default: {None})
+
+        Returns:
+            The job or None, if there is no such job
+        '''
+
+        if line is not None and line in self.lines:
+            return self.lines[line]
+        if name is not None:
+            return self.names.get(name)
+        return None
+
+    def dependencies(self, job):
+        '''Get all jobs, which have to be done before job
+
+        Arguments:
+            job -- The job
+
+        Returns:
+            List of jobs
+        '''
+
+        if not self.dag:
+            position = self.positions[job]
+            return self.joblist[position - 1:position] if position else []
+
+        return [
+            self.names[name] for name in job.after or []
+            if name in self.names
+        ]
+
+    def dependents(self, job):
+        '''Get all jobs, which directly depend on job
+
+        Arguments:
+            job -- The job
+
+        Returns:
+            List of jobs
+        '''
+
+        # All dependents are collected at once, so that this is not
+        # quadratic for every job.
+        if self.dependents_index is None:
+            self.dependents_index = {
+                indexed_job: []
+                for indexed_job in self.joblist
+            }
+            for dependent in self.joblist:
+                for dependency in self.dependencies(dependent):
+                    dependents = self.dependents_index[dependency]
+                    if not dependents or dependents[-1] is not dependent:
+                        dependents.append(dependent)
+
+        return list(self.dependents_index.get(job, []))
+
+    def is_ready(self, job):
+        '''Check if all dependencies of job are done
+
+        Arguments:
+            job -- The job
+
+        Returns:
+            True, if the job can be executed
+        '''
+
+        return all(dependency.status == Status.DONE
+                   for dependency in self.dependencies(job))
+
+    def roots(self):
+        '''Get all jobs without dependencies
+
+        Returns:
+            List of jobs
+        '''
+
+        return [job for job in self.joblist if not self.dependencies(job)]
+
+    def sinks(self):
+        '''Get all jobs, no other job depends on
+
+        Returns:
+            List of jobs
+        '''
+
+        return [job for job in self.joblist if not self.dependents(job)]
+
+    def ordered(self):
+        '''Get all jobs ordered, so that every job comes after its
+        dependencies
+
+        Returns:
+            List of jobs
+        '''
+
+        order = []
+        visited = set()
+
+        def visit(job):
+            if job in visited:
+                return
+            visited.add(job)
+            for dependency in self.dependencies(job):
+                visit(dependency)
+            order.append(job)
+
+        for job in self.joblist:
+            visit(job)
+
+        return order
 
 
 class Job:
@@ -62,7 +221,14 @@ class Job:
                  arguments=None,
                  status=None,
                  line=None,
-                 filter_dict={}):
+                 filter_dict={},
+                 carry=False,
+                 name=None,
+                 after=None,
+                 scatter=None,
+                 planned=False,
+                 radius=None,
+                 nearest=None):
         '''Init the job object
 
         Keyword Arguments:
@@ -72,6 +238,19 @@ class Job:
             status -- State of the job (e.g. DONE) (default: {None})
             line -- The line of the job in the file (default: {None})
             filter_dict -- Filters for this job (default: {{}})
+            carry -- If all files of the previous step are required
+            (default: {False})
+            name -- Name of the job, used to reference it in other jobs
+            (default: {None})
+            after -- Names of the jobs this job depends on, None if it
+            depends on the previous job (default: {None})
+            scatter -- Inputs the job is executed for, as glob or comma
+            separated list (default: {None})
+            planned -- If the server was assigned by the workflow planner
+            (default: {False})
+            radius -- Maximal distance of the server (default: {None})
+            nearest -- Number of nearest servers to choose from
+            (default: {None})
         '''
 
         self.server = server
@@ -79,12 +258,19 @@ class Job:
         self.arguments = list(map(lambda x: x.strip(), arguments))
         self.line = line
         self.filter_dict = filter_dict
+        self.carry = carry
+        self.name = name
+        self.after = after
+        self.scatter = scatter
+        self.planned = planned
+        self.radius = radius
+        self.nearest = nearest
         if status == 'OPEN':
             self.status = Status.OPEN
         elif status == 'DONE':
             self.status = Status.DONE
         else:
-            status = Status.ERROR
+            self.status = Status.ERROR
 
     def __str__(self):
         return '{} {}'.format(self.procedure, ' '.join(self.arguments))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Warm worker processes for persistent procedures.
+
+A persistent procedure is started once with the environment variable
+DTNRPC_PERSISTENT set. It reads the arguments of one call per line from
+stdin (separated by spaces) and answers every line with a single line
+'<CODE> <RESULT>' on stdout, where a code of 0 means success. Hence,
+arguments must not contain whitespace.
+'''
+
+import os
+import queue
+import subprocess
+import threading
+
+from utilities import LOGGER
+
+# Seconds a worker may take for one call, before it is killed.
+TIMEOUT = 600
+
+
+class PersistentProcedure():
+    '''A fixed number of long-lived worker processes of a procedure. Every
+    worker handles one call at a time, dead workers are restarted.
+    '''
+
+    def __init__(self, bin_path, workers=1, timeout=TIMEOUT):
+        '''Init the procedure and start the worker processes
+
+        Arguments:
+            bin_path -- Path to the executable of the procedure
+
+        Keyword Arguments:
+            workers -- Number of worker processes (default: {1})
+            timeout -- Seconds a worker may take for one call
+            (default: {TIMEOUT})
+        '''
+
+        self.bin_path = bin_path
+        self.workers = workers
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        self.processes = set()
+        self.lock = threading.Lock()
+
+        for _ in range(workers):
+            self.idle.put(self._spawn())
+
+    def _spawn(self):
+        '''Start a new worker process
+
+        Returns:
+            The worker process
+        '''
+
+        env = dict(os.environ)
+        env['DTNRPC_PERSISTENT'] = '1'
+
+        process = subprocess.Popen(
+            [self.bin_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env)
+
+        with self.lock:
+            self.processes.add(process)
+
+        LOGGER.debug(' | Started persistent worker {} for {}'.format(
+            process.pid, self.bin_path))
+        return process
+
+    def _kill(self, process):
+        '''Stop a worker process
+
+        Arguments:
+            process -- The worker process
+        '''
+
+        with self.lock:
+            self.processes.discard(process)
+
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+    def call(self, arguments):
+        '''Execute a call on one of the workers. Blocks until a worker is
+        available.
+
+        Arguments:
+            arguments -- The arguments of the call
+
+        Returns:
+            The return code of the procedure and the result
+        '''
+
+        # Whitespace would change the number of arguments or, in case of a
+        # newline, the number of calls the worker sees.
+        if any(not argument or argument.split() != [argument]
+               for argument in arguments):
+            return (1, b'Arguments of persistent procedures must not be '
+                    b'empty or contain whitespace.')
+
+        process = self.idle.get()
+
+        # The worker died while it was idle, so the call is not its fault.
+        if process.poll() is not None:
+            LOGGER.warning(' | Persistent worker {} for {} died, restarting.'
+                           .format(process.pid, self.bin_path))
+            self._kill(process)
+            process = self._spawn()
+
+        # A worker which does not answer in time is killed, which ends the
+        # readline below.
+        timer = threading.Timer(self.timeout, process.kill)
+        timer.start()
+        try:
+            process.stdin.write((' '.join(arguments) + '\n').encode('utf-8'))
+            process.stdin.flush()
+            answer = process.stdout.readline()
+
+            # An empty answer means, that the worker died.
+            if not answer:
+                raise BrokenPipeError()
+
+            code, _, result = answer.rstrip(b'\n').partition(b' ')
+            return (0 if int(code) == 0 else 1, result.rstrip())
+
+        except (OSError, ValueError):
+            reason = 'failed' if timer.is_alive() else 'timed out'
+            LOGGER.error(' | Persistent worker {} for {} {}, restarting.'
+                         .format(process.pid, self.bin_path, reason))
+            self._kill(process)
+            process = self._spawn()
+            return (1, 'Persistent worker {}.'.format(reason).encode('utf-8'))
+
+        finally:
+            timer.cancel()
+            self.idle.put(process)
+
+    def stop(self):
+        '''Stop all worker processes
+        '''
+
+        with self.lock:
+            processes = list(self.processes)
+
+        # Closing stdin asks the workers to exit, kill them if they do not.
+        for process in processes:
+            try:
+                process.stdin.close()
+                process.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+            self._kill(process)
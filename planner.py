@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Planning of whole workflows. Instead of choosing the server of every job
+on the previous hop, the servers of all jobs are chosen at once, so that the
+expected makespan of the workflow is as short as possible.
+'''
+
+import os
+import math
+
+import numpy as np
+
+import utilities
+from utilities import LOGGER
+from job import Status
+
+# Expected execution time of a job on an idle server in seconds.
+STEP_TIME = 10.0
+
+# Expected time to forward a bundle over one hop in seconds.
+HOP_TIME = 5.0
+
+# Expected bandwidth of a hop in bytes per second.
+BANDWIDTH = 256 * 1024
+
+# Distance covered by one hop, in the unit of the locations.
+RADIO_RANGE = 280.0
+
+
+def input_size(job, env_path=''):
+    '''Sum up the sizes of all files used as arguments by a job
+
+    Arguments:
+        job -- The job
+
+    Keyword Arguments:
+        env_path -- Directory the arguments are relative to (default: {''})
+
+    Returns:
+        The size in bytes
+    '''
+
+    size = 0
+    for argument in job.arguments:
+        path = os.path.join(env_path, argument)
+        if os.path.isfile(path):
+            size = size + os.path.getsize(path)
+
+    return size
+
+
+def transfer_time(source, destination, size):
+    '''Estimate the time to transfer data between two locations. Every hop
+    takes HOP_TIME plus the time to send the data. If a location is not
+    known, one hop is assumed.
+
+    Arguments:
+        source -- Location (x, y) of the sender
+        destination -- Location (x, y) of the receiver
+        size -- Number of bytes to be transferred
+
+    Returns:
+        The expected time in seconds
+    '''
+
+    distance = np.hypot(destination[0] - source[0],
+                        destination[1] - source[1])
+    hops = 1
+    if not np.isnan(distance):
+        hops = max(1, int(math.ceil(distance / RADIO_RANGE)))
+
+    return hops * (HOP_TIME + size / float(BANDWIDTH))
+
+
+def execution_time(offer):
+    '''Estimate the execution time of a job on a server. The more loaded the
+    server is and the fewer calls it handles in parallel, the longer it
+    takes.
+
+    Arguments:
+        offer -- The offer of the server, None if unknown
+
+    Returns:
+        The expected time in seconds
+    '''
+
+    if offer is None:
+        return STEP_TIME
+
+    try:
+        cpu_load = float(offer.capabilities.get('cpu_load', 0))
+    except ValueError:
+        cpu_load = 0
+
+    return STEP_TIME * (1 + cpu_load / offer.capacity)
+
+
+def plan_workflow(rhizome,
+                  own_sid,
+                  originator,
+                  job_file_path,
+                  jobs,
+                  job_id,
+                  env_path='',
+                  include_self=False):
+    '''Assign a server to every job with the address 'any'. The jobs are
+    scheduled in the order of their dependencies. Every job gets the server,
+    where it is expected to finish first, considering the transfer of the
+    results of its dependencies, the load of the server and the jobs already
+    assigned to it. For jobs returning a result, the transfer back to the
+    originator is considered as well. The assigned jobs are marked as
+    'planned' in the job file.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        own_sid -- SID of the planning node, which holds all files
+        originator -- SID of the originator of the call
+        job_file_path -- Path to the job file, which is rewritten
+        jobs -- The parsed job file
+        job_id -- The ID of the job, used for logging
+
+    Keyword Arguments:
+        env_path -- Directory the arguments are relative to (default: {''})
+        include_self -- The planning node may execute jobs itself
+        (default: {False})
+
+    Returns:
+        An error reason or None on success
+    '''
+
+    offers = {}
+    locations = {}
+
+    def locate(sid):
+        if sid not in locations:
+            offers[sid] = utilities.REGISTRY.offer(sid)
+            if sid == own_sid:
+                locations[sid] = tuple(map(float, utilities.get_location()))
+            elif offers[sid]:
+                locations[sid] = offers[sid].coords
+            else:
+                locations[sid] = (np.nan, np.nan)
+        return locations[sid]
+
+    # Server, finish time and result size of every job. Jobs already done
+    # have their results on the planning node.
+    finished = {}
+    busy = {}
+    makespan = 0.0
+    assignments = []
+
+    for job in jobs.ordered():
+        size = input_size(job, env_path)
+        if job.status == Status.DONE:
+            finished[job.line] = (own_sid, 0.0, size)
+            continue
+
+        # The results of the dependencies and the files in the arguments,
+        # which are sent from the planning node, have to arrive first.
+        inputs = [finished[dependency.line]
+                  for dependency in jobs.dependencies(job)]
+        result_size = size + sum(result[2] for result in inputs)
+        inputs.append((own_sid, 0.0, size))
+
+        candidates = [job.server]
+        if job.server == 'any':
+            servers = utilities.search_servers(rhizome, own_sid, originator,
+                                               job, job_id, include_self)
+            if not servers:
+                reason = '{} | Could not find any servers for {}'.format(
+                    job_id, job.procedure)
+                LOGGER.critical(reason)
+                return reason
+            candidates = [server.sid for server in servers]
+
+        best = None
+        for sid in candidates:
+            position = locate(sid)
+            ready = max(
+                time if source == sid else
+                time + transfer_time(locate(source), position, data_size)
+                for source, time, data_size in inputs)
+            start = max(ready, busy.get(sid, 0.0))
+            duration = execution_time(offers.get(sid))
+            end = start + duration
+
+            cost = end
+            if not jobs.dependents(job) and sid != originator:
+                cost = cost + transfer_time(position, locate(originator),
+                                            result_size)
+
+            if best is None or cost < best[0]:
+                best = (cost, sid, start, end)
+
+        # A server handling several calls in parallel is only partially
+        # occupied by the job.
+        cost, sid, start, end = best
+        capacity = offers[sid].capacity if offers.get(sid) else 1
+        busy[sid] = start + (end - start) / capacity
+        finished[job.line] = (sid, end, result_size)
+        makespan = max(makespan, cost)
+
+        if job.server == 'any':
+            assignments.append((job, sid))
+
+    if not assignments:
+        return None
+
+    with open(job_file_path, 'r') as job_file:
+        lines = job_file.readlines()
+
+    # The server is the first part of the line, the planned option is
+    # appended to the options.
+    for job, sid in assignments:
+        line = lines[job.line].rstrip('\n').replace('any', sid, 1)
+        if not job.planned:
+            line = line + ' planned'
+        lines[job.line] = line + '\n'
+
+    with open(job_file_path, 'w') as job_file:
+        job_file.writelines(lines)
+
+    LOGGER.info('{} | Planned {} jobs on {} servers, expected makespan {:.1f}s.'
+                .format(job_id, len(assignments),
+                        len(set(sid for _, sid in assignments)), makespan))
+
+    return None
+
+
+def replan_workflow(rhizome,
+                    own_sid,
+                    originator,
+                    job_file_path,
+                    jobs,
+                    job_id,
+                    env_path='',
+                    include_self=False):
+    '''Plan the remaining jobs of a workflow again, if servers assigned by
+    the planner disappeared, i.e. have no fresh offer anymore. Jobs joining
+    several branches keep their server, since all branches have to meet on
+    it.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        own_sid -- SID of the planning node, which holds all files
+        originator -- SID of the originator of the call
+        job_file_path -- Path to the job file, which is rewritten
+        jobs -- The parsed job file
+        job_id -- The ID of the job, used for logging
+
+    Keyword Arguments:
+        env_path -- Directory the arguments are relative to (default: {''})
+        include_self -- The planning node may execute jobs itself
+        (default: {False})
+
+    Returns:
+        A tuple of the job file, parsed again if it changed, and an error
+        reason, which is None on success
+    '''
+
+    gone = [
+        job for job in jobs.joblist
+        if job.planned and job.status == Status.OPEN and
+        job.server != own_sid and len(jobs.dependencies(job)) < 2 and
+        utilities.REGISTRY.offer(job.server) is None
+    ]
+    if not gone:
+        return (jobs, None)
+
+    for job in gone:
+        LOGGER.warn('{} | Planned server {} of {} disappeared.'.format(
+            job_id, job.server, job.procedure))
+        utilities.replace_any_to_sid(job_file_path, job.line, 'any',
+                                     old_sid=job.server)
+
+    jobs = utilities.parse_jobfile(job_file_path)
+    reason = plan_workflow(rhizome, own_sid, originator, job_file_path, jobs,
+                           job_id, env_path, include_self)
+
+    return (utilities.parse_jobfile(job_file_path), reason)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A size bounded LRU cache for results of procedures
+'''
+
+import threading
+from collections import OrderedDict
+
+
+class ResultCache():
+    '''Stores results of procedures. If either the number of entries or the
+    total size of the entries exceeds the limits, the least recently used
+    entries are evicted.
+    '''
+
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024):
+        '''Init the empty cache
+
+        Keyword Arguments:
+            max_entries -- Maximal number of entries (default: {128})
+            max_bytes -- Maximal total size of all entries (default: {64 MiB})
+        '''
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Get an entry and mark it as recently used
+
+        Arguments:
+            key -- The key of the entry
+
+        Returns:
+            The entry or None, if there is no such entry
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        '''Add an entry and evict old entries if required
+
+        Arguments:
+            key -- The key of the entry
+            value -- The entry
+            size -- The size of the entry in bytes
+
+        Returns:
+            True, if the entry was stored, False if it is too large
+        '''
+
+        if size > self.max_bytes or self.max_entries < 1:
+            return False
+
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size = self.size - old_entry[1]
+
+            self.entries[key] = (value, size)
+            self.size = self.size + size
+
+            while (len(self.entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size = self.size - evicted_size
+
+        return True
@@ -10,20 +10,24 @@ import subprocess
 import os
 import threading
 import zipfile
-from _thread import start_new_thread
+import shutil
 import client
 import math
 
-from pyserval.client import Client
 from pyserval.exceptions import DuplicateBundleException, DecryptionError
-from pyserval.exceptions import InvalidTokenError, RhizomeHTTPStatusError
-from requests.exceptions import ConnectionError
-from json.decoder import JSONDecodeError
+from pyserval.exceptions import PayloadNotFoundError
 
 import utilities
+import transfer
+import blobs
+import planner
+from executor import CallExecutor
+from persistent import PersistentProcedure, TIMEOUT as PERSISTENT_TIMEOUT
+from watcher import BundleWatcher
+from result_cache import ResultCache
 from utilities import LOGGER
 from utilities import ACK, CALL, CLEANUP, ERROR, RESULT, CONFIGURATION
-from utilities import RPC, OFFER
+from utilities import RPC, OFFER, GATHER, BLOB
 from job import Status, Job
 
 # This is the global serval RESTful client object
@@ -38,6 +42,22 @@ CLEANUP_BUNDLES = {}
 # The server's default SID to be used.
 SERVER_DEFAULT_SID = None
 
+# The executor handling the calls, if they are not executed in a queue.
+EXECUTOR = None
+
+# The running persistent procedures, keyed by (name, number of arguments).
+PERSISTENT_PROCEDURES = {}
+
+# Results of procedures with the 'cache' option.
+RESULT_CACHE = ResultCache()
+
+# Working directories of calls waiting for other branches of a workflow,
+# keyed by the rpcid and the line of the joining job.
+PENDING_JOINS = {}
+
+# Calls waiting for chunks of their blobs, keyed by the bundle ID of the call.
+WAITING_CALLS = {}
+
 
 def server_publish_procedures_thread():
     # Start a thread containing this function and execute it every
@@ -49,6 +69,19 @@ def server_publish_procedures_thread():
 
     server_publish_procedures()
 
+    # Calls to other servers without answer count as failed.
+    utilities.LATENCY.expire()
+
+    # Calls still missing chunks are tried again periodically, so that they
+    # fail after 'blob_timeout' even if no further chunk arrives.
+    if EXECUTOR:
+        resume_calls(resumable_calls(), EXECUTOR.submit)
+        LOGGER.info(
+            ' | Executor: {} calls waiting, {} running, utilization {:.2f}'
+            .format(EXECUTOR.queue_depth(), EXECUTOR.running_calls(),
+                    EXECUTOR.utilization()))
+    utilities.serval_session().log_stats()
+
 
 def server_publish_procedures():
     '''This function publishes offered procedures and capabilities
@@ -60,13 +93,10 @@ def server_publish_procedures():
     global SERVER_DEFAULT_SID
 
 
-    # The the offered procedures and capabilities for publishing.
-    offered_procedures = get_offered_procedures(
-        utilities.CONFIGURATION['rpcs'])
-    capabilities = get_capabilities(utilities.CONFIGURATION['capabilites'],
-                                    utilities.CONFIGURATION['location'])
+    payload = offer_payload(EXECUTOR.workers if EXECUTOR else 1,
+                            EXECUTOR.queue_depth() if EXECUTOR else 0,
+                            EXECUTOR.running_calls() if EXECUTOR else 0)
 
-    payload = ''
     # To not run this code multiple times at the same time, we use a LOCK.
     with LOCK:
         # First, see if we already publishing our procedures.
@@ -78,17 +108,6 @@ def server_publish_procedures():
                 offer_bundle_id = bundle.bundle_id
                 break
 
-        # Put all offered procedures to the payload
-        payload = 'procedures: {}\n'.format(len(offered_procedures))
-        for procedure in offered_procedures:
-            procedure_str = str(procedure) + '\n'
-            payload = payload + procedure_str
-
-        # Put all capabilities to the payload
-        payload = payload + 'capabilities: {}\n'.format(len(capabilities))
-        for capability in capabilities:
-            payload = payload + capability
-
         # If we already publish procedures, just update.
         # Otherwise, insert a new bundle.
         if offer_bundle_id:
@@ -101,27 +120,178 @@ def server_publish_procedures():
                 service=OFFER)
 
 
-def get_offered_procedures(rpc_defs):
-    '''Get all offered procedures from the procedures file specified
-    in the config file
+def offer_payload(workers, queued, running):
+    '''Build the payload of the offer containing the offered procedures,
+    the capabilities and the status of the server
+
+    Arguments:
+        workers -- Number of calls handled in parallel
+        queued -- Number of calls waiting
+        running -- Number of calls being handled
+
+    Returns:
+        The payload
+    '''
+
+    # The the offered procedures and capabilities for publishing.
+    offered_procedures = get_offered_procedures(
+        utilities.CONFIGURATION['rpcs'])
+    capabilities = get_capabilities(utilities.CONFIGURATION['capabilites'],
+                                    utilities.CONFIGURATION['location'])
+
+    # Put all offered procedures to the payload
+    payload = 'procedures: {}\n'.format(len(offered_procedures))
+    for procedure in offered_procedures:
+        procedure_str = str(procedure) + '\n'
+        payload = payload + procedure_str
+
+    # Put all capabilities to the payload
+    payload = payload + 'capabilities: {}\n'.format(len(capabilities))
+    for capability in capabilities:
+        payload = payload + capability
+
+    # The status of the server, the capacity is used to spread
+    # scattered jobs, the waiting and running calls to spread the load
+    # of all clients.
+    payload = payload + 'workers: {}\n'.format(workers)
+    payload = payload + 'queue: {}\n'.format(queued)
+    payload = payload + 'running: {}\n'.format(running)
+
+    return payload
+
+
+def parse_procedures(rpc_defs):
+    '''Parse the rpc.defs file
 
     Arguments:
         rpc_defs -- The path to the rpc.defs file
 
     Returns:
-        Number of offered procedures and offered procedures
+        The offered procedures, an index from (name, number of arguments)
+        to the matching procedures and a dict from (name, number of
+        arguments) to the options of the procedure
     '''
 
     offered_procedures = set()
+    procedure_index = {}
+    procedure_options = {}
     with open(rpc_defs, 'r') as conf_file:
         for procedure_definition in conf_file:
-            # RPC defs are stored as '<NAME> <ARG1> ...'
-            procedure_definition_list = procedure_definition.split(' ')
+            # RPC defs are stored as '<NAME> <ARG1> ... [| <OPTION>[:VALUE] ...]'
+            procedure_definition, _, options = procedure_definition.partition(
+                '|')
+            procedure_definition_list = procedure_definition.rstrip(
+                ' ').split(' ')
             name = procedure_definition_list[0]
             args = procedure_definition_list[1:]
-            offered_procedures.add(Job(procedure=name, arguments=args))
+            procedure = Job(procedure=name, arguments=args)
+            offered_procedures.add(procedure)
+
+            key = (name, len(procedure.arguments))
+            procedure_index.setdefault(key, []).append(procedure)
+
+            procedure_options[key] = {}
+            for option in options.split():
+                option_name, _, option_value = option.partition(':')
+                procedure_options[key][option_name] = option_value
+
+    return offered_procedures, procedure_index, procedure_options
+
+
+def parse_capabilities(rpc_caps):
+    '''Parse the rpc.caps file
+
+    Arguments:
+        rpc_caps -- The path to rpc.caps file
+
+    Returns:
+        All capability lines of the file
+    '''
+
+    with open(rpc_caps, 'r') as conf_file:
+        return frozenset(conf_file)
+
+
+# The parsed rpc.defs and rpc.caps files.
+PROCEDURES_CACHE = utilities.FileCache(parse_procedures)
+CAPABILITIES_CACHE = utilities.FileCache(parse_capabilities)
+
+
+def get_offered_procedures(rpc_defs):
+    '''Get all offered procedures from the procedures file specified
+    in the config file
+
+    Arguments:
+        rpc_defs -- The path to the rpc.defs file
+
+    Returns:
+        Set of offered procedures, must not be modified
+    '''
+
+    return PROCEDURES_CACHE.get(rpc_defs)[0]
+
+
+def get_offered_procedure(job):
+    '''Get the offered procedures matching the name and number of arguments
+    of a job
+
+    Arguments:
+        job -- The job to be looked up
+
+    Returns:
+        List of matching offered procedures, must not be modified
+    '''
+
+    procedure_index = PROCEDURES_CACHE.get(utilities.CONFIGURATION['rpcs'])[1]
+    return procedure_index.get((job.procedure, len(job.arguments)), [])
+
+
+def get_procedure_options(job):
+    '''Get the options of the offered procedure matching a job
+
+    Arguments:
+        job -- The job to be looked up
+
+    Returns:
+        Dict of the options, must not be modified
+    '''
+
+    procedure_options = PROCEDURES_CACHE.get(
+        utilities.CONFIGURATION['rpcs'])[2]
+    return procedure_options.get((job.procedure, len(job.arguments)), {})
+
+
+def get_persistent_procedure(job, workers):
+    '''Get the warm workers of a persistent procedure, they are started on
+    first use.
+
+    Arguments:
+        job -- The job to be executed
+        workers -- Number of worker processes
+
+    Returns:
+        The PersistentProcedure for the job
+    '''
+
+    key = (job.procedure, len(job.arguments))
+    with LOCK:
+        procedure = PERSISTENT_PROCEDURES.get(key)
 
-    return offered_procedures
+        # The number of workers changed in the rpc.defs, so restart.
+        if procedure and procedure.workers != workers:
+            procedure.stop()
+            procedure = None
+
+        if procedure is None:
+            bin_path = '{}/{}'.format(utilities.CONFIGURATION['bins'],
+                                      job.procedure)
+            procedure = PersistentProcedure(
+                bin_path, workers,
+                timeout=float(utilities.CONFIGURATION.get(
+                    'persistent_timeout', PERSISTENT_TIMEOUT)))
+            PERSISTENT_PROCEDURES[key] = procedure
+
+    return procedure
 
 
 def get_capabilities(rpc_caps, location):
@@ -133,21 +303,37 @@ def get_capabilities(rpc_caps, location):
         location -- The path to the location file
 
     Returns:
-        Number of capabilities and capabilities
+        Set of capabilities
     '''
 
-    capabilities = set()
-    with open(rpc_caps, 'r') as conf_file:
-        for capability in conf_file:
-            capabilities.add(capability)
+    capabilities = set(CAPABILITIES_CACHE.get(rpc_caps))
 
-    with open(location, 'r') as location_file:
-        coords = location_file.readline().split(' ')
-        capabilities.add('gps_coord={},{}\n'.format(coords[0], coords[1]))
+    coords = utilities.LOCATION_CACHE.get(location)
+    capabilities.add('gps_coord={},{}\n'.format(coords[0], coords[1]))
 
     return capabilities
 
 
+def get_capability_map():
+    '''Get all capabilities from the files in the config as dict
+
+    Returns:
+        Dict from capability name to its value
+    '''
+
+    capabilities = get_capabilities(utilities.CONFIGURATION['capabilites'],
+                                    utilities.CONFIGURATION['location'])
+
+    capability_map = {}
+    for capability in capabilities:
+        if '=' not in capability:
+            continue
+        key, value = capability.split('=', 1)
+        capability_map[key.strip()] = value.strip()
+
+    return capability_map
+
+
 def update_capability(capability, value):
     read_caps = None
     updated_caps = []
@@ -164,6 +350,8 @@ def update_capability(capability, value):
         for item in updated_caps:
             f.write(item)
 
+    CAPABILITIES_CACHE.invalidate(utilities.CONFIGURATION['capabilites'])
+
 
 def server_offering_procedure(job):
     '''Function for checking if the server is offering the procedure.
@@ -178,18 +366,7 @@ def server_offering_procedure(job):
     global LOCK
 
     with LOCK:
-        # The the offered procedures
-        offered_jobs = get_offered_procedures(utilities.CONFIGURATION['rpcs'])
-
-        for offered_job in offered_jobs:
-            if offered_job.procedure != job.procedure:
-                # The name does not match, so skip.
-                continue
-
-            if len(offered_job.arguments) != len(job.arguments):
-                # The number of arguments to not match, so skip.
-                continue
-
+        for offered_job in get_offered_procedure(job):
             # It is not enough to check if we theoretically offer the
             # procedure but also if the executable is available.
             bin_path = '%s/%s' % (utilities.CONFIGURATION['bins'],
@@ -204,37 +381,27 @@ def server_offering_procedure(job):
         return False
 
 
-def server_execute_procedure(job, env_path):
-    '''The main execution function, which executes the called procedure
+def resolve_arguments(job, env_path):
+    '''Check that exactly one offered procedure matches the job and make
+    its file arguments point into the working directory
 
     Arguments:
         job -- The job to be executed
         env_path -- The temporary path where the procedure will be executed
 
     Returns:
-        The return code of the procedure and a string containing the result
+        An error message or None, if the job can be executed
     '''
 
-    # Path of the executable itself.
-    bin_path = utilities.CONFIGURATION['bins'] + '/%s %s'
-
     # We have to rewrite some paths, so we need the offered jobs...
-    offered_jobs = get_offered_procedures(utilities.CONFIGURATION['rpcs'])
-    offered_job = [
-        _job for _job in offered_jobs if _job.procedure == job.procedure and
-        len(_job.arguments) == len(job.arguments)
-    ]
+    offered_job = get_offered_procedure(job)
 
     # In case the are either more than one or none such procedures,
     # there is something wrong and we need to abort.
-    error = None
     if len(offered_job) > 1:
-        error = 'There is more than one matching procedure! Can not execute.'
+        return 'There is more than one matching procedure! Can not execute.'
     elif len(offered_job) < 1:
-        error = 'There is no such procedure. Can not execute'
-
-    if error:
-        return (1, error)
+        return 'There is no such procedure. Can not execute'
 
     # This is the job we are looking for.
     offered_job = offered_job[0]
@@ -247,6 +414,33 @@ def server_execute_procedure(job, env_path):
             job.arguments[i] = env_path + job.arguments[i]
             job.arguments[i] = job.arguments[i].replace('//', '/')
 
+    return None
+
+
+def server_execute_procedure(job, env_path):
+    '''The main execution function, which executes the called procedure
+
+    Arguments:
+        job -- The job to be executed
+        env_path -- The temporary path where the procedure will be executed
+
+    Returns:
+        The return code of the procedure and a string containing the result
+    '''
+
+    # Path of the executable itself.
+    bin_path = utilities.CONFIGURATION['bins'] + '/%s %s'
+
+    error = resolve_arguments(job, env_path)
+    if error:
+        return (1, error)
+
+    # Persistent procedures are handed to one of their warm workers.
+    options = get_procedure_options(job)
+    if 'persistent' in options:
+        workers = int(options['persistent'] or 1)
+        return get_persistent_procedure(job, workers).call(job.arguments)
+
     # Execute the job!
     job_process = subprocess.Popen(
         bin_path % (job.procedure, ' '.join(job.arguments)),
@@ -262,6 +456,126 @@ def server_execute_procedure(job, env_path):
         return (0, out.rstrip())
 
 
+def result_cache_key(job, env_path):
+    '''Build the key for the result cache of a job. File arguments are
+    represented by the hash of their content.
+
+    Arguments:
+        job -- The job to be executed
+        env_path -- The temporary path where the procedure will be executed
+
+    Returns:
+        The key or None, if a file argument does not exist
+    '''
+
+    offered_job = get_offered_procedure(job)
+    if len(offered_job) != 1:
+        return None
+
+    key = [job.procedure]
+    for argument_type, argument in zip(offered_job[0].arguments,
+                                       job.arguments):
+        if argument_type != 'file':
+            key.append(argument)
+            continue
+
+        file_path = (env_path + argument).replace('//', '/')
+        if not os.path.isfile(file_path):
+            return None
+        key.append(utilities.hash_file(file_path))
+
+    return tuple(key)
+
+
+def server_execute_procedure_cached(job, env_path, job_id):
+    '''Executes the procedure, but answers from the result cache for
+    procedures with the 'cache' option. A result file inside the env_path
+    is cached together with the result.
+
+    Arguments:
+        job -- The job to be executed
+        env_path -- The temporary path where the procedure will be executed
+        job_id -- The ID of the call, used for logging
+
+    Returns:
+        The return code of the procedure and a string containing the result
+    '''
+
+    key, result = lookup_cached_result(job, env_path, job_id)
+    if result is not None:
+        return (0, result)
+
+    code, result = server_execute_procedure(job, env_path)
+    if code == 0 and key is not None:
+        store_cached_result(key, env_path, result)
+
+    return (code, result)
+
+
+def lookup_cached_result(job, env_path, job_id):
+    '''Look up the result of a procedure with the 'cache' option. A cached
+    result file is restored in the env_path.
+
+    Arguments:
+        job -- The job to be executed
+        env_path -- The temporary path where the procedure will be executed
+        job_id -- The ID of the call, used for logging
+
+    Returns:
+        The key for storing the result, None if the result is not cached,
+        and the cached result, None if there is none
+    '''
+
+    if 'cache' not in get_procedure_options(job):
+        return (None, None)
+
+    key = result_cache_key(job, env_path)
+    if key is None:
+        return (None, None)
+
+    cached = RESULT_CACHE.get(key)
+    if cached is None:
+        return (key, None)
+
+    result, result_file, content = cached
+    # Restore the result file in the new env_path.
+    if result_file is not None:
+        result_path = env_path.rstrip('/') + result_file
+        os.makedirs(os.path.dirname(result_path), exist_ok=True)
+        with open(result_path, 'wb') as cached_file:
+            cached_file.write(content)
+        result = result_path.encode('utf-8')
+
+    LOGGER.info('{} | -Execution- Using cached result of {}.'.format(
+        job_id, job.procedure))
+    return (key, result)
+
+
+def store_cached_result(key, env_path, result):
+    '''Store the result of a successful execution in the result cache
+
+    Arguments:
+        key -- The key from lookup_cached_result
+        env_path -- The temporary path where the procedure was executed
+        result -- The result of the procedure
+    '''
+
+    # If the result is a file in the env_path, we have to keep the file,
+    # the env_path itself will be different next time.
+    env_base = env_path.rstrip('/')
+    result_file = None
+    content = b''
+    result_decoded = result.decode('utf-8')
+    if (result_decoded.startswith(env_base + '/') and
+            os.path.isfile(result_decoded)):
+        result_file = result_decoded[len(env_base):]
+        with open(result_decoded, 'rb') as cached_file:
+            content = cached_file.read()
+
+    RESULT_CACHE.put(key, (result, result_file, content),
+                     len(result) + len(content))
+
+
 def is_capable(job):
     '''Function for checking if the server is capable to execute the procedure
 
@@ -277,16 +591,11 @@ def is_capable(job):
         return True
 
     # Get the server capabilities
-    capabilities = get_capabilities(utilities.CONFIGURATION['capabilites'],
-                                    utilities.CONFIGURATION['location'])
+    capabilities = get_capability_map()
 
     for requirement, requirement_value in job.filter_dict.items():
         # Get the capability we are looking for
-        capability_line = [
-            line for line in capabilities if requirement in line
-        ]
-
-        capability_value = capability_line[0].split('=')[1].rstrip()
+        capability_value = capabilities[requirement]
 
         if float(capability_value) < float(requirement_value):
             return False
@@ -294,6 +603,100 @@ def is_capable(job):
     return True
 
 
+def remember_bundle(call_bundle, bundle):
+    '''Remember a bundle sent because of a call, so that it is removed when
+    the call is cleaned up
+
+    Arguments:
+        call_bundle -- The bundle containing the call
+        bundle -- The sent bundle
+    '''
+
+    if call_bundle.bundle_id in CLEANUP_BUNDLES:
+        CLEANUP_BUNDLES[call_bundle.bundle_id].append(bundle.bundle_id)
+    else:
+        CLEANUP_BUNDLES[call_bundle.bundle_id] = [bundle.bundle_id]
+
+
+def wait_for_blobs(potential_call, error):
+    '''Park a call, whose blobs did not arrive completely, instead of
+    blocking a worker. The call is handled again when its missing chunks
+    arrived, see resumable_calls.
+
+    Arguments:
+        potential_call -- The call bundle
+        error -- The BlobNotFoundError naming the missing chunks
+
+    Returns:
+        True, if the call waits, False if it waited 'blob_timeout' already
+    '''
+
+    with LOCK:
+        waiting = WAITING_CALLS.get(potential_call.bundle_id)
+        if waiting is None:
+            waiting = {
+                'call': potential_call,
+                'deadline': time.time() + float(
+                    CONFIGURATION.get('blob_timeout', 60))
+            }
+            WAITING_CALLS[potential_call.bundle_id] = waiting
+
+        if time.time() > waiting['deadline']:
+            WAITING_CALLS.pop(potential_call.bundle_id, None)
+            return False
+
+        waiting['missing'] = set(error.bundle_ids)
+        return True
+
+
+def resumable_calls(bundle_id=None):
+    '''Get the waiting calls, which should be handled again
+
+    Keyword Arguments:
+        bundle_id -- ID of an arrived chunk, only calls for which it was the
+        last missing chunk are returned. All waiting calls if None
+        (default: {None})
+
+    Returns:
+        List of call bundles
+    '''
+
+    calls = []
+    with LOCK:
+        for waiting in WAITING_CALLS.values():
+            # None means, that the call is handled right now.
+            missing = waiting['missing']
+            if missing is None:
+                continue
+            if bundle_id is not None:
+                missing.discard(bundle_id)
+                if missing:
+                    continue
+            waiting['missing'] = None
+            calls.append(waiting['call'])
+    return calls
+
+
+def resume_calls(calls, submit):
+    '''Handle waiting calls again
+
+    Arguments:
+        calls -- List of call bundles from resumable_calls
+        submit -- Function starting the handling of a call, returns False if
+        the server is overloaded
+    '''
+
+    for potential_call in calls:
+        if submit(potential_call):
+            continue
+
+        # Try again with the next chunk or periodically.
+        with LOCK:
+            waiting = WAITING_CALLS.get(potential_call.bundle_id)
+            if waiting is not None:
+                waiting['missing'] = set()
+
+
 def return_error(call_bundle,
                  reason,
                  file_list=None,
@@ -313,21 +716,24 @@ def return_error(call_bundle,
 
     LOGGER.debug('####### {}, {}, {}, {}'.format(call_bundle.bundle_id, reason, file_list, zip_file_name))
 
-    # If files should be returned to the client, create a ZIP and open
-    # the ZIP file.
-    payload_path = utilities.make_zip(
-        file_list,
-        name=zip_file_name + '_error.zip',
-        subpath_to_remove=zip_file_name)
-
-    payload = open(payload_path, 'rb')
+    # If files should be returned to the client, create a ZIP file.
+    payload_path = None
+    if file_list is not None:
+        payload_path = blobs.make_zip(
+            SERVAL.rhizome,
+            file_list,
+            name=zip_file_name + '_error.zip',
+            subpath_to_remove=zip_file_name,
+            owner=call_bundle.bundle_id)
 
-    LOGGER.debug('####### {}, {},'.format(payload_path, payload))
+        LOGGER.debug('####### {}'.format(payload_path))
 
     # Simply insert the error bundle containing all relevant data
-    error_bundle = SERVAL.rhizome.new_bundle(
+    error_bundle = transfer.insert_bundle(
+        SERVAL.rhizome,
+        SERVER_DEFAULT_SID,
+        payload_path=payload_path,
         name=call_bundle.manifest.name,
-        payload=payload.read(),
         service=RPC,
         recipient=call_bundle.manifest.originator,
         custom_manifest={
@@ -339,11 +745,160 @@ def return_error(call_bundle,
     LOGGER.debug('Returned Error with {} to {}'.format(
         error_bundle.bundle_id, call_bundle.manifest.originator))
 
-    id_to_store = error_bundle.bundle_id
-    if call_bundle.bundle_id in CLEANUP_BUNDLES:
-        CLEANUP_BUNDLES[call_bundle.bundle_id].append(id_to_store)
-    else:
-        CLEANUP_BUNDLES[call_bundle.bundle_id] = [id_to_store]
+    remember_bundle(call_bundle, error_bundle)
+
+
+def collect_result_files(env_path, snapshot, job_file_path, result,
+                         following_jobs):
+    '''Collect the files to be sent on after the execution: the job file,
+    all files created or changed by the procedure, the result file and all
+    files used by the following jobs.
+
+    Arguments:
+        env_path -- The path where the procedure was executed
+        snapshot -- The snapshot of env_path taken before the execution
+        job_file_path -- Path to the job file
+        result -- The result of the procedure
+        following_jobs -- All jobs after the executed one
+
+    Returns:
+        List of files
+    '''
+
+    files = [job_file_path] + utilities.changed_files(env_path, snapshot)
+
+    # Paths in job files and results are relative to env_path.
+    referenced = [result] + [
+        argument for job in following_jobs for argument in job.arguments
+    ]
+    env_root = os.path.normpath(env_path)
+    for path in referenced:
+        path = os.path.normpath(
+            env_root + '/' + path.replace(env_path, '').lstrip('/'))
+        if path.startswith(env_root + os.sep) and os.path.isfile(path):
+            files.append(path)
+
+    # Every file is only zipped once.
+    unique_files = []
+    for path in map(os.path.normpath, files):
+        if path not in unique_files:
+            unique_files.append(path)
+
+    return unique_files
+
+
+def update_job_file(job_file_path, jobs, job, code, result):
+    '''Mark a job as DONE or ERROR and insert its result into all jobs
+    depending on it
+
+    Arguments:
+        job_file_path -- Path to the job file
+        jobs -- The parsed job file
+        job -- The executed job
+        code -- The return code of the job
+        result -- The result of the job
+    '''
+
+    with open(job_file_path, 'r') as job_file:
+        lines = job_file.readlines()
+
+    lines[job.line] = utilities.insert_to_line(lines[job.line],
+                                               'DONE' if code == 0 else 'ERROR')
+
+    # The result replaces '##name' and, if it is the only dependency,
+    # also '##'.
+    for dependent in jobs.dependents(job):
+        if job.name:
+            lines[dependent.line] = utilities.substitute_result(
+                lines[dependent.line], result, job.name)
+        if len(jobs.dependencies(dependent)) == 1:
+            lines[dependent.line] = utilities.substitute_result(
+                lines[dependent.line], result)
+
+    with open(job_file_path, 'w') as job_file:
+        job_file.writelines(lines)
+
+
+def join_branch(job_id, job, env_path, job_file_path):
+    '''Join the call of a branch of a workflow with the calls of the other
+    branches, which already arrived. The files and the job file of the call
+    are merged into the working directory of the first call.
+
+    Arguments:
+        job_id -- The rpcid of the workflow
+        job -- The joining job
+        env_path -- Working directory of the call
+        job_file_path -- Path to the job file of the call
+
+    Returns:
+        The working directory and the job file path of the joined calls, if
+        all branches arrived, None otherwise
+    '''
+
+    key = (job_id, job.line)
+
+    with LOCK:
+        if key not in PENDING_JOINS:
+            PENDING_JOINS[key] = (env_path, job_file_path)
+            return None
+
+        joined_env_path, joined_job_file_path = PENDING_JOINS[key]
+
+        # Copy all files of this branch, except of the job file, which is
+        # merged line by line.
+        for root, _, files in os.walk(env_path):
+            for f in files:
+                path = os.path.join(root, f)
+                if os.path.normpath(path) == os.path.normpath(job_file_path):
+                    continue
+                destination = os.path.join(joined_env_path,
+                                           os.path.relpath(path, env_path))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copyfile(path, destination)
+        utilities.merge_job_files(joined_job_file_path, job_file_path)
+
+        jobs = utilities.parse_jobfile(joined_job_file_path)
+        if not jobs.is_ready(jobs.find(line=job.line)):
+            return None
+
+        del PENDING_JOINS[key]
+        LOGGER.info('{} | All branches of {} arrived.'.format(
+            job_id, job.procedure))
+        return (joined_env_path, joined_job_file_path)
+
+
+def find_call_job(potential_call, file_list):
+    '''Find the job file of an extracted call and the job this server has
+    to execute. The call names the job we have to execute. Otherwise, we
+    iterate through all jobs and try to find a job for us.
+
+    Arguments:
+        potential_call -- The bundle containing the call
+        file_list -- The extracted files
+
+    Returns:
+        The path to the job file, None if there is none, and the job, None
+        if the server has no job
+    '''
+
+    jobs = None
+    job_file_path = None
+    for _file in file_list:
+        if _file.endswith('.jb'):
+            jobs = utilities.parse_jobfile(_file)
+            job_file_path = _file
+
+    if jobs is None:
+        return (None, None)
+
+    step = getattr(potential_call.manifest, 'step', None)
+    if step is not None:
+        return (job_file_path, jobs.find(line=int(step)))
+
+    for job in jobs.joblist:
+        if job.status == Status.OPEN and job.server == SERVER_DEFAULT_SID:
+            return (job_file_path, job)
+    return (job_file_path, None)
 
 
 def server_handle_call(potential_call):
@@ -366,27 +921,46 @@ def server_handle_call(potential_call):
     zip_file_base_path = '{}_{}'.format(job_id, exec_time)
 
     zip_file_step_path = '{}_step.zip'.format(zip_file_base_path)
-    zip_file_result_step_path = '{}_result_step'.format(zip_file_base_path)
-    zip_file_result_path = '{}_result'.format(zip_file_base_path)
 
     # Download the payload from the Rhizome store
-    with open(zip_file_step_path, 'wb') as zip_file:
-        zip_file.write(potential_call.payload)
+    try:
+        transfer.download_payload(potential_call, zip_file_step_path)
+    except (DecryptionError, PayloadNotFoundError) as e:
+        LOGGER.error('{} | Could not download the call, skipping. ({})'
+                     .format(job_id, e))
+        return
 
-    jobs = None
     job_file_path = None
     file_list = None
 
     # If we have a valid ZIP file, we extract it and parse the job file.
     if zipfile.is_zipfile(zip_file_step_path):
-        file_list = utilities.extract_zip(zip_file_step_path,
-                                          zip_file_base_path + '/')
-
-        # Find the job file and parse it.
-        for _file in file_list:
-            if _file.endswith('.jb'):
-                jobs = utilities.parse_jobfile(_file)
-                job_file_path = _file
+        # Workers do not wait for missing chunks, the call is parked
+        # instead. In a queue, the call is simply waited for.
+        try:
+            file_list = blobs.extract_zip(
+                SERVAL.rhizome,
+                zip_file_step_path,
+                zip_file_base_path + '/',
+                timeout=None if EXECUTOR is None else 0)
+        except blobs.BlobNotFoundError as e:
+            shutil.rmtree(zip_file_base_path, ignore_errors=True)
+            os.remove(zip_file_step_path)
+            if EXECUTOR is not None and wait_for_blobs(potential_call, e):
+                LOGGER.info('{} | Waiting for {} chunks.'.format(
+                    job_id, e.missing))
+                return
+
+            reason = '{} | {}'.format(job_id, e)
+            LOGGER.critical(reason)
+            return_error(potential_call, reason)
+            return
+
+        with LOCK:
+            WAITING_CALLS.pop(potential_call.bundle_id, None)
+
+        # Find the job file and the job for us.
+        job_file_path, possible_job = find_call_job(potential_call, file_list)
     else:
         # We have not found a valid ZIP file, so abort here and inform
         # the client.
@@ -401,7 +975,7 @@ def server_handle_call(potential_call):
         return
 
     # We could not find any jobs in the ZIP, so abort and inform the client.
-    if jobs is None:
+    if job_file_path is None:
         reason = '{} | Call has no job file.'.format(job_id)
         LOGGER.critical(reason)
         return_error(
@@ -411,210 +985,514 @@ def server_handle_call(potential_call):
             zip_file_name=zip_file_base_path)
         return
 
-    possible_job = None
-    possible_next_job = None
+    server_handle_step(
+        Step(potential_call, zip_file_base_path, job_file_path, possible_job,
+             file_list))
 
-    # We iterate through all jobs and try to find a job for us.
-    # We remember our job and the job for the next hop, if available.
-    for job in jobs.joblist:
-        if job.status == Status.OPEN and job.server == SERVER_DEFAULT_SID:
-            possible_job = job
-            try:
-                current_position = jobs.joblist.index(possible_job)
-                possible_next_job = jobs.joblist[current_position + 1]
-            except IndexError:
-                pass
-            break
 
-    # Do a check, if the procedure is offered and inform the client if not.
-    LOGGER.info('{} | Checking if offering {}'.format(job_id,
-                                                      possible_job.procedure))
-    if possible_job is None or not server_offering_procedure(possible_job):
-        reason = 'Server is not offering this procedure.'
-        LOGGER.critical(reason)
-        return_error(
-            potential_call,
-            reason,
-            file_list=file_list,
-            zip_file_name=zip_file_base_path)
-        return
+def copy_working_directory(env_path, job_file_path, suffix):
+    '''Copy the working directory of a call for a further local branch of a
+    workflow
 
-    # Check, if the server is capable to execute the procedure and inform
-    # the client if not.
-    LOGGER.info('{} | Checking if capable to execute {}'.format(
-        job_id, possible_job.procedure))
-    if not is_capable(possible_job):
-        reason = 'Server is not capable to execute the job.'
-        LOGGER.critical('{} | {}'.format(job_id, reason))
-        return_error(
-            potential_call,
-            reason,
-            file_list=file_list,
-            zip_file_name=zip_file_base_path)
-        return
+    Arguments:
+        env_path -- The working directory
+        job_file_path -- Path to the job file in env_path
+        suffix -- Appended to the name of the copy
 
-    # Since we are now confident about the job, we sent an ACK and start
-    # processing.
-    try:
-        SERVAL.rhizome.new_bundle(
-            name=potential_call.manifest.name,
-            payload='',
-            service=RPC,
-            recipient=potential_call.manifest.sender,
-            custom_manifest={
+    Returns:
+        The path of the copy and the path of the job file in it
+    '''
+
+    copy_path = '{}_{}'.format(os.path.normpath(env_path), suffix)
+    shutil.copytree(env_path, copy_path)
+    copy_job_file_path = os.path.join(
+        copy_path, os.path.relpath(job_file_path, env_path))
+
+    return (copy_path, copy_job_file_path)
+
+
+class Step():
+    '''A call while its jobs are executed on this server. All decisions
+    about the jobs are made here, so that the threaded and the asynchronous
+    server only differ in how they send bundles and wait. Methods looking
+    up servers or touching the working directory block.
+    '''
+
+    def __init__(self, potential_call, env_path, job_file_path, job,
+                 file_list, local=False):
+        '''Init the step
+
+        Arguments:
+            potential_call -- The bundle containing the call
+            env_path -- The working directory of the call
+            job_file_path -- Path to the job file
+            job -- The job to be executed, None if the server has no job
+            file_list -- Files to be returned on errors
+
+        Keyword Arguments:
+            local -- The job was passed on by this server, not received
+            (default: {False})
+        '''
+
+        self.call = potential_call
+        self.job_id = potential_call.manifest.rpcid
+        self.originator = potential_call.manifest.originator
+        self.file_list = file_list
+        self.local = local
+        self.snapshot = {}
+        self.code = None
+        self.result = None
+        self.local_jobs = []
+        self.remote_jobs = []
+        self._enter(env_path, job_file_path, job)
+
+    def _enter(self, env_path, job_file_path, job):
+        '''Switch to a working directory and parse its job file
+
+        Arguments:
+            env_path -- The working directory
+            job_file_path -- Path to the job file
+            job -- The job to be executed, may be None
+        '''
+
+        self.env_path = env_path
+        self.job_file_path = job_file_path
+        self.result_step_path = '{}_result_step'.format(env_path)
+        self.result_path = '{}_result'.format(env_path)
+        self.jobs = utilities.parse_jobfile(job_file_path)
+        self.job = None
+        if job is not None:
+            self.job = self.jobs.find(line=job.line)
+
+    def take_snapshot(self):
+        '''Remember the state of the working directory, so that only new and
+        changed files have to be sent on.
+        '''
+
+        self.snapshot = utilities.snapshot_files(self.env_path)
+
+    def error_arguments(self):
+        '''Keyword arguments of return_error for this step
+
+        Returns:
+            Dict of the files to be returned and the name of the ZIP file
+        '''
+
+        return {'file_list': self.file_list, 'zip_file_name': self.env_path}
+
+    def check(self):
+        '''Check if the procedure is offered and if the server is capable to
+        execute it
+
+        Returns:
+            The reason why the job can not be executed, None if it can
+        '''
+
+        job = self.job
+        LOGGER.info('{} | Checking if offering {}'.format(
+            self.job_id, job.procedure if job else None))
+        if job is None or not (job.procedure == GATHER or
+                               server_offering_procedure(job)):
+            reason = 'Server is not offering this procedure.'
+            LOGGER.critical(reason)
+            return reason
+
+        LOGGER.info('{} | Checking if capable to execute {}'.format(
+            self.job_id, job.procedure))
+        if not is_capable(job):
+            reason = 'Server is not capable to execute the job.'
+            LOGGER.critical('{} | {}'.format(self.job_id, reason))
+            return reason
+
+        return None
+
+    def ack_fields(self):
+        '''Fields of the ACK sent before the execution. Jobs passed on
+        locally were already acknowledged with the call.
+
+        Returns:
+            Dict of name, service, recipient and custom_manifest of the ACK,
+            None if no ACK has to be sent
+        '''
+
+        if self.local:
+            return None
+
+        return {
+            'name': self.call.manifest.name,
+            'service': RPC,
+            'recipient': self.call.manifest.sender,
+            'custom_manifest': {
                 'type': ACK,
-                'originator': potential_call.manifest.originator,
-                'rpcid': job_id
-            })
-    except DuplicateBundleException:
-        pass
-
-    # After sending the ACK, execute the procedure and store the result.
-    LOGGER.info(
-        '{} | -Execution- Starting execution of {}...'
-        .format(job_id, job.procedure))
-    code, result = server_execute_procedure(possible_job,
-                                            zip_file_base_path + '/')
-    result_decoded = result.decode('utf-8')
+                'originator': self.originator,
+                'rpcid': self.job_id
+            }
+        }
 
-    capabilities = get_capabilities(utilities.CONFIGURATION['capabilites'],
-                                    utilities.CONFIGURATION['location'])
+    def join(self):
+        '''A job joining several branches of a workflow has to wait, until
+        the calls of all branches arrived. Then, the step continues in the
+        joined working directory.
 
-    capability_line = [
-            line for line in capabilities if 'energy' in line
-        ]
+        Returns:
+            False, if the step has to wait for other branches
+        '''
 
-    capability_value = float(capability_line[0].split('=')[1].rstrip())
+        if not self.jobs.dag or self.jobs.is_ready(self.job):
+            return True
 
-    update_capability(
-        'energy', capability_value - float(possible_job.filter_dict['energy']))
-    server_publish_procedures()
+        joined = join_branch(self.job_id, self.job, self.env_path,
+                             self.job_file_path)
+        if joined is None:
+            LOGGER.info('{} | Waiting for other branches of {}.'.format(
+                self.job_id, self.job.procedure))
+            return False
+
+        self.file_list = joined[0]
+        self._enter(joined[0], joined[1], self.job)
+        self.take_snapshot()
+        return True
+
+    def gather(self):
+        '''Gathering executes nothing, the results of all parts are the
+        arguments of the job and are returned together.
+
+        Returns:
+            The return code and the result
+        '''
+
+        return (0, ' '.join(self.job.arguments).encode('utf-8'))
+
+    def consume_energy(self):
+        '''Reduce the energy capability by the energy the job required
+
+        Returns:
+            True, if the capabilities changed and should be published
+        '''
+
+        if 'energy' not in self.job.filter_dict:
+            return False
+
+        capability_value = float(get_capability_map()['energy'])
+        update_capability(
+            'energy',
+            capability_value - float(self.job.filter_dict['energy']))
+        return True
+
+    def finish(self, code, result):
+        '''Mark the job as DONE or ERROR in the job file and provide its
+        result as input for the following jobs
+
+        Arguments:
+            code -- The return code of the job
+            result -- The result of the job
+
+        Returns:
+            List of the following jobs, empty if the result has to be
+            returned to the client
+        '''
+
+        self.code = code
+        self.result = result.decode('utf-8')
+        update_job_file(self.job_file_path, self.jobs, self.job, code,
+                        self.result.replace(self.env_path, ''))
+
+        # If a step of a workflow fails, the following steps are not called.
+        if self.jobs.dag and code != 0:
+            return []
+        return self.jobs.dependents(self.job)
+
+    def plan(self, next_jobs):
+        '''Choose the servers of the following jobs and split them into the
+        jobs executed here and elsewhere
+
+        Arguments:
+            next_jobs -- The following jobs
+
+        Returns:
+            The reason why no server was found, None on success
+        '''
 
-    # Here we need to prepare the job for the next hop.
-    if possible_next_job is not None:
         LOGGER.info('{} | -Runtime- Preparing job {} for next hop.'.format(
-            job_id, possible_job.procedure))
-        # After executing the job, we have to update the job_file.
-        # Therefore, we first read it.
-        job_file = open(job_file_path, 'r+')
-        lines = job_file.readlines()
+            self.job_id, self.job.procedure))
+        include_self = CONFIGURATION.get('select_self') == 'true'
 
-        if code == 0:
-            # The execution was successful, so we append DONE to the
-            # corresponding line.
-            lines[possible_job.line] = utilities.insert_to_line(
-                lines[possible_job.line], 'DONE')
-        else:
-            # Something went wrong, we append ERROR to the line.
-            lines[possible_job.line] = utilities.insert_to_line(
-                lines[possible_job.line], 'ERROR')
-
-        # The result of the job has to be provided as input for the next hop,
-        # so we have to replace the placeholder ## with the result in the
-        # job file.
-        lines[possible_next_job.line] = lines[possible_next_job.line].replace(
-            '##', result_decoded.replace(zip_file_base_path, ''))
-
-        # The file has been updated, so we can write the content and close it.
-        job_file.seek(0)
-        for line in lines:
-            job_file.write(line)
-        job_file.close()
+        # Servers assigned by the planner are kept, unless they disappeared.
+        jobs, reason = planner.replan_workflow(
+            SERVAL.rhizome, SERVER_DEFAULT_SID, self.originator,
+            self.job_file_path, self.jobs, self.job_id,
+            env_path=self.env_path, include_self=include_self)
+        if reason:
+            return reason
 
         # If the next server is again any, we search a new one for the next
         # job. This is about the same process as in the client.
-        if possible_next_job.server == 'any':
-            LOGGER.info('{} | Searching next server.'.format(job_id))
-            reason = utilities.lookup_server(
-                SERVAL.rhizome, SERVER_DEFAULT_SID,
-                potential_call.manifest.originator, possible_next_job, job_id,
-                job_file_path)
+        for next_job in [jobs.find(line=job.line) for job in next_jobs]:
+            if next_job.server != 'any':
+                continue
 
+            LOGGER.info('{} | Searching next server.'.format(self.job_id))
+            reason = utilities.lookup_server(
+                SERVAL.rhizome, SERVER_DEFAULT_SID, self.originator, next_job,
+                self.job_id, self.job_file_path, include_self=include_self)
             if reason:
-                return_error(
-                    potential_call,
-                    reason,
-                    file_list=file_list,
-                    zip_file_name=zip_file_base_path)
-                return
+                return reason
+
+        # The job file contains the results and servers of the next jobs
+        # now.
+        self.jobs = utilities.parse_jobfile(self.job_file_path)
+        self.job = self.jobs.find(line=self.job.line)
+        next_jobs = [self.jobs.find(line=job.line) for job in next_jobs]
+        self.local_jobs = [
+            job for job in next_jobs if job.server == SERVER_DEFAULT_SID
+        ]
+        self.remote_jobs = [
+            job for job in next_jobs if job.server != SERVER_DEFAULT_SID
+        ]
+        return None
+
+    def next_hop_files(self):
+        '''Files to be sent to the remote next hops
+
+        Returns:
+            The working directory, if a next job needs all files, otherwise
+            a list of the files, see collect_result_files
+        '''
+
+        if any(job.carry for job in self.remote_jobs):
+            return self.env_path
+
+        following_jobs = [
+            job for job in self.jobs.joblist
+            if job.status != Status.DONE and job.line != self.job.line
+        ]
+        return collect_result_files(self.env_path, self.snapshot,
+                                    self.job_file_path, self.result,
+                                    following_jobs)
 
-        # Done. Make the payload containing all required files, read the
-        # payload ...
-        payload_path = utilities.make_zip(
-            zip_file_base_path,
-            name=zip_file_result_step_path,
-            subpath_to_remove=zip_file_base_path + '/')
-        payload = open(payload_path, 'rb')
-
-        # ... and send the bundle.
-        next_hop_bundle = SERVAL.rhizome.new_bundle(
-            name=possible_next_job.procedure,
-            payload=payload.read(),
-            service=RPC,
-            recipient=possible_next_job.server,
-            custom_manifest={
+    def next_hop_fields(self, next_job):
+        '''Fields of the call of a remote next hop
+
+        Arguments:
+            next_job -- The job of the next hop
+
+        Returns:
+            Dict of name, service, recipient and custom_manifest
+        '''
+
+        return {
+            'name': next_job.procedure,
+            'service': RPC,
+            'recipient': next_job.server,
+            'custom_manifest': {
                 'type': CALL,
-                'originator': potential_call.manifest.originator,
-                'rpcid': job_id
-            })
+                'originator': self.originator,
+                'rpcid': self.job_id,
+                'step': next_job.line
+            }
+        }
 
-        LOGGER.info(
-            '{} | -Transmission- Next step {} is called: bid is {}'.format(
-                job_id, possible_next_job.procedure,
-                next_hop_bundle.bundle_id))
-
-        # We have to remember the bundle id for cleanup lateron.
-        id_to_store = next_hop_bundle.bundle_id
-        if potential_call.bundle_id in CLEANUP_BUNDLES:
-            CLEANUP_BUNDLES[potential_call.bundle_id].append(id_to_store)
-        else:
-            CLEANUP_BUNDLES[potential_call.bundle_id] = [id_to_store]
+    def next_hop_sent(self, next_job, bundle):
+        '''Remember the call of a next hop for the cleanup and the latency
+        statistics
+
+        Arguments:
+            next_job -- The job of the next hop
+            bundle -- The sent call
+        '''
+
+        LOGGER.info('{} | -Transmission- Next step {} is called: bid is {}'
+                    .format(self.job_id, next_job.procedure,
+                            bundle.bundle_id))
+        remember_bundle(self.call, bundle)
+        utilities.LATENCY.sent(next_job.server, next_job.procedure,
+                               self.job_id)
+
+    def branch(self, next_job):
+        '''Start a further local branch in a copy of the working directory
+
+        Arguments:
+            next_job -- The first job of the branch
+
+        Returns:
+            The step of the branch
+        '''
+
+        branch_path, branch_job_file_path = copy_working_directory(
+            self.env_path, self.job_file_path, next_job.line)
+        LOGGER.info('{} | -Runtime- Executing step {} locally.'.format(
+            self.job_id, next_job.procedure))
+        return Step(self.call, branch_path, branch_job_file_path, next_job,
+                    branch_path, local=True)
+
+    def continue_with(self, next_job):
+        '''Continue with a local job in this working directory, without a
+        round trip through the Rhizome store
+
+        Arguments:
+            next_job -- The next job
+        '''
+
+        LOGGER.info('{} | -Runtime- Executing step {} locally.'.format(
+            self.job_id, next_job.procedure))
+        self.job = next_job
+        self.local = True
+
+    def result_files(self):
+        '''Files returned to the client. The client already has its input
+        files, so only new and changed files are returned. The results of
+        gathered parts are the arguments of the job.
+
+        Returns:
+            List of files, see collect_result_files
+        '''
 
-    else:
         LOGGER.info('{} | -Runtime- Preparing result from {}.'.format(
-            job_id, possible_job.procedure))
-        # There is no next hop, return the result to the client by
-        # building and reading the payload...
-        payload_path = utilities.make_zip(
-            zip_file_base_path,
-            name=zip_file_result_path,
-            subpath_to_remove=zip_file_base_path + '/')
-        payload = open(payload_path, 'rb')
-
-        # ... constructing the custom manifest part ...
+            self.job_id, self.job.procedure))
+        return collect_result_files(
+            self.env_path, self.snapshot, self.job_file_path, self.result,
+            [self.job] if self.job.procedure == GATHER else [])
+
+    def result_fields(self):
+        '''Fields of the result, or of the error if the job failed
+
+        Returns:
+            Dict of name, service, recipient and custom_manifest
+        '''
+
         custom_manifest = {
-            'type': None,
-            'originator': potential_call.manifest.originator,
-            'rpcid': job_id
+            'type': RESULT,
+            'originator': self.originator,
+            'rpcid': self.job_id,
+            'step': self.job.line
         }
 
-        # ... (if code is 1, an error occured) ...
-        if code == 1:
+        # If code is 1, an error occured.
+        if self.code == 1:
             custom_manifest['type'] = ERROR
-        else:
-            custom_manifest['type'] = RESULT
+            custom_manifest['reason'] = 'Step {} failed.'.format(
+                self.job.name or self.job.line)
+
+        return {
+            'name': self.job.procedure,
+            'service': RPC,
+            'recipient': self.jobs.client_sid,
+            'custom_manifest': custom_manifest
+        }
+
+    def result_sent(self, bundle):
+        '''Remember the result for the cleanup
 
-        # ... and sending the result.
-        result_bundle = SERVAL.rhizome.new_bundle(
-            name=possible_job.procedure,
-            payload=payload.read(),
-            service=RPC,
-            recipient=jobs.client_sid,
-            custom_manifest=custom_manifest)
+        Arguments:
+            bundle -- The sent result
+        '''
 
         LOGGER.info('{} | -Transmission- Result is sent: bid is {}'.format(
-            job_id, result_bundle.bundle_id))
+            self.job_id, bundle.bundle_id))
+        remember_bundle(self.call, bundle)
+
+
+def server_handle_step(step):
+    '''Execute a job of a call. As long as the next job is executed by this
+    server as well, it is executed right away in the same working
+    directory, a bundle is only sent when the workflow leaves the server.
+
+    Arguments:
+        step -- The Step of the call
+    '''
+
+    step.take_snapshot()
+
+    while True:
+        # Inform the client, if the procedure is not offered or the server
+        # is not capable to execute it.
+        reason = step.check()
+        if reason:
+            return_error(step.call, reason, **step.error_arguments())
+            return
+
+        # Since we are now confident about the job, we sent an ACK and start
+        # processing.
+        ack_fields = step.ack_fields()
+        if ack_fields:
+            try:
+                SERVAL.rhizome.new_bundle(payload='', **ack_fields)
+            except DuplicateBundleException:
+                pass
 
-        # We have to remember the bundle id for cleanup lateron.
-        id_to_store = result_bundle.bundle_id
-        if potential_call.bundle_id in CLEANUP_BUNDLES:
-            CLEANUP_BUNDLES[potential_call.bundle_id].append(id_to_store)
+        if not step.join():
+            return
+
+        # After sending the ACK, execute the procedure and store the result.
+        LOGGER.info('{} | -Execution- Starting execution of {}...'.format(
+            step.job_id, step.job.procedure))
+        if step.job.procedure == GATHER:
+            code, result = step.gather()
         else:
-            CLEANUP_BUNDLES[potential_call.bundle_id] = [id_to_store]
+            code, result = server_execute_procedure_cached(
+                step.job, step.env_path + '/', step.job_id)
 
-    # This seems a little dangling, but in every case a payload is created
-    # which needs to be closed anyway, so just do it here.
-    payload.close()
+        if step.consume_energy():
+            server_publish_procedures()
+
+        # After executing the job, we have to update the job file.
+        next_jobs = step.finish(code, result)
+        if not next_jobs:
+            break
+
+        reason = step.plan(next_jobs)
+        if reason:
+            return_error(step.call, reason, **step.error_arguments())
+            return
+
+        if step.remote_jobs:
+            # Done. Make the payload containing all required files ...
+            payload_path = blobs.make_zip(
+                SERVAL.rhizome,
+                step.next_hop_files(),
+                name=step.result_step_path,
+                subpath_to_remove=step.env_path + '/',
+                owner=step.call.bundle_id)
+
+            # ... and send a call to every next hop. Independent branches of
+            # a workflow are executed in parallel this way.
+            for next_job in step.remote_jobs:
+                next_hop_bundle = transfer.insert_bundle(
+                    SERVAL.rhizome,
+                    SERVER_DEFAULT_SID,
+                    payload_path=payload_path,
+                    **step.next_hop_fields(next_job))
+                step.next_hop_sent(next_job, next_hop_bundle)
+
+        if not step.local_jobs:
+            return
+
+        # Further local branches are handled by the workers like calls. If
+        # all workers are busy and the queue is full, or in a queue, the
+        # branch is executed right here.
+        for next_job in step.local_jobs[1:]:
+            branch = step.branch(next_job)
+            if not (EXECUTOR and EXECUTOR.submit(branch,
+                                                 server_handle_step)):
+                server_handle_step(branch)
+
+        # The first one continues in this working directory.
+        step.continue_with(step.local_jobs[0])
+
+    # There is no next hop, return the result to the client.
+    payload_path = blobs.make_zip(
+        SERVAL.rhizome,
+        step.result_files(),
+        name=step.result_path,
+        subpath_to_remove=step.env_path + '/',
+        owner=step.call.bundle_id)
+
+    result_bundle = transfer.insert_bundle(
+        SERVAL.rhizome,
+        SERVER_DEFAULT_SID,
+        payload_path=payload_path,
+        **step.result_fields())
+    step.result_sent(result_bundle)
 
 
 def server_cleanup_store(bundle):
@@ -627,6 +1505,9 @@ def server_cleanup_store(bundle):
     global CLEANUP_BUNDLES
     global SERVAL
 
+    # Blobs only used by this call are not needed any longer.
+    blobs.release_blobs(SERVAL.rhizome, bundle.bundle_id)
+
     # check if there are bundles to be cleaned up
     if bundle.bundle_id not in CLEANUP_BUNDLES:
         return
@@ -637,8 +1518,8 @@ def server_cleanup_store(bundle):
     # Iterate over all bundles, set the CLEANUP flag. remove the payload
     # and update the bundle in the Rhizome store
     for stored_bundle_id in stored_bundle_ids:
-        stored_bundle = SERVAL.rhizome.get_bundle(stored_bundle_id)
-        stored_bundle.refresh()
+        # Only the manifest is needed, the payload is dropped anyway.
+        stored_bundle = transfer.get_bundle(SERVAL.rhizome, stored_bundle_id)
         stored_bundle.manifest.type = CLEANUP
         stored_bundle.payload = ''
         stored_bundle.update()
@@ -647,135 +1528,182 @@ def server_cleanup_store(bundle):
     CLEANUP_BUNDLES.pop(bundle.bundle_id, None)
 
 
-def server_listen(queue):
-    '''The main server listening function
+def server_dispatch_bundle(rhizome, bundle, queue):
+    '''Handles a single bundle returned by newsince
 
     Arguments:
+        rhizome -- Pyserval Rhizome connection
+        bundle -- The bundle from the newsince list
         queue -- If the procedure should be executed sequentially in a queue
         or not
     '''
 
-    LOGGER.info(' | Starting server')
+    # Offers are passed to the registry, so that lookups always see the
+    # latest offers without scanning the store.
+    if bundle.manifest.service == OFFER:
+        utilities.REGISTRY.update(rhizome, bundle)
+        return
+
+    # A chunk arrived, which may complete the blobs of waiting calls.
+    if bundle.manifest.service == BLOB:
+        if EXECUTOR:
+            resume_calls(resumable_calls(bundle.bundle_id), EXECUTOR.submit)
+        return
+
+    # If it is not a RPC bundle, skip.
+    if not bundle.manifest.service == RPC:
+        return
+
+    # We could download the bundle, but it seems that we are not the
+    # destination, so skip. The bundle may still tell that a server we
+    # called completed the call.
+    if not bundle.manifest.recipient == SERVER_DEFAULT_SID:
+        client.observe_latency(rhizome, bundle)
+        LOGGER.debug(
+            " | Received RPC bundle for other client, skipping. (bid:{})"
+            .format(bundle.manifest.id))
+        return
+
+    # At this point, we have an call and have to start handling it.
+    # Therefore, we download the manifest. The payload is streamed to disk
+    # later on, if needed.
+    try:
+        potential_call = transfer.get_bundle(rhizome, bundle.bundle_id)
+    except DecryptionError:
+        LOGGER.error(
+            " | Error decrypting received RPC bundle, skipping. (bid:{})"
+            .format(bundle.manifest.id))
+        return
+    utilities.LATENCY.observe(potential_call.manifest)
+
+    # Yay, ACK received.
+    if potential_call.manifest.type == ACK:
+        LOGGER.info('{} | Received ACK for {} from {}'.format(
+            potential_call.manifest.rpcid,
+            potential_call.manifest.name,
+            potential_call.manifest.sender))
+
+    # All checks pass, start the execution (either in background
+    # or blocking in a queue)
+    elif potential_call.manifest.type == CALL:
+        LOGGER.info(
+            '{} | -Runtime- Received call, starting handling.'
+            .format(potential_call.manifest.rpcid))
+        if queue:
+            server_handle_call(potential_call)
+        elif not EXECUTOR.submit(potential_call):
+            # All workers are busy and the queue is full, so we refuse the
+            # call instead of overloading the node.
+            reason = 'Server is overloaded.'
+            LOGGER.critical('{} | {} (queue depth {}, {} running)'.format(
+                potential_call.manifest.rpcid, reason,
+                EXECUTOR.queue_depth(), EXECUTOR.running_calls()))
+            return_error(potential_call, reason)
+
+    # If the bundle is a cleanup file, we start the cleanup routine.
+    elif potential_call.manifest.type == CLEANUP:
+        LOGGER.info('{} | Cleaning up store for bundle {}'.format(
+            potential_call.manifest.rpcid, bundle.bundle_id))
+        server_cleanup_store(potential_call)
+
+    elif potential_call.manifest.type == RESULT:
+        LOGGER.debug('{} | Recieved RPC result, skipping.'.format(
+            potential_call.manifest.rpcid))
+    else:
+        LOGGER.error(
+            "{} | Received RPC bundle of unknown type ({}), skipping."
+            .format(potential_call.manifest.rpcid,
+                    potential_call.manifest.type))
+
+
+def server_connect():
+    '''Connect to Serval and prepare the state shared by all calls: the
+    default SID, the server registry and the result cache
+
+    Returns:
+        The Pyserval Rhizome connection and the newsince token to start with
+    '''
 
     global SERVER_DEFAULT_SID
     global SERVAL
+    global RESULT_CACHE
 
-    # Create a RESTful serval_client to Serval with the parameters from
-    # the config file and get the Rhizome serval_client.
-    SERVAL = Client(
-            host=CONFIGURATION['host'],
-            port=int(CONFIGURATION['port']),
-            user=CONFIGURATION['user'],
-            passwd=CONFIGURATION['passwd']
-        )
+    # Get the RESTful serval_client to Serval with the parameters from
+    # the config file and get the Rhizome serval_client. All requests share
+    # the pooled session.
+    SERVAL = utilities.serval_client()
     rhizome = SERVAL.rhizome
     SERVER_DEFAULT_SID = SERVAL.keyring.default_identity().sid
 
-    # At this point we can publish all offered procedures and capabilities.
-    # The publish function is executed once at startup and then periodically.
-    LOGGER.info(' | Publishing procedures and capabilities.')
-    server_publish_procedures_thread()
-
     all_bundles = rhizome.get_bundlelist()
     token = all_bundles[0].token
 
-    # This is the main server loop.
-    while True:
-        try:
-            bundles = rhizome.get_bundlelist_newsince(token)
+    # Fill the server registry once, afterwards it is updated from newsince.
+    utilities.REGISTRY.load(rhizome, all_bundles)
 
-        except ConnectionError:
-            LOGGER.warn(
-                " | ConnectionError while calling newsince, continuing...")
-            time.sleep(1)
-            continue
+    RESULT_CACHE = ResultCache(
+        max_entries=int(CONFIGURATION.get('result_cache_entries', 128)),
+        max_bytes=int(CONFIGURATION.get('result_cache_bytes', 64 * 1024 * 1024)))
 
-        except RhizomeHTTPStatusError as e:
-            LOGGER.warn(
-                " | RhizomeHTTPStatusError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
+    return (rhizome, token)
 
-        except InvalidTokenError as e:
-            LOGGER.warn(
-                " | InvalidTokenError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
 
-        except KeyError as e:
-            LOGGER.warn(
-                " | KeyError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
+def server_listen(queue):
+    '''The main server listening function
 
-        except JSONDecodeError as e:
-            LOGGER.warn(
-                " | JSONDecodeError while calling newsince, hint: {}, continuing..."
-                .format(e))
-            time.sleep(1)
-            continue
+    Arguments:
+        queue -- If the procedure should be executed sequentially in a queue
+        or not
+    '''
 
-        if len(bundles) == 0:
-            time.sleep(1)
-            continue
+    LOGGER.info(' | Starting server')
 
-        bundle = bundles[0]
-        token = bundle.token
+    global EXECUTOR
 
-        # If it is not a RPC bundle, skip.
-        if not bundle.manifest.service == RPC:
-            continue
+    rhizome, token = server_connect()
 
-        # We could download the bundle, but it seems that we are not the
-        # destination, so skip.
-        if not bundle.manifest.recipient == SERVER_DEFAULT_SID:
-            LOGGER.debug(
-                " | Received RPC bundle for other client, skipping. (bid:{})"
-                .format(bundle.manifest.id))
-            continue
+    # At this point we can publish all offered procedures and capabilities.
+    # The publish function is executed once at startup and then periodically.
+    LOGGER.info(' | Publishing procedures and capabilities.')
+    server_publish_procedures_thread()
 
-        # At this point, we have an call and have to start handling it.
-        # Therefore, we download the manifest.
-        try:
-            potential_call = rhizome.get_bundle(bundle.bundle_id)
-        except DecryptionError:
-            LOGGER.error(
-                " | Error decrypting received RPC bundle, skipping. (bid:{})"
-                .format(bundle.manifest.id))
-            continue
+    # Calls are handled by a bounded number of workers, unless they should
+    # be executed sequentially.
+    if not queue:
+        EXECUTOR = CallExecutor(
+            server_handle_call,
+            workers=int(CONFIGURATION.get('workers', 4)),
+            queue_size=int(CONFIGURATION.get('queue_size', 16)))
 
-        # Yay, ACK received.
-        if potential_call.manifest.type == ACK:
-            LOGGER.info('{} | Received ACK for {} from {}'.format(
-                potential_call.manifest.rpcid,
-                potential_call.manifest.name,
-                potential_call.manifest.sender))
-
-        # All checks pass, start the execution (either in background
-        # or blocking in a queue)
-        elif potential_call.manifest.type == CALL:
-            LOGGER.info(
-                '{} | -Runtime- Received call, starting handling.'
-                .format(potential_call.manifest.rpcid))
-            if queue:
-                server_handle_call(potential_call)
-            else:
-                start_new_thread(server_handle_call, (potential_call, ))
-
-        # If the bundle is a cleanup file, we start the cleanup routine.
-        elif potential_call.manifest.type == CLEANUP:
-            LOGGER.info('{} | Cleaning up store for bundle {}'.format(
-                potential_call.manifest.rpcid, bundle.bundle_id))
-            server_cleanup_store(potential_call)
-
-        elif potential_call.manifest.type == RESULT:
-            LOGGER.debug('{} | Recieved RPC result, skipping.'.format(
-                potential_call.manifest.rpcid))
-        else:
-            LOGGER.error(
-                "{} | Received RPC bundle of unknown type ({}), skipping."
-                .format(potential_call.manifest.rpcid,
-                        potential_call.manifest.type))
+    try:
+        server_loop(rhizome, token, queue)
+    finally:
+        if EXECUTOR:
+            LOGGER.info(' | Stopping workers.')
+            EXECUTOR.shutdown()
+        stop_persistent_procedures()
+        utilities.LATENCY.save(force=True)
+
+
+def stop_persistent_procedures():
+    '''Stop the warm workers of all persistent procedures
+    '''
+
+    for procedure in PERSISTENT_PROCEDURES.values():
+        procedure.stop()
+
+
+def server_loop(rhizome, token, queue):
+    '''The main server loop, watches the store and dispatches all bundles
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        token -- The newsince token to start with
+        queue -- If the procedure should be executed sequentially in a queue
+        or not
+    '''
+
+    watcher = BundleWatcher(rhizome, token)
+    watcher.subscribe(
+        lambda bundle: server_dispatch_bundle(rhizome, bundle, queue))
+    watcher.run()
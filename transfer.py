@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Streaming transfer of bundle payloads. Payloads are read from and
+written to files in chunks, so they never have to fit into memory.
+'''
+
+import os
+import re
+import json
+import uuid
+
+from pyserval.lowlevel.rhizome import Manifest
+from pyserval.rhizome import Bundle
+from pyserval.exceptions import DecryptionError, DuplicateBundleException
+from pyserval.exceptions import ManifestNotFoundError, PayloadNotFoundError
+from pyserval.exceptions import InvalidTokenError
+from pyserval.exceptions import RhizomeHTTPStatusError, RhizomeInsertionError
+
+from utilities import CONFIGURATION
+from utilities import serval_session
+
+# Number of bytes read or written at once.
+CHUNK_SIZE = 64 * 1024
+
+# Bytes which may change the state of TableParser.
+TABLE_STRUCTURE = re.compile(rb'[][{}"\\]')
+
+
+def _url(path):
+    '''Build the URL of a Serval REST endpoint
+
+    Arguments:
+        path -- Path of the endpoint
+
+    Returns:
+        The full URL
+    '''
+
+    return 'http://{}:{}{}'.format(CONFIGURATION['host'],
+                                   CONFIGURATION['port'], path)
+
+
+def _auth():
+    '''Get the credentials for the Serval REST API
+
+    Returns:
+        Tuple of user and password
+    '''
+
+    return (CONFIGURATION['user'], CONFIGURATION['passwd'])
+
+
+class MultipartStream():
+    '''A multipart/form-data body, which streams the payload file instead of
+    reading it into memory.
+    '''
+
+    def __init__(self, fields, payload_path=None, payload=b''):
+        '''Init the body
+
+        Arguments:
+            fields -- List of (name, filename, content type, value) of all
+            fields before the payload, filename and content type may be None
+
+        Keyword Arguments:
+            payload_path -- Path to the payload, payload is used if None
+            (default: {None})
+            payload -- Small payload as bytes (default: {b''})
+        '''
+
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(boundary)
+        self.payload_path = payload_path
+        self.payload = payload
+
+        head = b''
+        for name, filename, content_type, value in fields:
+            head = head + self._part_header(boundary, name, filename,
+                                            content_type)
+            head = head + value.encode('utf-8') + b'\r\n'
+
+        head = head + self._part_header(boundary, 'payload', 'file',
+                                        'application/octet-stream')
+        self.head = head
+        self.tail = '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+        payload_size = len(payload)
+        if payload_path is not None:
+            payload_size = os.path.getsize(payload_path)
+        self.length = len(self.head) + payload_size + len(self.tail)
+
+    @staticmethod
+    def _part_header(boundary, name, filename, content_type):
+        '''Build the header of a part
+
+        Arguments:
+            boundary -- The multipart boundary
+            name -- Name of the field
+            filename -- Filename of the field or None
+            content_type -- Content type of the field or None
+
+        Returns:
+            The encoded header
+        '''
+
+        header = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(
+            boundary, name)
+        if filename is not None:
+            header = header + '; filename="{}"'.format(filename)
+        header = header + '\r\n'
+        if content_type is not None:
+            header = header + 'Content-Type: {}\r\n'.format(content_type)
+        return (header + '\r\n').encode('utf-8')
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield self.head
+
+        if self.payload_path is not None:
+            with open(self.payload_path, 'rb') as payload:
+                for chunk in iter(lambda: payload.read(CHUNK_SIZE), b''):
+                    yield chunk
+        elif self.payload:
+            yield self.payload
+
+        yield self.tail
+
+
+def get_bundle(rhizome, bundle_id):
+    '''Get a bundle with its complete manifest, but without downloading the
+    payload. Use 'download_payload' to get the payload.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        bundle_id -- The ID of the bundle
+
+    Returns:
+        The bundle with an empty payload
+    '''
+
+    response = serval_session().get(
+        _url('/restful/rhizome/{}.rhm'.format(bundle_id)), auth=_auth())
+    if response.status_code == 404:
+        raise ManifestNotFoundError(bundle_id)
+    if response.status_code != 200:
+        raise RhizomeHTTPStatusError(response)
+
+    manifest = Manifest()
+    manifest.update(response.text)
+
+    return Bundle(
+        rhizome,
+        manifest=manifest,
+        payload='',
+        bundle_id=manifest.id,
+        complete=True)
+
+
+def download_payload(bundle, path):
+    '''Stream the payload of a bundle into a file
+
+    Arguments:
+        bundle -- The bundle, the manifest must be complete
+        path -- Path of the file to be written
+
+    Returns:
+        The path of the written file
+    '''
+
+    endpoint = 'raw.bin'
+    if bundle.manifest.crypt == 1:
+        endpoint = 'decrypted.bin'
+
+    with serval_session().get(
+            _url('/restful/rhizome/{}/{}'.format(bundle.bundle_id, endpoint)),
+            auth=_auth(),
+            stream=True) as response:
+        if response.status_code == 419:
+            raise DecryptionError(bundle.bundle_id)
+        if response.status_code == 404:
+            raise PayloadNotFoundError(bundle.bundle_id)
+        if response.status_code != 200:
+            raise RhizomeHTTPStatusError(response)
+
+        with open(path, 'wb') as payload_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                payload_file.write(chunk)
+
+    return path
+
+
+def insert_bundle(rhizome,
+                  sender,
+                  payload_path=None,
+                  name='',
+                  service='',
+                  recipient='',
+                  custom_manifest=None,
+                  bundle_secret=None):
+    '''Insert a new bundle, the payload is streamed from a file
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        sender -- SID of the local identity authoring the bundle, the bundle
+        is anonymous if empty
+
+    Keyword Arguments:
+        payload_path -- Path to the payload, empty if None (default: {None})
+        name -- Name of the bundle (default: {''})
+        service -- Service of the bundle (default: {''})
+        recipient -- SID of the recipient, the payload is encrypted if set
+        (default: {''})
+        custom_manifest -- Additional manifest fields (default: {None})
+        bundle_secret -- Secret key of the bundle as hex string, which
+        determines the bundle ID (default: {None})
+
+    Returns:
+        The new bundle with an empty payload
+    '''
+
+    fields = [('name', name), ('service', service), ('sender', sender),
+              ('recipient', recipient), ('crypt', 1 if recipient else 0)]
+    if custom_manifest:
+        fields.extend(custom_manifest.items())
+
+    body = MultipartStream(
+        insert_parts(sender, fields, bundle_secret=bundle_secret),
+        payload_path)
+
+    response = serval_session().post(
+        _url('/restful/rhizome/insert'),
+        auth=_auth(),
+        data=body,
+        headers={'Content-Type': body.content_type})
+
+    return insert_result(rhizome, sender, response.status_code,
+                         response.text, response.headers)
+
+
+def insert_parts(sender, fields, bundle_id=None, bundle_secret=None):
+    '''Build the form fields of an insert request, without the payload
+
+    Arguments:
+        sender -- SID of the local identity authoring the bundle, the bundle
+        is anonymous if empty
+        fields -- List of (key, value) of the manifest
+
+    Keyword Arguments:
+        bundle_id -- ID of an existing bundle to be updated (default: {None})
+        bundle_secret -- Secret key of the bundle as hex string, which
+        determines the bundle ID (default: {None})
+
+    Returns:
+        List of fields for MultipartStream
+    '''
+
+    # Empty values are not part of the manifest, but 0 is.
+    manifest_text = ''.join(
+        '{}={}\n'.format(key, value) for key, value in fields
+        if value or value == 0)
+
+    parts = []
+    if bundle_id:
+        parts.append(('bundle-id', None, None, bundle_id))
+    if sender:
+        parts.append(('bundle-author', None, None, sender))
+    if bundle_secret:
+        parts.append(('bundle-secret', None, None, bundle_secret))
+    parts.append(('manifest', 'manifest1',
+                  'rhizome/manifest;format="text+binarysig"', manifest_text))
+
+    return parts
+
+
+def insert_result(rhizome, sender, status_code, text, headers):
+    '''Evaluate the response of an insert request
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        sender -- SID of the local identity authoring the bundle
+        status_code -- HTTP status of the response
+        text -- Body of the response
+        headers -- Headers of the response
+
+    Returns:
+        The new bundle with an empty payload
+    '''
+
+    manifest = Manifest()
+    if status_code == 201:
+        manifest.update(text)
+        return Bundle(
+            rhizome,
+            manifest=manifest,
+            payload='',
+            bundle_id=manifest.id,
+            bundle_author=sender,
+            from_here=2,
+            complete=True)
+
+    if status_code == 200:
+        manifest.update(text)
+        raise DuplicateBundleException(bid=manifest.id)
+
+    raise RhizomeInsertionError(
+        http_status=status_code,
+        bundle_status=headers.get(
+            'Serval-Rhizome-Result-Bundle-Status-Code'),
+        bundle_message=headers.get(
+            'Serval-Rhizome-Result-Bundle-Status-Message'),
+        response_text=text)
+
+
+class TableParser():
+    '''Parse a JSON table ({"header": [...], "rows": [[...], ...]}) while
+    it is received. Every row is returned as soon as it is complete, the
+    rest of the table does not have to be received.
+    '''
+
+    def __init__(self):
+        '''Init the parser
+        '''
+
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.header = None
+        self.captured = None
+
+    def feed(self, chunk):
+        '''Parse the next received bytes. Only brackets, quotes and
+        backslashes are looked at, everything in between is skipped.
+
+        Arguments:
+            chunk -- The received bytes
+
+        Returns:
+            List of (header, row) completed by the chunk
+        '''
+
+        rows = []
+        # Start of the bytes of chunk, which still have to be captured.
+        captured_from = 0
+        # Position of a byte escaped by a backslash.
+        escaped = -1
+
+        # The last chunk ended with a backslash.
+        start = 0
+        if self.escape and chunk:
+            self.escape = False
+            start = 1
+
+        for match in TABLE_STRUCTURE.finditer(chunk, start):
+            position = match.start()
+            byte = chunk[position]
+
+            # Brackets in strings are no structure.
+            if self.in_string:
+                if position == escaped:
+                    continue
+                if byte == ord('\\'):
+                    if position + 1 < len(chunk):
+                        escaped = position + 1
+                    else:
+                        self.escape = True
+                elif byte == ord('"'):
+                    self.in_string = False
+                continue
+
+            if byte == ord('"'):
+                self.in_string = True
+            elif byte in b'[{':
+                self.depth = self.depth + 1
+                # The first array in the object is the header, all arrays
+                # in the second one are rows.
+                if byte == ord('[') and self.captured is None and (
+                        self.depth == 3 or
+                        (self.depth == 2 and self.header is None)):
+                    self.captured = bytearray()
+                    captured_from = position
+            elif byte in b']}':
+                self.depth = self.depth - 1
+                if self.captured is not None and self.depth == (
+                        1 if self.header is None else 2):
+                    self.captured.extend(chunk[captured_from:position + 1])
+                    values = json.loads(self.captured.decode('utf-8'))
+                    self.captured = None
+                    if self.header is None:
+                        self.header = values
+                    else:
+                        rows.append((self.header, values))
+
+        if self.captured is not None:
+            self.captured.extend(chunk[captured_from:])
+
+        return rows
+
+
+def _table_rows(chunks):
+    '''Parse a JSON table while it is streamed, see TableParser
+
+    Arguments:
+        chunks -- Iterable of received bytes
+
+    Returns:
+        Generator of (header, row)
+    '''
+
+    parser = TableParser()
+    for chunk in chunks:
+        for header, row in parser.feed(chunk):
+            yield (header, row)
+
+
+def row_to_bundle(rhizome, header, row):
+    '''Build a bundle from a row of a bundle list
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        header -- Header of the bundle list
+        row -- The row
+
+    Returns:
+        The bundle with the standard manifest fields only
+    '''
+
+    data = dict(zip(header, row))
+
+    manifest = Manifest()
+    manifest.__dict__.update({
+        key: value for key, value in data.items()
+        if key in manifest.__dict__
+    })
+
+    bundle = Bundle(
+        rhizome,
+        manifest=manifest,
+        bundle_id=data['id'],
+        from_here=data['.fromhere'],
+        token=data['.token'])
+    if data.get('.author') is not None:
+        bundle.bundle_author = data['.author']
+
+    return bundle
+
+
+def newsince(rhizome, token, timeout=None):
+    '''Stream all bundles inserted after token. Serval keeps the
+    connection open and sends new bundles as they arrive, until its
+    timeout is reached. Every bundle is returned as soon as it was
+    received.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        token -- The newsince token
+
+    Keyword Arguments:
+        timeout -- Seconds without data, after which the connection is
+        given up (default: {None})
+
+    Returns:
+        Generator of bundles from the bundle list, with the standard
+        manifest fields only
+    '''
+
+    with serval_session().get(
+            _url('/restful/rhizome/newsince/{}/bundlelist.json'.format(token)),
+            auth=_auth(),
+            stream=True,
+            timeout=timeout) as response:
+        if response.status_code == 404:
+            raise InvalidTokenError(token, response.reason)
+        if response.status_code != 200:
+            raise RhizomeHTTPStatusError(response)
+
+        # read1 returns what was received so far, instead of waiting for
+        # a full chunk or the end of the response.
+        for header, row in _table_rows(
+                iter(lambda: response.raw.read1(CHUNK_SIZE), b'')):
+            yield row_to_bundle(rhizome, header, row)
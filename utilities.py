@@ -6,17 +6,35 @@
 '''
 
 import os
+import re
 import sys
+import glob
 import string
 import zipfile
 import errno
 import math
 import time
 import logging
+import threading
+import hashlib
+import zlib
+import bz2
+import lzma
 
 import requests
+import numpy as np
 from numpy import random
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pyserval.client import Client
+from pyserval.connection import CheckedConnection
+from pyserval.exceptions import UnauthorizedError
+from pyserval.lowlevel.client import LowLevelClient
+from pyserval.keyring import Keyring
+from pyserval.rhizome import Rhizome
+from pyserval.meshms import MeshMS
+from pyserval.meshmb import MeshMB
+from pyserval.route import Route
 
 from job import Jobfile, Job
 
@@ -30,19 +48,72 @@ CLEANUP = 'cleanup'
 # Rhizome service definitions
 OFFER = 'RPCOFFER'
 RPC = 'RPC'
+BLOB = 'RPCBLOB'
+
+# Built-in procedure collecting the results of scattered jobs.
+GATHER = 'gather'
 
 # Server selection definitions
 FIRST = 'first'
 RANDOM = 'random'
 BEST = 'best'
 PROB = 'probabilistic'
+LEARNED = 'learned'
+P2C = 'p2c'
 
 # Hold the configuration read from config file.
 CONFIGURATION = {}
 
+# Failed requests to Serval are repeated this often, waiting
+# HTTP_BACKOFF * 2^n seconds before the n-th repetition.
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.2
+
+# Serval answers with these codes, if it is busy or restarting.
+HTTP_RETRY_STATUS = (500, 502, 503, 504)
+
+# An offer has to be seen within this time (in ms) to be considered.
+OFFER_TIMEOUT = 120000
+
 # This are the available capabilities.
 filter_keywords = ['energy', 'gps_coord', 'cpu_load', 'memory', 'disk_space']
 
+# Weights of the capabilities when rating servers.
+RATING_WEIGHTS = {'energy': 3, 'cpu_load': 2, 'memory': 1, 'disk_space': 1}
+
+# Edge length of the cells of the spatial index of servers, in the unit of
+# the locations.
+GRID_CELL_SIZE = 280.0
+
+# Latency assumed for servers without statistics, in seconds.
+LATENCY_PRIOR = 30.0
+
+# Time constant of the decay of the statistics of a server, in seconds.
+# After this time without contact, they only have a weight of 1/e.
+LATENCY_STALE_TIME = 3600.0
+
+# Lower bound of the success rate used for predictions.
+LATENCY_MIN_SUCCESS = 0.05
+
+# Minimal time between two writes of the latency statistics, in seconds.
+LATENCY_SAVE_INTERVAL = 30.0
+
+# Compression policies for ZIP files, 'cpu' saves CPU time, 'bandwidth'
+# saves transmitted bytes.
+COMPRESSION_POLICIES = ['cpu', 'balanced', 'bandwidth']
+
+# Files with these extensions are already compressed and only stored.
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.7z', '.rar', '.zst',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.ogg'
+}
+
+# Size of the samples used to estimate the compression ratio.
+COMPRESSION_SAMPLE_SIZE = 16 * 1024
+
+# Files with a lower estimated saving are only stored.
+MIN_COMPRESSION_SAVING = 0.1
+
 LOGGER = logging.getLogger("dtnrpc")
 LOGGER.setLevel(logging.DEBUG)
 
@@ -70,26 +141,324 @@ def seed(random_file_path="random.seed"):
         random.seed(0)
 
 
-def replace_any_to_sid(job_file_path, linecounter, sid):
+class FileCache():
+    '''Caches the parsed content of files. A file is only parsed again if
+    its modification time or size changed.
+    '''
+
+    def __init__(self, parser):
+        '''Init the cache
+
+        Arguments:
+            parser -- Function parsing a file, gets the path as argument
+        '''
+
+        self.parser = parser
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        '''Get the parsed content of a file
+
+        Arguments:
+            path -- Path of the file
+
+        Returns:
+            The parsed content as returned by the parser
+        '''
+
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == key:
+                return entry[1]
+
+        content = self.parser(path)
+
+        with self.lock:
+            self.entries[path] = (key, content)
+
+        return content
+
+    def invalidate(self, path):
+        '''Forget a file, e.g. after writing it ourselves, since two writes
+        within the timestamp granularity can not be told apart.
+
+        Arguments:
+            path -- Path of the file
+        '''
+
+        with self.lock:
+            self.entries.pop(path, None)
+
+
+def parse_location(location_file_path):
+    '''Parse the location file
+
+    Arguments:
+        location_file_path -- Path to the location file
+
+    Returns:
+        The position as tuple of strings (x, y)
+    '''
+
+    with open(location_file_path, 'r') as location_file:
+        x, y = location_file.readline().split(' ')[:2]
+
+    return x.strip(), y.strip()
+
+
+LOCATION_CACHE = FileCache(parse_location)
+
+
+def get_location():
+    '''Get the own position from the location file in the config
+
+    Returns:
+        The position as tuple of strings (x, y)
+    '''
+
+    return LOCATION_CACHE.get(CONFIGURATION['location'])
+
+
+def replace_any_to_sid(job_file_path, linecounter, sid, old_sid='any'):
     '''Replaces 'any' with a concrete SID
 
     Arguments:
         job_file_path -- Path to the job file to be changed
         linecounter -- Line of the job file to be changed
         sid -- SID to be set
+
+    Keyword Arguments:
+        old_sid -- The server to be replaced (default: {'any'})
     '''
 
     with open(job_file_path, 'r+') as job_file:
         lines = job_file.readlines()
-        lines[linecounter] = lines[linecounter].replace('any', sid)
+        # The server is the first part of the line, so only replace the
+        # first occurrence.
+        lines[linecounter] = lines[linecounter].replace(old_sid, sid, 1)
 
         # Changes are so far only in-memory, so write it to disk.
         job_file.seek(0)
         for line in lines:
             job_file.write(line)
+        job_file.truncate()
         job_file.close()
 
 
+class ServalSession(requests.Session):
+    '''HTTP session for all requests to Serval. Connections are kept alive
+    and reused, failed requests are repeated with exponential backoff and
+    the duration of all requests is counted per endpoint.
+    '''
+
+    def __init__(self, pool_size, retries=HTTP_RETRIES):
+        '''Init the session
+
+        Arguments:
+            pool_size -- Number of connections kept alive
+
+        Keyword Arguments:
+            retries -- Number of repetitions of failed requests
+            (default: {HTTP_RETRIES})
+        '''
+
+        super().__init__()
+
+        # Requests are repeated if the connection could not be established
+        # and, if nothing was changed in the store, if Serval was busy.
+        # Inserts may have arrived, so they are not repeated after sending.
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=HTTP_BACKOFF,
+            status_forcelist=HTTP_RETRY_STATUS,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.mount('http://', adapter)
+
+        # Endpoint -> [requests, failures, total seconds, maximal seconds]
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(url):
+        '''Get the endpoint of a URL for counting, IDs and tokens are
+        replaced by '*'
+
+        Arguments:
+            url -- The requested URL
+
+        Returns:
+            The endpoint
+        '''
+
+        path = '/' + url.split('/', 3)[-1].split('?')[0]
+        path = re.sub(r'/newsince/[^/]+/', '/newsince/*/', path)
+        return re.sub(r'[0-9A-Fa-f]{32,}', '*', path)
+
+    def request(self, method, url, *args, **kwargs):
+        '''Send a request and count its duration. For streamed responses,
+        the time until the headers arrived is counted.
+
+        Arguments:
+            method -- HTTP method
+            url -- The URL
+            *args -- Further arguments of requests.Session.request
+            **kwargs -- Further keyword arguments of requests.Session.request
+
+        Returns:
+            The response
+        '''
+
+        start = time.time()
+        failed = True
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            failed = response.status_code in HTTP_RETRY_STATUS
+            return response
+        finally:
+            duration = time.time() - start
+            key = '{} {}'.format(method, self.endpoint(url))
+            with self.stats_lock:
+                stats = self.stats.setdefault(key, [0, 0, 0.0, 0.0])
+                stats[0] = stats[0] + 1
+                stats[1] = stats[1] + (1 if failed else 0)
+                stats[2] = stats[2] + duration
+                stats[3] = max(stats[3], duration)
+
+    def log_stats(self):
+        '''Log the request counters of all endpoints
+        '''
+
+        with self.stats_lock:
+            stats = sorted(self.stats.items())
+
+        for key, (count, failures, total, maximum) in stats:
+            LOGGER.info(
+                ' | HTTP {}: {} requests, {} failed, {:.3f}s mean, {:.3f}s max'
+                .format(key, count, failures, total / count, maximum))
+
+
+class SessionConnection(CheckedConnection):
+    '''Pyserval connection sending all requests through the shared session
+    '''
+
+    def _request(self, method, path, **params):
+        '''Send a request to the REST API
+
+        Arguments:
+            method -- HTTP method
+            path -- (relative) path to the REST endpoint
+            **params -- Additional parameters to be sent with the request
+
+        Returns:
+            The response
+        '''
+
+        response = serval_session().request(method, self._BASE + path,
+                                            auth=self._AUTH, **params)
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        if response.status_code == 401:
+            raise UnauthorizedError()
+
+        return response
+
+    def get(self, path, **params):
+        return self._request('GET', path, **params)
+
+    def post(self, path, **params):
+        return self._request('POST', path, **params)
+
+    def put(self, path, **params):
+        return self._request('PUT', path, **params)
+
+    def delete(self, path, **params):
+        return self._request('DELETE', path, **params)
+
+    def patch(self, path, **params):
+        return self._request('PATCH', path, **params)
+
+
+class ServalClient(Client):
+    '''Pyserval client using the shared session, see serval_client
+    '''
+
+    def __init__(self, host, port, user, passwd):
+        '''Init the client, like pyserval.client.Client
+
+        Arguments:
+            host -- Hostname to connect to
+            port -- Port to connect to
+            user -- Username for HTTP basic auth
+            passwd -- Password for HTTP basic auth
+        '''
+
+        self._connection = SessionConnection(
+            host=host, port=port, user=user, passwd=passwd)
+        self._low_level_client = LowLevelClient(self._connection)
+        self.keyring = Keyring(self._low_level_client.keyring)
+        self.rhizome = Rhizome(self._low_level_client.rhizome, self.keyring)
+        self.meshms = MeshMS(self._low_level_client.meshms)
+        self.meshmb = MeshMB(self._low_level_client.meshmb)
+        self.route = Route(self._low_level_client.route)
+
+
+# The process-wide session and client, created on first use.
+SESSION = None
+SERVAL_CLIENT = None
+SESSION_LOCK = threading.Lock()
+
+
+def serval_session():
+    '''Get the HTTP session shared by all requests to Serval. The pool
+    keeps a connection alive for every worker, the watcher and the
+    publisher, unless 'http_pool_size' is configured.
+
+    Returns:
+        The ServalSession
+    '''
+
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION is None:
+            pool_size = int(CONFIGURATION.get(
+                'http_pool_size', int(CONFIGURATION.get('workers', 4)) + 2))
+            SESSION = ServalSession(
+                pool_size,
+                retries=int(CONFIGURATION.get('http_retries', HTTP_RETRIES)))
+        return SESSION
+
+
+def serval_client():
+    '''Get the pyserval client shared by the whole process, it uses the
+    shared session
+
+    Returns:
+        The ServalClient
+    '''
+
+    global SERVAL_CLIENT
+
+    with SESSION_LOCK:
+        if SERVAL_CLIENT is None:
+            SERVAL_CLIENT = ServalClient(
+                host=CONFIGURATION['host'],
+                port=int(CONFIGURATION['port']),
+                user=CONFIGURATION['user'],
+                passwd=CONFIGURATION['passwd'])
+        return SERVAL_CLIENT
+
+
 def serval_running():
     '''Check if Serval is running
 
@@ -98,11 +467,7 @@ def serval_running():
     '''
 
     try:
-        Client(
-            host=CONFIGURATION['host'],
-            port=int(CONFIGURATION['port']),
-            user=CONFIGURATION['user'],
-            passwd=CONFIGURATION['passwd']).keyring.get_identities()
+        serval_client().keyring.get_identities()
     except requests.exceptions.ConnectionError:
         LOGGER.critical(
             ' | Serval is not running. Start with \'servald start\'')
@@ -244,6 +609,13 @@ def parse_jobfile(job_file_path):
         # Finally, add local filters, if available.
         if possible_filters:
             filter_dict = {}
+            carry = False
+            name = None
+            after = None
+            scatter = None
+            planned = False
+            radius = None
+            nearest = None
             possible_filters = possible_filters.split(' ')
             if '' in possible_filters:
                 possible_filters = [
@@ -261,8 +633,48 @@ def parse_jobfile(job_file_path):
                     filter_dict[fil[0]] = fil[1]
                     continue
 
+                # The step needs all files of the previous step, not only
+                # the changed ones.
+                elif fil[0] == 'carry':
+                    carry = True
+                    continue
+
+                # Name of the step, used to reference its result with
+                # '##name' and in the dependencies of other steps.
+                elif fil[0] == 'name' and len(fil) > 1:
+                    name = fil[1]
+                    continue
+
+                # The steps which have to be done before this step.
+                elif fil[0] == 'after':
+                    after = []
+                    if len(fil) > 1:
+                        after = [dep for dep in fil[1].split(',') if dep]
+                    continue
+
+                # The job is executed once per input.
+                elif fil[0] == 'scatter':
+                    scatter = filter_arg.partition(':')[2]
+                    continue
+
+                # The server was assigned by the workflow planner.
+                elif fil[0] == 'planned':
+                    planned = True
+                    continue
+
+                # Only servers within this distance are considered.
+                elif fil[0] == 'radius' and len(fil) > 1:
+                    radius = float(fil[1])
+                    continue
+
+                # Only this number of nearest servers is considered.
+                elif fil[0] == 'nearest' and len(fil) > 1:
+                    nearest = int(fil[1])
+                    continue
+
             jobs.add(possible_sid, procedure_name, procedure_args, status,
-                     counter, filter_dict)
+                     counter, filter_dict, carry, name, after, scatter,
+                     planned, radius, nearest)
         else:
             jobs.add(possible_sid, procedure_name, procedure_args, status,
                      counter)
@@ -317,17 +729,166 @@ def make_zip(to_zip, name='tmp_container', subpath_to_remove=''):
     if not isinstance(to_zip, str):
         with zipfile.ZipFile(name + '.zip', 'w', zipfile.ZIP_DEFLATED) as zipf:
             for arg in to_zip:
-                zipf.write(arg, arg.replace(subpath_to_remove, ''))
+                write_to_zip(zipf, arg, arg.replace(subpath_to_remove, ''))
     else:
         with zipfile.ZipFile(name + '.zip', 'w', zipfile.ZIP_DEFLATED) as zipf:
             for root, dirs, files in os.walk(to_zip):
                 for f in files:
                     path = os.path.join(root, f)
-                    zipf.write(path, path.replace(subpath_to_remove, ''))
+                    write_to_zip(zipf, path,
+                                 path.replace(subpath_to_remove, ''))
 
     return name + '.zip'
 
 
+def compression_sample(path, sample_size=COMPRESSION_SAMPLE_SIZE):
+    '''Read samples from the beginning, the middle and the end of a file
+
+    Arguments:
+        path -- Path of the file
+
+    Keyword Arguments:
+        sample_size -- Size of each sample (default: {16 KiB})
+
+    Returns:
+        The concatenated samples
+    '''
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as sampled_file:
+        if size <= 3 * sample_size:
+            return sampled_file.read()
+
+        sample = b''
+        for offset in (0, (size - sample_size) // 2, size - sample_size):
+            sampled_file.seek(offset)
+            sample = sample + sampled_file.read(sample_size)
+        return sample
+
+
+def choose_compression(path, policy='balanced'):
+    '''Choose the compression of a file in a ZIP file. The compression
+    ratio is estimated on a sample, files which do not compress well are
+    only stored.
+
+    Arguments:
+        path -- Path of the file
+
+    Keyword Arguments:
+        policy -- One of COMPRESSION_POLICIES (default: {'balanced'})
+
+    Returns:
+        Tuple of the zipfile compression type and level
+    '''
+
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return (zipfile.ZIP_STORED, None)
+
+    sample = compression_sample(path)
+    if not sample:
+        return (zipfile.ZIP_STORED, None)
+
+    # The fastest DEFLATE level is cheap enough to estimate the ratio.
+    ratio = len(zlib.compress(sample, 1)) / float(len(sample))
+    if ratio > 1 - MIN_COMPRESSION_SAVING:
+        return (zipfile.ZIP_STORED, None)
+
+    if policy == 'cpu':
+        return (zipfile.ZIP_DEFLATED, 1)
+
+    if policy == 'bandwidth':
+        # Spend CPU time for the smallest result, chosen on the sample.
+        candidates = [
+            (len(zlib.compress(sample, 9)), zipfile.ZIP_DEFLATED, 9),
+            (len(bz2.compress(sample, 9)), zipfile.ZIP_BZIP2, 9),
+            (len(lzma.compress(sample)), zipfile.ZIP_LZMA, None),
+        ]
+        _, compress_type, level = min(candidates, key=lambda c: c[0])
+        return (compress_type, level)
+
+    return (zipfile.ZIP_DEFLATED, None)
+
+
+def write_to_zip(zipf, path, arcname, policy=None):
+    '''Add a file to a ZIP file with an adaptively chosen compression
+
+    Arguments:
+        zipf -- The ZIP file opened for writing
+        path -- Path of the file
+        arcname -- Name of the file in the ZIP file
+
+    Keyword Arguments:
+        policy -- The compression policy, 'compression' from the
+        configuration if None (default: {None})
+    '''
+
+    if policy is None:
+        policy = CONFIGURATION.get('compression', 'balanced')
+
+    compress_type, level = choose_compression(path, policy)
+    zipf.write(path, arcname, compress_type, level)
+
+
+def hash_file(path, chunk_size=65536):
+    '''Compute the SHA-256 of a file without reading it into memory at once
+
+    Arguments:
+        path -- Path of the file
+
+    Keyword Arguments:
+        chunk_size -- Number of bytes read at once (default: {65536})
+
+    Returns:
+        The hex digest of the file content
+    '''
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def snapshot_files(path):
+    '''Remember the modification time and size of all files below path
+
+    Arguments:
+        path -- The directory to be scanned
+
+    Returns:
+        Dict from file path to (modification time, size)
+    '''
+
+    snapshot = {}
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            file_path = os.path.join(root, f)
+            stat = os.stat(file_path)
+            snapshot[file_path] = (stat.st_mtime_ns, stat.st_size)
+
+    return snapshot
+
+
+def changed_files(path, snapshot):
+    '''Find all files below path, which are new or changed since the
+    snapshot was taken
+
+    Arguments:
+        path -- The directory to be scanned
+        snapshot -- The snapshot returned by 'snapshot_files'
+
+    Returns:
+        List of the new and changed files
+    '''
+
+    current = snapshot_files(path)
+    return [
+        file_path for file_path, state in current.items()
+        if snapshot.get(file_path) != state
+    ]
+
+
 def insert_to_line(line, appendix):
     '''Inserts appendix to line
 
@@ -353,6 +914,97 @@ def insert_to_line(line, appendix):
     return ret_line
 
 
+def substitute_result(line, result, name=None):
+    '''Replace the placeholder of a result in a job line
+
+    Arguments:
+        line -- The job line
+        result -- The result to be inserted
+
+    Keyword Arguments:
+        name -- Name of the step of the result, '##name' is replaced. If
+        None, '##' is replaced (default: {None})
+
+    Returns:
+        The changed line
+    '''
+
+    placeholder = '##' + (name or '')
+    return re.sub(
+        re.escape(placeholder) + r'(?![\w.-])', lambda _: result, line)
+
+
+def _is_placeholder(token):
+    '''Check if a token of a job line is not filled in yet
+
+    Arguments:
+        token -- The token
+
+    Returns:
+        True, if the token is 'any' or a result placeholder
+    '''
+
+    return token == 'any' or token.startswith('##')
+
+
+def merge_job_lines(line_a, line_b):
+    '''Merge two versions of the same job line, which were changed on
+    different branches of a workflow. Filled in servers and results are
+    taken from both, as well as the DONE and ERROR markers.
+
+    Arguments:
+        line_a -- The first version
+        line_b -- The second version
+
+    Returns:
+        The merged line
+    '''
+
+    if line_a == line_b:
+        return line_a
+
+    job_a, _, filters = line_a.rstrip('\n').partition('|')
+    job_b = line_b.rstrip('\n').partition('|')[0]
+    tokens_a = job_a.split()
+    tokens_b = job_b.split()
+
+    merged = []
+    for i in range(max(len(tokens_a), len(tokens_b))):
+        token_a = tokens_a[i] if i < len(tokens_a) else None
+        token_b = tokens_b[i] if i < len(tokens_b) else None
+        if token_a is None or (_is_placeholder(token_a) and
+                               token_b is not None):
+            merged.append(token_b)
+        else:
+            merged.append(token_a)
+
+    line = ' '.join(merged)
+    if filters:
+        line = line + ' |' + filters
+    return line + '\n'
+
+
+def merge_job_files(job_file_path, other_job_file_path):
+    '''Merge another version of a job file into job_file_path
+
+    Arguments:
+        job_file_path -- Path to the job file to be changed
+        other_job_file_path -- Path to the other version of the job file
+    '''
+
+    with open(job_file_path, 'r') as job_file:
+        lines = job_file.readlines()
+    with open(other_job_file_path, 'r') as other_job_file:
+        other_lines = other_job_file.readlines()
+
+    # The first line is the client SID and not a job.
+    for i in range(1, min(len(lines), len(other_lines))):
+        lines[i] = merge_job_lines(lines[i], other_lines[i])
+
+    with open(job_file_path, 'w') as job_file:
+        job_file.writelines(lines)
+
+
 def config_files_present(server=True):
     '''Check, if all files from conf are present.
 
@@ -439,7 +1091,11 @@ class Server():
                  cpu_load=None,
                  memory=None,
                  disk_space=None,
-                 energy=None):
+                 energy=None,
+                 procedures=None,
+                 capacity=1,
+                 calls=0,
+                 published=0):
         '''Server constructor
 
         Arguments:
@@ -452,6 +1108,14 @@ class Server():
             memory -- Available memory (default: {None})
             disk_space -- Available disk space (default: {None})
             energy -- Available energy (default: {None})
+            procedures -- All offered procedures as (name, number of
+            arguments), computed from jobs if not given (default: {None})
+            capacity -- Number of calls the server handles in parallel
+            (default: {1})
+            calls -- Number of calls waiting and running on the server
+            (default: {0})
+            published -- Time the server published its status in seconds
+            (default: {0})
         '''
 
         self.sid = sid
@@ -461,68 +1125,139 @@ class Server():
         self.disk_space = float(disk_space) if disk_space else None
         self.energy = float(energy) if energy else None
         self.jobs = jobs
+        self.capacity = capacity
+        self.calls = calls
+        self.published = published
         self.rating = 0
 
+        if procedures is None:
+            procedures = set(
+                (job.procedure, len(job.arguments)) for job in jobs or [])
+        self.procedures = procedures
 
-def rate_server(server, job):
-    quality = 0
-    for requirement_name, requirement in job.filter_dict.items():
-        capability = getattr(server, requirement_name)
-
-        # If the server has no restrictions regarding this particular
-        # requirement, it gets the best quality.
-        tmp_quality = None
-        if capability is None:
-            tmp_quality = 0
-        else:
-            tmp_quality = capability / float(requirement)
-
-        if requirement == 'energy':
-            tmp_quality = tmp_quality * 3
-        if requirement == 'cpu_load':
-            tmp_quality = tmp_quality * 2
-        if requirement == 'memory':
-            tmp_quality = tmp_quality * 1
-        if requirement == 'disk_space':
-            tmp_quality = tmp_quality * 1
-
-        quality = quality + tmp_quality
-
-    server.rating = quality + ((280 / server.gps_coord) * 3)
-    return server
+        # All capabilities in the order of filter_keywords, missing
+        # capabilities are NaN. Used for the vectorized checks.
+        self.capabilities = np.array(
+            [getattr(self, keyword) for keyword in filter_keywords],
+            dtype=float)
 
 
-def sort_servers(server_list):
-    '''Sort server list based on the rating, higher is better, thus
-    sort order is reversed.
+def rate_servers(server_list, job):
+    '''Rate all servers at once based on the requirements of the job and
+    their distance. The rating is also stored in every server.
 
     Arguments:
         server_list -- List of servers
+        job -- The job to be executed
 
     Returns:
-        Sorted server list
+        Array containing the ratings in the order of server_list
     '''
 
-    return sorted(
-        server_list,
-        key=lambda x: x.rating,
-        reverse=True)
+    if not server_list:
+        return np.zeros(0)
 
+    capabilities = np.array([server.capabilities for server in server_list])
+    ratings = np.zeros(len(server_list))
 
-def select_first_server(server_list):
-    '''Select the first server
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for requirement_name, requirement in job.filter_dict.items():
+            column = capabilities[:, filter_keywords.index(requirement_name)]
 
-    Arguments:
-        server_list -- List of servers
+            # If the server has no restrictions regarding this particular
+            # requirement, it gets no additional quality.
+            quality = np.where(np.isnan(column), 0,
+                               column / float(requirement))
+            ratings += quality * RATING_WEIGHTS.get(requirement_name, 1)
 
-    Returns:
-        The first server from the list
-    '''
+        # Nearer servers are better.
+        distances = capabilities[:, filter_keywords.index('gps_coord')]
+        ratings += np.where(np.isnan(distances), 0, (280 / distances) * 3)
 
-    return server_list[0]
+    # Ratings which can not be compared are the worst.
+    ratings[np.isnan(ratings)] = -np.inf
 
+    for server, rating in zip(server_list, ratings):
+        server.rating = float(rating)
 
-def select_random_server(server_list):
+    return ratings
+
+
+def rate_server(server, job):
+    '''Rate a single server, see 'rate_servers'
+
+    Arguments:
+        server -- The server to be rated
+        job -- The job to be executed
+
+    Returns:
+        The rated server
+    '''
+
+    rate_servers([server], job)
+    return server
+
+
+def top_servers(server_list, k, ratings=None):
+    '''Get the k best rated servers without sorting the whole list.
+    Higher is better.
+
+    Arguments:
+        server_list -- List of servers
+        k -- Number of servers to return
+
+    Keyword Arguments:
+        ratings -- The ratings of the servers as returned by 'rate_servers',
+        taken from the servers if not given (default: {None})
+
+    Returns:
+        The k best servers, sorted by their rating
+    '''
+
+    if ratings is None:
+        ratings = np.array([server.rating for server in server_list],
+                           dtype=float)
+
+    k = min(k, len(server_list))
+    if k < 1:
+        return []
+
+    top = np.argpartition(-ratings, k - 1)[:k]
+    top = top[np.argsort(-ratings[top], kind='stable')]
+    return [server_list[i] for i in top]
+
+
+def sort_servers(server_list, ratings=None):
+    '''Sort server list based on the rating, higher is better, thus
+    sort order is reversed.
+
+    Arguments:
+        server_list -- List of servers
+
+    Keyword Arguments:
+        ratings -- The ratings of the servers (default: {None})
+
+    Returns:
+        Sorted server list
+    '''
+
+    return top_servers(server_list, len(server_list), ratings)
+
+
+def select_first_server(server_list):
+    '''Select the first server
+
+    Arguments:
+        server_list -- List of servers
+
+    Returns:
+        The first server from the list
+    '''
+
+    return server_list[0]
+
+
+def select_random_server(server_list):
     '''Select a random server
 
     Arguments:
@@ -535,42 +1270,118 @@ def select_random_server(server_list):
     return random.choice(server_list)
 
 
-def select_best_server(server_list):
+def select_best_server(server_list, ratings=None):
     '''Select the best server
 
     Arguments:
         server_list -- List of servers
 
+    Keyword Arguments:
+        ratings -- The ratings of the servers (default: {None})
+
     Returns:
-        The best server based on the sorted list returned from
-        'sort_servers'
+        The best server based on the ratings
     '''
 
-    return sort_servers(server_list)[0]
+    return top_servers(server_list, 1, ratings)[0]
 
 
-def select_probabilistic_server(server_list):
+def select_probabilistic_server(server_list, ratings=None):
     '''Select one of the best servers.
-    Servers are first sorted using 'sort_servers' and then a server
-    is selected using the gamma distribution
+    An index is drawn from the normal distribution and the server at this
+    position of the rating order is selected.
 
     Arguments:
         server_list -- List of servers
 
+    Keyword Arguments:
+        ratings -- The ratings of the servers (default: {None})
+
     Returns:
         One of the best available servers.
     '''
 
-    sorted_server_list = sort_servers(server_list)
-    index = abs(round(random.standard_normal()))
-    ret = None
-    try:
-        return sorted_server_list[index]
-    except IndexError:
-        return sorted_server_list[-1]
+    index = int(abs(round(random.standard_normal())))
+
+    # Only the servers up to the drawn index have to be ordered.
+    return top_servers(server_list, index + 1, ratings)[-1]
+
+
+def select_learned_server(server_list, job):
+    '''Select the server with the shortest predicted completion time, based
+    on the observed latencies of former calls
+
+    Arguments:
+        server_list -- List of servers
+        job -- The job to be executed
+
+    Returns:
+        The server expected to complete the job first
+    '''
+
+    predictions = [
+        LATENCY.predict(server.sid, job.procedure) for server in server_list
+    ]
+    return server_list[int(np.argmin(predictions))]
+
 
+def server_load(server):
+    '''Estimate the load of a server, i.e. the number of calls per worker.
+    Calls sent to the server after it published its status are counted as
+    well, since they are not part of the status yet.
 
-def select_server(server_list, selection_type=FIRST):
+    Arguments:
+        server -- The server
+
+    Returns:
+        The load of the server
+    '''
+
+    calls = server.calls + LATENCY.pending_calls(server.sid, server.published)
+    return calls / float(max(server.capacity, 1))
+
+
+def select_p2c_server(server_list, ratings=None):
+    '''Select the less loaded of two random servers (power of two choices).
+    This spreads the calls of many clients, which all see the same offers,
+    over the servers instead of choosing the same best server.
+
+    Arguments:
+        server_list -- List of servers
+
+    Keyword Arguments:
+        ratings -- If given, better rated servers are drawn more likely and
+        win if the load is equal (default: {None})
+
+    Returns:
+        The less loaded server of the two drawn servers
+    '''
+
+    if len(server_list) < 2:
+        return server_list[0]
+
+    probabilities = None
+    if ratings is not None:
+        # Ratings are shifted to be positive, servers which can not be
+        # compared are only drawn if there is no other choice.
+        ratings = np.asarray(ratings, dtype=float)
+        finite = np.isfinite(ratings)
+        if np.count_nonzero(finite) >= 2:
+            weights = np.where(finite,
+                               ratings - ratings[finite].min() + 1.0, 0.0)
+            probabilities = weights / weights.sum()
+
+    first, second = random.choice(len(server_list), 2, replace=False,
+                                  p=probabilities)
+    candidates = [server_list[first], server_list[second]]
+    loads = [server_load(server) for server in candidates]
+
+    if loads[0] == loads[1] and ratings is not None:
+        return candidates[int(ratings[second] > ratings[first])]
+    return candidates[int(loads[1] < loads[0])]
+
+
+def select_server(server_list, selection_type=FIRST, ratings=None, job=None):
     '''Server selection API function
 
     Arguments:
@@ -578,6 +1389,10 @@ def select_server(server_list, selection_type=FIRST):
 
     Keyword Arguments:
         selection_type -- The method to be used (default: {FIRST})
+        ratings -- The ratings of the servers as returned by 'rate_servers'
+        (default: {None})
+        job -- The job to be executed, required for LEARNED
+        (default: {None})
 
     Returns:
         A server from the server_list based on the selection_type
@@ -590,91 +1405,809 @@ def select_server(server_list, selection_type=FIRST):
         return select_random_server(server_list)
 
     if selection_type == BEST:
-        return select_best_server(server_list)
+        return select_best_server(server_list, ratings)
 
     if selection_type == PROB:
-        return select_probabilistic_server(server_list)
+        return select_probabilistic_server(server_list, ratings)
+
+    if selection_type == LEARNED:
+        return select_learned_server(server_list, job)
+
+    if selection_type == P2C:
+        if CONFIGURATION.get('p2c_weighted') != 'true':
+            ratings = None
+        return select_p2c_server(server_list, ratings)
 
     return None
 
 
-def parse_available_servers(rhizome, own_sid, originator_sid=None):
-    '''This function iterates through all RPC offers and parses them
-    into servers
+def parse_offer(payload, server_name):
+    '''Parses the payload of an RPC offer
 
     Arguments:
-        rhizome -- Pyserval Rhizome connection
-        own_sid -- SID of the caller of this function
-        originator_sid -- SID of the originator a particular call.
+        payload -- The decoded payload of the offer bundle
+        server_name -- The name of the offering server
 
     Returns:
-        A list containing all found servers excluding self and originator
+        A tuple of the offered jobs, a dict containing the raw capabilities
+        and a dict containing the status of the server
     '''
 
-    # Get all bundles and check if any available. If not, just return.
-    bundles = rhizome.get_bundlelist()
-    if not bundles:
-        return None
+    jobs = []
+    capabilities = {}
+    status = {}
+    for offer in payload.split('\n'):
+        # There are two lines containing :, which introduce new
+        # sections of the file. These can be skipped. All other lines
+        # containing : describe the status of the server.
+        if ':' in offer:
+            key, _, value = offer.partition(':')
+            if key not in ('procedures', 'capabilities'):
+                status[key] = value.strip()
+            continue
+        if offer == '':
+            continue
+
+        # If = is not in the line, than we have a procedure to be parsed
+        if '=' not in offer:
+            jobname = offer.split(' ')[0]
+            jobarguments = offer.split(' ')[1:]
+            jobs.append(
+                Job(server=server_name,
+                    procedure=jobname,
+                    arguments=jobarguments))
+        else:
+            # If there is a =, then we have a capability.
+            _type, _value = offer.split('=')
+            capabilities[_type] = _value
+
+    return jobs, capabilities, status
+
+
+class Offer():
+    '''Simple class for representing a parsed RPC offer
+    '''
+
+    def __init__(self, version, sender, name, jobs, capabilities,
+                 status=None):
+        '''Offer constructor
+
+        Arguments:
+            version -- Version of the offer bundle
+            sender -- SID of the offering node
+            name -- Name of the server (its SID)
+            jobs -- All jobs offered
+            capabilities -- Dict containing the raw capabilities
+
+        Keyword Arguments:
+            status -- Dict containing the raw status (default: {None})
+        '''
+
+        self.version = version
+        self.sender = sender
+        self.name = name
+        self.jobs = jobs
+        self.capabilities = capabilities
+        self.status = status or {}
+
+        # Number of calls the server handles in parallel.
+        self.capacity = int(self.status.get('workers', 1))
+
+        # Number of calls waiting and running on the server when it
+        # published the offer.
+        self.calls = (int(self.status.get('queue', 0)) +
+                      int(self.status.get('running', 0)))
+
+        # The position of the server, NaN if the server did not publish it.
+        self.coords = (np.nan, np.nan)
+        if 'gps_coord' in capabilities:
+            x, y = capabilities['gps_coord'].split(',')
+            self.coords = (float(x), float(y))
+
+        # All offered procedures as (name, number of arguments).
+        self.procedures = set(
+            (job.procedure, len(job.arguments)) for job in jobs)
+
+
+class SpatialGrid():
+    '''Uniform grid over the positions of servers. Every cell contains the
+    keys of all positions inside of it, so that only the cells near a
+    position have to be searched.
+    '''
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        '''Init the empty grid
+
+        Keyword Arguments:
+            cell_size -- Edge length of a cell (default: {GRID_CELL_SIZE})
+        '''
+
+        self.cell_size = float(cell_size)
+        # Keys of the positions in every non-empty cell.
+        self.cells = {}
+        self.positions = {}
+
+    def _cell(self, x, y):
+        '''Get the cell containing a position
+
+        Arguments:
+            x -- X coordinate
+            y -- Y coordinate
+
+        Returns:
+            The cell as tuple of integers
+        '''
+
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def insert(self, key, x, y):
+        '''Insert or move a position
+
+        Arguments:
+            key -- Key of the position
+            x -- X coordinate
+            y -- Y coordinate
+        '''
+
+        self.remove(key)
+        self.positions[key] = (x, y)
+        self.cells.setdefault(self._cell(x, y), set()).add(key)
+
+    def remove(self, key):
+        '''Remove a position, if it is in the grid
+
+        Arguments:
+            key -- Key of the position
+        '''
+
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+
+        cell = self._cell(*position)
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def _distance(self, key, x, y):
+        '''Distance between a stored position and a point
+
+        Arguments:
+            key -- Key of the position
+            x -- X coordinate of the point
+            y -- Y coordinate of the point
+
+        Returns:
+            The Euclidean distance
+        '''
+
+        position = self.positions[key]
+        return math.hypot(position[0] - x, position[1] - y)
+
+    def within(self, x, y, radius):
+        '''Find all positions within a radius around a point
+
+        Arguments:
+            x -- X coordinate of the point
+            y -- Y coordinate of the point
+            radius -- The radius
+
+        Returns:
+            List of (distance, key), sorted by the distance
+        '''
+
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+
+        # If the area covers more cells than are occupied, it is cheaper to
+        # check the occupied cells.
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            cells = [
+                cell for cell in self.cells
+                if min_x <= cell[0] <= max_x and min_y <= cell[1] <= max_y
+            ]
+        else:
+            cells = [(i, j) for i in range(min_x, max_x + 1)
+                     for j in range(min_y, max_y + 1)]
+
+        found = []
+        for cell in cells:
+            for key in self.cells.get(cell, ()):
+                distance = self._distance(key, x, y)
+                if distance <= radius:
+                    found.append((distance, key))
+
+        return sorted(found)
+
+    def nearest(self, x, y, k, accept=None):
+        '''Find the k nearest positions to a point. The cells are searched
+        in rings around the cell of the point until no unsearched position
+        can be nearer than the k-th found one.
+
+        Arguments:
+            x -- X coordinate of the point
+            y -- Y coordinate of the point
+            k -- Number of positions to be found
+
+        Keyword Arguments:
+            accept -- Function getting a key, only positions it returns True
+            for are considered (default: {None})
+
+        Returns:
+            List of (distance, key), sorted by the distance
+        '''
+
+        if k < 1 or not self.cells:
+            return []
+
+        center_x, center_y = self._cell(x, y)
+        last_ring = max(
+            max(abs(cell[0] - center_x), abs(cell[1] - center_y))
+            for cell in self.cells)
+
+        found = []
+        for ring in range(last_ring + 1):
+            # A ring is the border of a square of cells, for large rings
+            # only the occupied cells are checked.
+            if 8 * ring > len(self.cells):
+                cells = [
+                    cell for cell in self.cells
+                    if max(abs(cell[0] - center_x),
+                           abs(cell[1] - center_y)) == ring
+                ]
+            else:
+                cells = set()
+                for offset in range(-ring, ring + 1):
+                    cells.update([
+                        (center_x + offset, center_y - ring),
+                        (center_x + offset, center_y + ring),
+                        (center_x - ring, center_y + offset),
+                        (center_x + ring, center_y + offset)
+                    ])
+
+            for cell in cells:
+                for key in self.cells.get(cell, ()):
+                    if accept is None or accept(key):
+                        found.append((self._distance(key, x, y), key))
+
+            # Positions in further rings are at least this far away.
+            found.sort()
+            if len(found) >= k and found[k - 1][0] <= ring * self.cell_size:
+                break
+
+        return found[:k]
+
+
+class ServerRegistry():
+    '''In-memory registry of all RPC offers found in the Rhizome store.
+    It is filled once with a full scan of the store and afterwards kept up
+    to date with the offers seen in the newsince loops.
+    '''
+
+    def __init__(self):
+        '''Init the empty registry
+        '''
+
+        # Parsed offers, keyed by bundle id.
+        self.offers = {}
+        # Inverted index from (procedure, number of arguments) to the bundle
+        # ids of all offers containing this procedure.
+        self.index = {}
+        # Positions of all offers with a known location.
+        self.grid = SpatialGrid()
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def load(self, rhizome, bundles=None):
+        '''Fill the registry with all offers from the Rhizome store
+
+        Arguments:
+            rhizome -- Pyserval Rhizome connection
+
+        Keyword Arguments:
+            bundles -- An already fetched bundle list (default: {None})
+        '''
+
+        if bundles is None:
+            bundles = rhizome.get_bundlelist()
+
+        for bundle in bundles:
+            self.update(rhizome, bundle)
+
+        self.loaded = True
+
+    def update(self, rhizome, bundle):
+        '''Add or update an offer. The payload of the offer is only
+        downloaded and parsed if the version of the bundle changed.
+
+        Arguments:
+            rhizome -- Pyserval Rhizome connection
+            bundle -- A bundle from the bundle list or newsince
+        '''
+
+        if not self.needs_update(bundle):
+            return
+
+        self.add(bundle, rhizome.get_payload(bundle))
+
+    def needs_update(self, bundle):
+        '''Check if a bundle is a fresh offer, which is not known yet
+
+        Arguments:
+            bundle -- A bundle from the bundle list or newsince
+
+        Returns:
+            True, if the payload of the offer has to be added
+        '''
 
-    server_list = []
-    for bundle in bundles:
         # We are only intereseted in RPC offers.
         if not bundle.manifest.service == OFFER:
-            continue
+            return False
 
-        # Make sure, that we can not call ourself.
-        if bundle.manifest.sender == own_sid:
-            continue
+        version = int(bundle.manifest.version)
+        if int(time.time() * 1000) - version > OFFER_TIMEOUT:
+            return False
 
-        # Do not call a procedure on the node which wants it to be offloaded...
-        if bundle.manifest.sender == originator_sid:
-            continue
+        with self.lock:
+            known = self.offers.get(bundle.bundle_id)
+            return not known or known.version < version
 
-        # A offer has to be seen within the last 120 seconds.
-        bundle_version = int(bundle.manifest.version)
-        time_in_store = int(time.time() * 1000) - bundle_version
-        if time_in_store > 120000:
-            continue
+    def add(self, bundle, payload):
+        '''Parse and store the payload of an offer
+
+        Arguments:
+            bundle -- A bundle from the bundle list or newsince
+            payload -- The downloaded payload of the offer
+        '''
+
+        version = int(bundle.manifest.version)
+        jobs, capabilities, status = parse_offer(
+            payload.decode('utf-8'), bundle.manifest.name)
+        offer = Offer(version, bundle.manifest.sender, bundle.manifest.name,
+                      jobs, capabilities, status)
+
+        with self.lock:
+            # Another thread may have stored a newer version meanwhile.
+            known = self.offers.get(bundle.bundle_id)
+            if known and known.version >= version:
+                return
+            self._remove(bundle.bundle_id)
+            self.offers[bundle.bundle_id] = offer
+            for procedure in offer.procedures:
+                self.index.setdefault(procedure, set()).add(bundle.bundle_id)
+            if not np.isnan(offer.coords).any():
+                self.grid.insert(bundle.bundle_id, *offer.coords)
+
+    def _remove(self, bundle_id):
+        '''Removes an offer and its index entries. The lock has to be held.
+
+        Arguments:
+            bundle_id -- The bundle id of the offer
+        '''
+
+        offer = self.offers.pop(bundle_id, None)
+        if offer is None:
+            return
+        self.grid.remove(bundle_id)
+
+        for procedure in offer.procedures:
+            bundle_ids = self.index[procedure]
+            bundle_ids.discard(bundle_id)
+            if not bundle_ids:
+                self.index.pop(procedure)
+
+    def evict(self, now):
+        '''Removes all offers, which are older than OFFER_TIMEOUT
+
+        Arguments:
+            now -- The current time in milliseconds
+        '''
+
+        with self.lock:
+            for bundle_id in list(self.offers):
+                if now - self.offers[bundle_id].version > OFFER_TIMEOUT:
+                    self._remove(bundle_id)
 
-        jobs = []
-        capabilities = {}
-
-        # We found an offer from a remote server. Start parsing.
-        offers = rhizome.get_payload(bundle).decode('utf-8').split('\n')
-        for offer in offers:
-            # There are two lines containing :, which introduce new
-            # sections of the file. These can be skipped.
-            if ':' in offer or offer == '':
-                continue
-
-            # If = is not in the line, than we have a procedure to be parsed
-            if '=' not in offer:
-                jobname = offer.split(' ')[0]
-                jobarguments = offer.split(' ')[1:]
-                jobs.append(
-                    Job(server=bundle.manifest.name,
-                        procedure=jobname,
-                        arguments=jobarguments))
+    def offer(self, sid):
+        '''Get the latest fresh offer of a server
+
+        Arguments:
+            sid -- SID of the server
+
+        Returns:
+            The offer or None, if the server has no fresh offer
+        '''
+
+        self.evict(int(time.time() * 1000))
+
+        with self.lock:
+            offers = [
+                offer for offer in self.offers.values() if offer.sender == sid
+            ]
+
+        if not offers:
+            return None
+        return max(offers, key=lambda offer: offer.version)
+
+    def servers(self, own_sid, originator_sid=None, job=None,
+                include_self=False):
+        '''Builds Server objects for all fresh offers
+
+        Arguments:
+            own_sid -- SID of the caller of this function
+
+        Keyword Arguments:
+            originator_sid -- SID of the originator a particular call
+            (default: {None})
+            job -- Only return servers offering this job, if the job has a
+            radius or a number of nearest servers, only these servers are
+            returned (default: {None})
+            include_self -- Also return the caller's own offer
+            (default: {False})
+
+        Returns:
+            A list containing all servers excluding originator and, unless
+            include_self is set, self
+        '''
+
+        self.evict(int(time.time() * 1000))
+
+        # Our own location is needed to compute the distances to the servers.
+        x2, y2 = get_location()
+
+        # Make sure, that we can not call ourself (unless the call can be
+        # handled locally) and do not call a procedure on the node which
+        # wants it to be offloaded...
+        def accept(bundle_id):
+            offer = self.offers[bundle_id]
+            return ((include_self or offer.sender != own_sid) and
+                    offer.sender != originator_sid)
+
+        with self.lock:
+            if job is None:
+                bundle_ids = list(self.offers)
             else:
-                # If there is a =, then we have a capability.
-                _type, _value = offer.split('=')
-                if _type == 'gps_coord':
-                    # Location is a special case. We need to compute our
-                    # own distance to the server distance, which will be stored
-                    x1, y1 = _value.split(',')
-                    x2 = y2 = None
-                    with open(CONFIGURATION['location']) as coord_file:
-                        x2, y2 = coord_file.readline().split(' ')
-                        _value = math.sqrt((float(x1) - float(x2))**2 +
-                                           (float(y1) - float(y2))**2)
+                bundle_ids = self.index.get(
+                    (job.procedure, len(job.arguments)), set())
+
+            # Servers far away are pruned with the spatial index before
+            # anything else is done.
+            if job is not None and job.radius is not None:
+                bundle_ids = [
+                    bundle_id for _, bundle_id in self.grid.within(
+                        float(x2), float(y2), job.radius)
+                    if bundle_id in bundle_ids
+                ]
+            if job is not None and job.nearest is not None:
+                candidates = set(bundle_ids)
+                bundle_ids = [
+                    bundle_id for _, bundle_id in self.grid.nearest(
+                        float(x2), float(y2), job.nearest,
+                        lambda bundle_id: (bundle_id in candidates and
+                                           accept(bundle_id)))
+                ]
 
-                capabilities[_type] = _value
+            offers = [
+                self.offers[bundle_id] for bundle_id in bundle_ids
+                if accept(bundle_id)
+            ]
+
+        if not offers:
+            return []
+
+        coords = np.array([offer.coords for offer in offers], dtype=float)
+        distances = np.hypot(coords[:, 0] - float(x2),
+                             coords[:, 1] - float(y2))
+
+        server_list = []
+        for offer, distance in zip(offers, distances):
+            capabilities = dict(offer.capabilities)
+            # Location is a special case, we store our own distance to the
+            # server instead of its position.
+            capabilities['gps_coord'] = (None if np.isnan(distance) else
+                                         float(distance))
+            server_list.append(
+                Server(offer.name, jobs=offer.jobs,
+                       procedures=offer.procedures, capacity=offer.capacity,
+                       calls=offer.calls, published=offer.version / 1000.0,
+                       **capabilities))
+
+        return server_list
+
+
+# The process-wide registry of all known servers.
+REGISTRY = ServerRegistry()
+
+
+class LatencyModel():
+    '''Statistics about how fast servers turned calls around, kept per
+    server and procedure: the moving average of the latency, the success
+    rate and the time of the last contact. A call is complete as soon as
+    the server is seen sending anything for it except of an ACK, i.e. the
+    call of the next step, the result or an error. The statistics are
+    stored in a text file with one line 'SID PROCEDURE LATENCY SUCCESS LAST
+    COUNT' per entry. Changes are written at most every
+    LATENCY_SAVE_INTERVAL seconds and on save(force=True).
+    '''
 
-        # After parsing, create a Server object and store it in the result list
-        s = Server(bundle.manifest.name, jobs=jobs, **capabilities)
-        server_list.append(s)
+    def __init__(self, alpha=0.3):
+        '''Init the empty model
 
-    return server_list
+        Keyword Arguments:
+            alpha -- Weight of a new observation in the moving averages
+            (default: {0.3})
+        '''
+
+        self.alpha = alpha
+        self.path = None
+        # Statistics keyed by (SID, procedure), every entry is a list of
+        # latency, success rate, last contact and number of calls.
+        self.entries = {}
+        # Sent calls, which are not complete yet, keyed by (SID, rpcid).
+        # Every value is a list of (procedure, time sent).
+        self.pending = {}
+        # If the entries changed since they were written, and when.
+        self.dirty = False
+        self.saved = 0
+        self.lock = threading.Lock()
+        # Serializes the writes, which happen without holding lock.
+        self.save_lock = threading.Lock()
+
+    def load(self, path):
+        '''Read the statistics from a file, a missing file is empty
+
+        Arguments:
+            path -- Path of the file, also used to store the statistics
+        '''
+
+        with self.lock:
+            self.path = path
+            if not os.path.isfile(path):
+                return
+
+            with open(path, 'r') as store:
+                for line in store:
+                    parts = line.split()
+                    if len(parts) != 6:
+                        continue
+                    self.entries[(parts[0], parts[1])] = [
+                        float(parts[2]), float(parts[3]), float(parts[4]),
+                        int(parts[5])
+                    ]
+
+    def save(self, force=False):
+        '''Write the changed statistics to the file, unless they were
+        written less than LATENCY_SAVE_INTERVAL seconds ago
+
+        Keyword Arguments:
+            force -- Write the changes regardless of the interval, e.g. on
+            shutdown (default: {False})
+        '''
+
+        with self.lock:
+            if not self.dirty or self.path is None:
+                return
+            if not force and \
+                    time.time() - self.saved < LATENCY_SAVE_INTERVAL:
+                return
+
+            lines = [
+                '{} {} {:.3f} {:.3f} {:.0f} {}\n'.format(
+                    sid, procedure, *entry)
+                for (sid, procedure), entry in self.entries.items()
+            ]
+            path = self.path
+            self.dirty = False
+            self.saved = time.time()
+
+        # Other threads are not blocked by the disk.
+        with self.save_lock:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as store:
+                store.writelines(lines)
+            os.replace(temp_path, path)
+
+    def _ensure_loaded(self):
+        '''Load the statistics from the configured file on first use
+        '''
+
+        if self.path is None:
+            self.load(CONFIGURATION.get('latency_store', 'latency.stats'))
+
+    def sent(self, sid, procedure, rpcid):
+        '''Remember a sent call
+
+        Arguments:
+            sid -- SID of the called server
+            procedure -- The called procedure
+            rpcid -- The rpcid of the call
+        '''
+
+        self._ensure_loaded()
+        with self.lock:
+            self.pending.setdefault((sid, rpcid), []).append(
+                (procedure, time.time()))
+
+    def pending_calls(self, sid, since=0):
+        '''Count the calls sent to a server, which are not complete yet
+
+        Arguments:
+            sid -- SID of the server
+
+        Keyword Arguments:
+            since -- Only count calls sent after this time in seconds
+            (default: {0})
+
+        Returns:
+            The number of pending calls
+        '''
+
+        with self.lock:
+            return sum(
+                1 for key, calls in self.pending.items() if key[0] == sid
+                for _, sent in calls if sent > since)
+
+    def waiting_for(self, sid):
+        '''Check if calls sent to a server are not complete yet
+
+        Arguments:
+            sid -- SID of the server
+
+        Returns:
+            True, if a call to the server is pending
+        '''
+
+        with self.lock:
+            return any(key[0] == sid for key in self.pending)
+
+    def observe(self, manifest):
+        '''Update the statistics with a bundle sent by a server. An ACK is
+        a contact, everything else completes the oldest pending call of the
+        server with the same rpcid.
+
+        Arguments:
+            manifest -- The complete manifest of the bundle
+        '''
+
+        key = (manifest.sender, getattr(manifest, 'rpcid', None))
+        now = time.time()
+
+        with self.lock:
+            calls = self.pending.get(key)
+            if not calls:
+                return
+
+            if manifest.type == ACK:
+                entry = self.entries.get((key[0], calls[0][0]))
+                if entry:
+                    entry[2] = now
+                return
+
+            procedure, sent = calls.pop(0)
+            if not calls:
+                del self.pending[key]
+            self._update(key[0], procedure, now - sent,
+                         manifest.type != ERROR, now)
+
+        self.save()
+
+    def _update(self, sid, procedure, latency, success, now):
+        '''Add an observation to the statistics. The lock has to be held.
+
+        Arguments:
+            sid -- SID of the server
+            procedure -- The called procedure
+            latency -- The observed latency in seconds
+            success -- If the call succeeded
+            now -- Time of the observation
+        '''
+
+        entry = self.entries.get((sid, procedure))
+        if entry is None:
+            self.entries[(sid, procedure)] = [
+                latency, 1.0 if success else 0.0, now, 1
+            ]
+        else:
+            entry[0] = (1 - self.alpha) * entry[0] + self.alpha * latency
+            entry[1] = (1 - self.alpha) * entry[1] + self.alpha * (
+                1.0 if success else 0.0)
+            entry[2] = now
+            entry[3] = entry[3] + 1
+
+        LOGGER.debug(' | {} took {:.1f}s for {} (success: {})'.format(
+            sid, latency, procedure, success))
+        self.dirty = True
+
+    def expire(self, timeout=None):
+        '''Count calls, which did not complete within timeout, as failed.
+        Called periodically by servers and the client daemon, so that
+        calls without answer are not waited for forever.
+
+        Keyword Arguments:
+            timeout -- Timeout in seconds, 'latency_timeout' if None
+            (default: {None})
+        '''
+
+        if timeout is None:
+            timeout = float(CONFIGURATION.get('latency_timeout', 600))
+        now = time.time()
+
+        with self.lock:
+            for key in list(self.pending):
+                calls = self.pending[key]
+                while calls and now - calls[0][1] > timeout:
+                    procedure, _ = calls.pop(0)
+                    self._update(key[0], procedure, timeout, False, now)
+                if not calls:
+                    del self.pending[key]
+
+        self.save()
+
+    def predict(self, sid, procedure):
+        '''Predict the time until a call of procedure on a server is
+        complete. A failed call has to be repeated, so the latency is
+        divided by the success rate. The older the last contact is, the
+        more the prediction approaches the average of all servers, since
+        the statistics may be outdated. Unknown servers get the average as
+        well, so that they are tried.
+
+        Arguments:
+            sid -- SID of the server
+            procedure -- The procedure to be called
+
+        Returns:
+            The predicted time in seconds
+        '''
+
+        self._ensure_loaded()
+        self.expire()
+
+        with self.lock:
+            known = [
+                entry[0] / max(entry[1], LATENCY_MIN_SUCCESS)
+                for (_, known_procedure), entry in self.entries.items()
+                if known_procedure == procedure
+            ]
+            entry = self.entries.get((sid, procedure))
+
+        prior = float(np.mean(known)) if known else LATENCY_PRIOR
+        if entry is None:
+            return prior
+
+        weight = math.exp(-(time.time() - entry[2]) / LATENCY_STALE_TIME)
+        expected = entry[0] / max(entry[1], LATENCY_MIN_SUCCESS)
+        return weight * expected + (1 - weight) * prior
+
+
+LATENCY = LatencyModel()
+
+
+def parse_available_servers(rhizome, own_sid, originator_sid=None,
+                            rescan=False, job=None, include_self=False):
+    '''Returns all servers currently offering procedures. The offers are
+    taken from the registry, which is filled with a full scan of the Rhizome
+    store on first use.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        own_sid -- SID of the caller of this function
+        originator_sid -- SID of the originator a particular call.
+
+    Keyword Arguments:
+        rescan -- Scan the whole store for new offers again (default: {False})
+        job -- Only return servers offering this job (default: {None})
+        include_self -- Also return the caller's own offer (default: {False})
+
+    Returns:
+        A list containing all found servers excluding originator and, unless
+        include_self is set, self
+    '''
+
+    if rescan or not REGISTRY.loaded:
+        REGISTRY.load(rhizome)
+
+    return REGISTRY.servers(own_sid, originator_sid, job, include_self)
 
 
 def find_available_servers(servers, job):
@@ -689,47 +2222,54 @@ def find_available_servers(servers, job):
         List of servers, which offer and are able to execute the procedure.
     '''
 
-    server_list = []
-    for server in servers:
-        # If the job has no capabilities, just execute it.
-        if not job.filter_dict:
-            server_list.append(server)
-            continue
+    # Skip all servers not offering the procedure we are looking for.
+    procedure = (job.procedure, len(job.arguments))
+    server_list = [
+        server for server in servers if procedure in server.procedures
+    ]
 
-        for offered_job in server.jobs:
-            # This is not the procedure we are looking for, so skip this.
-            if offered_job.procedure != job.procedure or len(
-                    offered_job.arguments) != len(job.arguments):
-                continue
-
-            # If we found a server offering the procedure, check if it is
-            # capable to execute it.
-            fullfills = True
-            for requirement in job.filter_dict:
-                capability = getattr(server, requirement)
-                # If the server has no restrictions regarding this particular
-                # requirement, just add the server to the result list.
-                if capability is None:
-                    server_list.append(server)
-                    continue
+    # If the job has no capabilities, just execute it.
+    if not job.filter_dict or not server_list:
+        return server_list
 
-                requirement_value = float(job.filter_dict[requirement])
+    # Check all requirements of all candidates at once. If the server has no
+    # restrictions regarding a particular requirement (NaN), it fullfills it.
+    capabilities = np.array([server.capabilities for server in server_list])
+    fullfills = np.ones(len(server_list), dtype=bool)
+    for requirement, requirement_value in job.filter_dict.items():
+        column = capabilities[:, filter_keywords.index(requirement)]
+        fullfills &= np.isnan(column) | (column >= float(requirement_value))
 
-                if capability < requirement_value:
-                    fullfills = False
-                    break
+    return [server_list[i] for i in np.flatnonzero(fullfills)]
 
-            if fullfills:
-                server_list.append(server)
 
-    return server_list
+def search_servers(rhizome, default_sid, originator, job, job_id,
+                   include_self=False):
+    '''Search all servers offering the procedure of job and being able to
+    execute it. If no server is found, the search is repeated up to ten
+    times.
 
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        default_sid -- SID of the caller of this function
+        originator -- SID of the originator of the call
+        job -- The job to be executed
+        job_id -- The ID of the job, used for logging
+
+    Keyword Arguments:
+        include_self -- The caller may execute the job itself
+        (default: {False})
+
+    Returns:
+        List of servers, empty if no server was found
+    '''
 
-def lookup_server(rhizome, default_sid, originator, job, job_id,
-                  job_file_path):
     for i in range(10):
-        # First, get all available offers from the Rhizome store.
-        servers = parse_available_servers(rhizome, default_sid, originator)
+        # First, get all available offers. If the last try did not find a
+        # server, we have to scan the whole store again.
+        servers = parse_available_servers(rhizome, default_sid, originator,
+                                          rescan=i > 0, job=job,
+                                          include_self=include_self)
         if not servers:
             LOGGER.warn(
                 '{} | Could not find any servers for the job in try {}/10'.
@@ -752,6 +2292,14 @@ def lookup_server(rhizome, default_sid, originator, job, job_id,
 
         break
 
+    return servers
+
+
+def lookup_server(rhizome, default_sid, originator, job, job_id,
+                  job_file_path, include_self=False):
+    servers = search_servers(rhizome, default_sid, originator, job, job_id,
+                             include_self)
+
     if not servers:
         reason = '{} | Could not find any servers for the job'.format(job_id)
         LOGGER.critical(" | " + reason)
@@ -763,10 +2311,11 @@ def lookup_server(rhizome, default_sid, originator, job, job_id,
 
     # If we have a list of potential servers, get the server based on
     # the selection algorithm as in the configure script.
-    rated_servers = [rate_server(server, job) for server in servers]
+    ratings = rate_servers(servers, job)
 
     try:
-        job.server = select_server(rated_servers, CONFIGURATION['server']).sid
+        job.server = select_server(servers, CONFIGURATION['server'],
+                                   ratings, job).sid
     except AttributeError:
         reason = '{} | Could not select server for the job using {}'.format(
             job_id, CONFIGURATION['server'])
@@ -779,3 +2328,200 @@ def lookup_server(rhizome, default_sid, originator, job, job_id,
 
     LOGGER.info('{} | Using server {} for the job.'.format(
         job_id, job.server))
+
+
+def scatter_inputs(spec):
+    '''Get the inputs of a scattered job
+
+    Arguments:
+        spec -- A glob or a comma separated list of inputs
+
+    Returns:
+        List of inputs
+    '''
+
+    if any(char in spec for char in '*?['):
+        return sorted(glob.glob(spec))
+    return [item for item in spec.split(',') if item]
+
+
+def scatter_servers(servers, count, ratings=None):
+    '''Spread count calls over servers. The best rated servers are used
+    first and every server gets calls in proportion to its capacity.
+
+    Arguments:
+        servers -- List of capable servers
+        count -- Number of calls
+
+    Keyword Arguments:
+        ratings -- The ratings of the servers, see rate_servers
+        (default: {None})
+
+    Returns:
+        List of the SIDs of the servers for all calls
+    '''
+
+    servers = sort_servers(servers, ratings)
+
+    # One round contains every server as often as its capacity.
+    round_robin = [
+        server.sid for server in servers
+        for _ in range(max(1, int(server.capacity)))
+    ]
+    return [round_robin[i % len(round_robin)] for i in range(count)]
+
+
+def _scatter_line(tokens, filters, name, after):
+    '''Build a job line for expand_scatter
+
+    Arguments:
+        tokens -- Server, procedure and arguments
+        filters -- Remaining requirements of the job
+        name -- Name of the job
+        after -- Names of the jobs this job depends on
+
+    Returns:
+        The job line
+    '''
+
+    options = filters + ['name:' + name, 'after:' + ','.join(after)]
+    return '{} | {}\n'.format(' '.join(tokens), ' '.join(options))
+
+
+def expand_scatter(rhizome, own_sid, job_file_path, jobs, job_id):
+    '''Expand every scattered job of a job file into one job per input. All
+    jobs get explicit names and dependencies, references to a scattered job
+    are replaced by references to all of its parts. If nothing depends on a
+    scattered job, a GATHER job is added, which collects the results of all
+    parts into one result.
+
+    The servers of the parts are chosen here, so that the parts are spread
+    over all capable servers.
+
+    Arguments:
+        rhizome -- Pyserval Rhizome connection
+        own_sid -- SID of the client
+        job_file_path -- Path to the job file, which is rewritten
+        jobs -- The parsed job file
+        job_id -- The ID of the job, used for logging
+
+    Returns:
+        A tuple of all inputs, which are files, and an error reason, which
+        is None on success
+    '''
+
+    input_files = []
+    if not any(job.scatter for job in jobs.joblist):
+        return (input_files, None)
+
+    with open(job_file_path, 'r') as job_file:
+        lines = job_file.readlines()
+
+    # Every job needs a name to be referenced.
+    names = {job.line: job.name or 'step{}'.format(job.line)
+             for job in jobs.joblist}
+
+    # Names of the parts of all scattered jobs.
+    parts = {}
+    for job in jobs.joblist:
+        if job.scatter:
+            inputs = scatter_inputs(job.scatter)
+            if not inputs:
+                reason = '{} | No inputs for {} found.'.format(
+                    job_id, job.procedure)
+                LOGGER.critical(reason)
+                return (input_files, reason)
+            parts[names[job.line]] = [
+                '{}.{}'.format(names[job.line], i) for i in range(len(inputs))
+            ]
+
+    new_lines = {}
+    for job in jobs.joblist:
+        job_part, _, filters = lines[job.line].rstrip('\n').partition('|')
+        tokens = job_part.split()
+        filters = [
+            option for option in filters.split()
+            if not option.startswith(('name:', 'after:', 'scatter:'))
+        ]
+
+        # Dependencies are explicit after the expansion, so '##' has to
+        # name the previous job.
+        dependencies = [names[dep.line] for dep in jobs.dependencies(job)]
+        if len(dependencies) == 1:
+            tokens = [
+                '##' + dependencies[0] if token == '##' else token
+                for token in tokens
+            ]
+
+        # References to scattered jobs are references to all parts.
+        after = []
+        for dependency in dependencies:
+            after.extend(parts.get(dependency, [dependency]))
+        expanded_tokens = []
+        for token in tokens:
+            referenced = token[2:] if token.startswith('##') else None
+            if referenced in parts:
+                expanded_tokens.extend('##' + part
+                                       for part in parts[referenced])
+            else:
+                expanded_tokens.append(token)
+        tokens = expanded_tokens
+
+        name = names[job.line]
+        if name not in parts:
+            new_lines[job.line] = [_scatter_line(tokens, filters, name,
+                                                 after)]
+            continue
+
+        inputs = scatter_inputs(job.scatter)
+        input_files.extend(item for item in inputs if os.path.isfile(item))
+
+        # The input replaces '@@' or is appended to the arguments.
+        part_tokens = []
+        for item in inputs:
+            if '@@' in tokens:
+                part_tokens.append(
+                    [item if token == '@@' else token for token in tokens])
+            else:
+                part_tokens.append(tokens + [item])
+
+        # Spread the parts over all capable servers.
+        sids = [tokens[0]] * len(inputs)
+        if tokens[0] == 'any':
+            part_job = Job(procedure=tokens[1], arguments=part_tokens[0][2:],
+                           filter_dict=job.filter_dict, radius=job.radius,
+                           nearest=job.nearest)
+            servers = search_servers(rhizome, own_sid, own_sid, part_job,
+                                     job_id)
+            if not servers:
+                reason = '{} | Could not find any servers for {}'.format(
+                    job_id, job.procedure)
+                LOGGER.critical(reason)
+                return (input_files, reason)
+            sids = scatter_servers(servers, len(inputs),
+                                   rate_servers(servers, part_job))
+
+        LOGGER.info('{} | Scattering {} over {} inputs and {} servers.'.format(
+            job_id, job.procedure, len(inputs), len(set(sids))))
+
+        new_lines[job.line] = []
+        for part, sid, part_token_list in zip(parts[name], sids, part_tokens):
+            new_lines[job.line].append(
+                _scatter_line([sid] + part_token_list[1:], filters, part,
+                              after))
+
+        # Without following jobs, the results of all parts are gathered on
+        # the server with the most parts.
+        if not jobs.dependents(job):
+            gather_sid = max(set(sids), key=sids.count)
+            new_lines[job.line].append(
+                _scatter_line(
+                    [gather_sid, GATHER] +
+                    ['##' + part for part in parts[name]], [], name,
+                    parts[name]))
+
+    with open(job_file_path, 'w') as job_file:
+        for i, line in enumerate(lines):
+            job_file.writelines(new_lines.get(i, [line]))
+
+    return (input_files, None)
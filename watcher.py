@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Watching the Rhizome store for new bundles. Clients and servers use one
+watcher instead of polling newsince on their own.
+'''
+
+import time
+import threading
+
+from pyserval.exceptions import InvalidTokenError, RhizomeHTTPStatusError
+from requests.exceptions import RequestException
+from json.decoder import JSONDecodeError
+
+import transfer
+from utilities import LOGGER
+from utilities import CONFIGURATION
+
+# Delay after a connection without new bundles, it is doubled for every
+# further idle or failed connection.
+MIN_DELAY = 0.05
+
+# Maximal delay between two connections.
+MAX_DELAY = 1.0
+
+
+class BundleWatcher():
+    '''Streams new bundles from the Rhizome store. While bundles arrive, the
+    watcher reconnects immediately. If the store is idle or not reachable,
+    the delay between two connections grows exponentially.
+
+    The bundles can either be iterated with 'bundles' or passed to all
+    subscribers with 'run'.
+    '''
+
+    def __init__(self, rhizome, token=None):
+        '''Init the watcher
+
+        Arguments:
+            rhizome -- Pyserval Rhizome connection
+
+        Keyword Arguments:
+            token -- The newsince token to start with, the latest bundle if
+            None (default: {None})
+        '''
+
+        self.rhizome = rhizome
+        self.token = token
+        self.delay = MIN_DELAY
+        self.running = False
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        '''Pass all new bundles to callback
+
+        Arguments:
+            callback -- Function getting a bundle
+        '''
+
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        '''Stop passing bundles to callback
+
+        Arguments:
+            callback -- A subscribed function
+        '''
+
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def _wait(self):
+        '''Wait before the next connection and increase the delay
+        '''
+
+        time.sleep(self.delay)
+        self.delay = min(self.delay * 2, MAX_DELAY)
+
+    def bundles(self):
+        '''Get all new bundles, blocks until new bundles arrive
+
+        Returns:
+            Generator of bundles from the bundle list
+        '''
+
+        if self.token is None:
+            self.token = self.rhizome.get_bundlelist()[0].token
+
+        timeout = float(CONFIGURATION.get('newsince_timeout', 90))
+        self.running = True
+
+        while self.running:
+            received = False
+            try:
+                for bundle in transfer.newsince(self.rhizome, self.token,
+                                                timeout):
+                    received = True
+                    self.token = bundle.token
+                    self.delay = MIN_DELAY
+                    yield bundle
+
+            except RequestException as e:
+                LOGGER.warn(
+                    " | Connection error while calling newsince, hint: {}, continuing..."
+                    .format(e))
+
+            except RhizomeHTTPStatusError as e:
+                LOGGER.warn(
+                    " | RhizomeHTTPStatusError while calling newsince, hint: {}, continuing..."
+                    .format(e))
+
+            except InvalidTokenError as e:
+                LOGGER.warn(
+                    " | InvalidTokenError while calling newsince, hint: {}, continuing..."
+                    .format(e))
+
+            except (KeyError, JSONDecodeError) as e:
+                LOGGER.warn(
+                    " | Invalid newsince response, hint: {}, continuing..."
+                    .format(e))
+
+            else:
+                # The connection ended after new bundles, so more are likely
+                # to follow.
+                if received:
+                    continue
+
+            self._wait()
+
+    def run(self):
+        '''Pass all new bundles to the subscribers, until 'stop' is called
+        '''
+
+        for bundle in self.bundles():
+            with self.lock:
+                subscribers = list(self.subscribers)
+
+            for callback in subscribers:
+                try:
+                    callback(bundle)
+                except Exception:
+                    LOGGER.exception(' | Handling bundle {} failed.'.format(
+                        bundle.bundle_id))
+
+    def stop(self):
+        '''Stop watching after the current connection
+        '''
+
+        self.running = False